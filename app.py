@@ -1,123 +1,251 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
+import os
 import time
 import re
+import uuid
+import copy
+import json
+import hashlib
+from sheets_client import FakeSheetsClient, RequestBudget, is_transient_error, rows_to_records
+from schedule_store import (JOURNAL_SHEET, capture_cells, current_journal, diff_cells, flatten_schedule, journal_rows,
+                            make_slot, schedule_from_tables, set_program_slot)
+from local_store import apply_pending
+from rules import day_occupancy, split_teachers, suggest_slots, teacher_day_masks
+from snapshots import change_kind, diff_states, group_by_room, group_by_teacher, schedule_state
+from optimizer import WorkloadOptimizer, apply_changes, double_bookings
+from ical import default_term, safe_filename
+from bell_schedule import BELL_SHEET, BellSchedule, rows_from_records
+from facilities import FACILITY_HEADERS, FACILITY_SHEET, capacities_from_records, capacity_of, occupancy, over_capacity
+from grid_payload import encode_master_grid
+from symbols import intern_schedule
+from search_index import SlotIndex
+from tenants import DEFAULT_ARCHIVE_ROOT, TenantServices, load_tenants
+from term_archive import check_term, default_term_key
 
 # --- 1. ตั้งค่าพื้นฐาน ---
 st.set_page_config(page_title="ระบบจัดตารางสอนออนไลน์ - Kru Phi", layout="wide")
 
-# เชื่อมต่อ Google Sheets
+# โรงเรียน (tenant): ตั้งค่าใน secrets.toml [tenants.<id>] หรือไฟล์ JSON ตาม SCHEDULER_TENANTS (ดู tenants.py)
+# ไม่ตั้งค่า = โรงเรียนเดียวแบบเดิม (SchoolSchedulerDB + .scheduler_cache.sqlite3)
+CACHE_PATH = os.environ.get("SCHEDULER_CACHE_PATH", ".scheduler_cache.sqlite3")
+MAX_TENANTS = int(os.environ.get("SCHEDULER_MAX_TENANTS", "8"))
+# ตรวจการแก้ไขจากผู้อื่นทุกกี่วินาที (อ่านเวอร์ชันในชีต Meta) — 0 = ปิด
+POLL_SECONDS = float(os.environ.get("SCHEDULER_POLL_SECONDS", "15"))
+
+def read_secrets():
+    try:
+        return st.secrets.to_dict()
+    except FileNotFoundError:  # ไม่มี secrets.toml (เช่น โหมด offline)
+        return {}
+
+TENANTS = load_tenants(read_secrets(), default_cache=CACHE_PATH)
+
+# เชื่อมต่อ Google Sheets (ผ่าน SheetsGateway: จำกัดโควต้า/retry/รวมการเขียน)
+# ตั้ง SCHEDULER_FAKE_SHEETS=1 (หรือ path ไฟล์ JSON) เพื่อใช้ข้อมูลจำลองแบบ offline
+# SCHEDULER_FAKE_LATENCY = หน่วงเวลาต่อคำขอ (วินาที) ให้ข้อมูลจำลองช้าเหมือน Sheets จริง (ใช้กับ loadtest.py)
+# client ที่ authorize แล้วใช้ร่วมกันทุกโรงเรียนที่ใช้ service account เดียวกัน
 @st.cache_resource
-def init_connection():
+def init_client(credentials_key):
+    fake = os.environ.get("SCHEDULER_FAKE_SHEETS")
+    if fake:
+        latency = float(os.environ.get("SCHEDULER_FAKE_LATENCY", "0"))
+        return FakeSheetsClient.from_json_file(fake, latency=latency) if os.path.isfile(fake) else FakeSheetsClient(latency=latency)
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets[credentials_key], scope)
     return gspread.authorize(creds)
 
-SHEET_NAME = "SchoolSchedulerDB"
-
-PERIODS = {
-    1: "08.15-09.00", 2: "09.00-09.45",
-    3: "10.00-10.45", 4: "10.45-11.30",
-    5: "12.20-13.05", 6: "13.05-13.50",
-    7: "14.00-14.45", 8: "14.45-15.30",
-    9: "15.45-16.30"
-}
-BREAKS = {
-    2: "พัก<br>15 นาที", 4: "พัก<br>กลางวัน",
-    6: "พัก<br>10 นาที", 8: "พัก<br>15 นาที"
-}
+# โควต้า Sheets (60 คำขอ/นาที) นับต่อ service account: ทุกโรงเรียนที่ใช้ account เดียวกันใช้ budget ก้อนเดียวกัน
+@st.cache_resource
+def init_request_budget(credentials_key):
+    return RequestBudget()
+
+# ของแต่ละโรงเรียน (gateway, journal, สำเนาในเครื่อง, sync, snapshot, ตารางสัญลักษณ์, .ics) สร้าง/ทิ้งพร้อมกัน
+# เก็บไว้ไม่เกิน MAX_TENANTS โรงเรียน: โรงเรียนที่ไม่ได้ใช้นานที่สุดถูกปล่อยก่อน (LRU) และหยุด sync เบื้องหลังของโรงเรียนนั้น
+@st.cache_resource(max_entries=MAX_TENANTS, on_release=lambda services: services.close())
+def init_tenant(tenant_id):
+    tenant = TENANTS[tenant_id]
+    return TenantServices(tenant, init_client(tenant.credentials), os.environ.get("SCHEDULER_ICS_DIR"),
+                          os.environ.get("SCHEDULER_ARCHIVE_DIR", DEFAULT_ARCHIVE_ROOT),
+                          budget=init_request_budget(tenant.credentials))
+
+def current_tenant():
+    return TENANTS[st.session_state.tenant_id]
+
+def init_connection():
+    return init_tenant(st.session_state.tenant_id).gateway
+
+def init_journal():
+    return init_tenant(st.session_state.tenant_id).journal
+
+# สำเนาข้อมูลล่าสุด + คิวการแก้ไขที่ยังไม่ได้ส่ง (ใช้งานต่อได้แม้ Sheets ล่ม)
+def init_local_store():
+    return init_tenant(st.session_state.tenant_id).store
+
+def init_sync():
+    return init_tenant(st.session_state.tenant_id).sync
+
+def init_snapshots():
+    return init_tenant(st.session_state.tenant_id).snapshots
+
+# ตารางสัญลักษณ์ (ชื่อครู/ห้อง/วิชา/สาย -> ID) ใช้ร่วมกันทุก session ของโรงเรียนเดียวกัน: ชื่อเดียวกันเก็บเป็น string เดียว
+# สร้างใหม่จากข้อมูลทุกครั้งที่โหลดใหม่ (ชื่อที่เลิกใช้ไม่ค้าง) | ในแต่ละรอบใช้ตารางเดียวกับดัชนีค้นหาของ session
+# (session อื่นอาจเปลี่ยนตารางของโรงเรียนระหว่างรอบ)
+def init_symbols():
+    return st.session_state.search_index.symbols
+
+def init_ics_builder():
+    # ไฟล์ .ics ล่าสุดของครู/ห้อง สร้างใหม่เฉพาะรายที่ตารางเปลี่ยน (แชร์ทุก session)
+    return init_tenant(st.session_state.tenant_id).ics
+
+def init_term_archive():
+    # คลังตารางของภาคเรียนที่จบแล้ว (ไฟล์ Parquet ในเครื่อง แยกโฟลเดอร์ต่อภาคเรียน)
+    return init_tenant(st.session_state.tenant_id).archive
+
+# เลือกโรงเรียน: ?school=<id> ใน URL หรือเมนูด้านข้าง (แสดงเมื่อมีมากกว่า 1 โรงเรียน)
+if st.session_state.get('tenant_id') not in TENANTS:
+    requested = st.query_params.get("school")
+    st.session_state.tenant_id = requested if requested in TENANTS else next(iter(TENANTS))
+if len(TENANTS) > 1:
+    tenant_ids = list(TENANTS)
+    chosen = st.sidebar.selectbox("🏫 โรงเรียน", tenant_ids, index=tenant_ids.index(st.session_state.tenant_id),
+                                  format_func=lambda t: TENANTS[t].name)
+    if chosen != st.session_state.tenant_id:
+        # ข้อมูล/ดัชนีใน session เป็นของโรงเรียนเดิม: ล้างแล้วโหลดใหม่
+        for k in list(st.session_state.keys()):
+            if k != 'session_id':
+                del st.session_state[k]
+        st.session_state.tenant_id = chosen
+        st.query_params["school"] = chosen
+        st.rerun()
+
 PROGRAM_OPTIONS = ["IEP", "EEP", "TEP", "TEP+", "SMEP", "SMEP+"]
-DAYS = ["จันทร์", "อังคาร", "พุธ", "พฤหัสบดี", "ศุกร์"]
+
+# กฎภาระงานครู (ดูรูปแบบใน rules.py) — ค่าเริ่มต้นเท่ากับกฎเดิม: สอนติดกันเกิน 2 คาบ (ทุกคาบที่ติดกันนับต่อเนื่อง)
+# กฎอื่นเปิดใช้ได้ตามต้องการ
+SCHEDULE_RULES = [
+    {"rule": "max_consecutive", "limit": 2},
+    # {"rule": "max_consecutive", "limit": 2, "min_break_minutes": 30},  # พักตั้งแต่ 30 นาที (พักกลางวัน) ตัดช่วงสอนติดกัน
+    # {"rule": "max_per_day", "limit": 6},
+    # {"rule": "max_per_week", "limit": 30},
+    # {"rule": "no_lunch_straddle"},
+    # {"rule": "required_free", "periods": [8, 9], "days": ["พุธ"]},  # เช่น คาบประชุม PLC
+]
+
+# ตารางเวลาเรียน (คาบ/เวลา/พัก) เป็นข้อมูล: ชีต BellSchedule ของแต่ละโรงเรียน (รูปแบบใน bell_schedule.py)
+# ไม่มีชีต = ค่าใน school_config | คอมไพล์ครั้งเดียวต่อชุดข้อมูลเป็นตาราง: คาบที่มีเรียนแต่ละวัน, ลำดับคาบ,
+# คอลัมน์ของตาราง (รวมช่องพัก) และกฎภาระงานที่รู้ช่วงพักของแต่ละวัน — ทุก loop ใช้ตารางเหล่านี้แทน range(1, 10)
+@st.cache_resource(max_entries=16)
+def compile_bell(rows):
+    bell = BellSchedule([list(r) for r in rows] or None)
+    return bell, bell.ruleset(SCHEDULE_RULES)
 
 # --- 2. ฟังก์ชันจัดการข้อมูล ---
 
 def load_data_from_gsheets():
-    try:
-        client = init_connection()
-        sh = client.open(SHEET_NAME)
-        
-        w_teach = sh.worksheet("Teachers")
-        teachers_data = w_teach.get_all_records()
-        teachers_df = pd.DataFrame(teachers_data)
-        if teachers_df.empty:
-            teachers_df = pd.DataFrame(columns=["ชื่อ-สกุล", "วิชาที่สอน", "ระดับชั้นที่สอน"])
-        
-        w_class = sh.worksheet("Classrooms")
-        class_data = w_class.get_all_records()
-        classrooms_df = pd.DataFrame(class_data)
-        
-        if classrooms_df.empty:
-            classrooms_df = create_default_classrooms()
-            
+    # เริ่มจากสำเนาในเครื่องทันที (ถ้ามี) แล้วดึงข้อมูลล่าสุดจาก Google Sheets เบื้องหลัง
+    store = init_local_store()
+    sync = init_sync()
+    values = store.load_dataset()
+    if values is None:
         try:
-            w_sched = sh.worksheet("Schedule")
-            sched_records = w_sched.get_all_records()
-        except:
-            sched_records = []
-            
-        current_rooms = classrooms_df["ห้องเรียน"].unique().tolist()
-        final_schedule = {r: {d: {p: [] for p in range(1, 10)} for d in DAYS} for r in current_rooms}
-        
-        for row in sched_records:
-            r = row['Room']
-            d = row['Day']
-            p = int(row['Period'])
-            if r in final_schedule and d in DAYS and p in range(1, 10):
-                final_schedule[r][d][p].append({
-                    "teacher": row['Teacher'],
-                    "subject": row['Subject'],
-                    "program": row['Program']
-                })
-                
-        return final_schedule, teachers_df, classrooms_df
+            values = sync.refresh()
+        except Exception as e:
+            if is_transient_error(e):
+                st.error(f"Google Sheets ไม่ตอบสนอง (โควต้าเต็ม/เครือข่าย) แม้ลองใหม่แล้ว: {e}")
+            else:
+                st.error(f"เกิดข้อผิดพลาดในการเชื่อมต่อ Google Sheets: {e}")
+            st.stop()
+            return None, None, None, None, None
+    elif 'data_initialized' not in st.session_state:
+        sync.refresh_in_background()
+    
+    # การแก้ไขที่ยังไม่ได้ส่งขึ้น Sheets (ออฟไลน์) ต้องเห็นด้วย
+    values = apply_pending(values, store.pending())
+    values[JOURNAL_SHEET] = current_journal(values.get(JOURNAL_SHEET, []))
+    tables = {t: rows_to_records(v) for t, v in values.items()}
+    
+    teachers_df = pd.DataFrame(tables["Teachers"])
+    if teachers_df.empty:
+        teachers_df = pd.DataFrame(columns=["ชื่อ-สกุล", "วิชาที่สอน", "ระดับชั้นที่สอน"])
+    
+    classrooms_df = pd.DataFrame(tables["Classrooms"])
+    
+    if classrooms_df.empty:
+        classrooms_df = create_default_classrooms()
+    
+    # สถานที่ใช้ร่วม (แล็บ/โรงยิม/ห้องคอม) + ความจุ = จำนวนห้องที่ใช้พร้อมกันได้ในคาบเดียว
+    facilities_df = pd.DataFrame(tables.get(FACILITY_SHEET, []))
+    if facilities_df.empty:
+        facilities_df = pd.DataFrame(columns=FACILITY_HEADERS)
         
-    except Exception as e:
-        st.error(f"เกิดข้อผิดพลาดในการเชื่อมต่อ Google Sheets: {e}")
-        st.stop()
-        return None, None, None
-
-def save_data_to_gsheets():
     try:
-        client = init_connection()
-        sh = client.open(SHEET_NAME)
-        
-        w_teach = sh.worksheet("Teachers")
-        w_teach.clear()
-        if not st.session_state.teachers_data.empty:
-            t_data = [st.session_state.teachers_data.columns.tolist()] + st.session_state.teachers_data.astype(str).values.tolist()
-            w_teach.update(t_data)
-            
-        w_class = sh.worksheet("Classrooms")
-        w_class.clear()
-        if not st.session_state.classrooms_data.empty:
-            c_data = [st.session_state.classrooms_data.columns.tolist()] + st.session_state.classrooms_data.astype(str).values.tolist()
-            w_class.update(c_data)
+        bell = compile_bell(tuple(tuple(r) for r in rows_from_records(tables.get(BELL_SHEET, []))))
+    except (ValueError, KeyError, IndexError) as e:
+        st.warning(f"ชีต {BELL_SHEET} ไม่ถูกต้อง ({e}) — ใช้ตารางเวลาเรียนมาตรฐานแทน")
+        bell = compile_bell(())
+    
+    # Snapshot + ท้าย journal ที่ยังไม่ถูก compact
+    current_rooms = classrooms_df["ห้องเรียน"].unique().tolist()
+    final_schedule = intern_schedule(schedule_from_tables(tables, current_rooms, bell[0].days, bell[0].periods), init_tenant(st.session_state.tenant_id).new_symbols())
             
-        w_sched = sh.worksheet("Schedule")
-        w_sched.clear()
-        
-        flat_data = []
-        headers = ["Room", "Day", "Period", "Teacher", "Subject", "Program"]
-        flat_data.append(headers)
-        
-        sched = st.session_state.schedule_data
-        for r in sched:
-            for d in sched[r]:
-                for p in sched[r][d]:
-                    for slot in sched[r][d][p]:
-                        flat_data.append([
-                            str(r), str(d), int(p), 
-                            str(slot['teacher']), str(slot['subject']), str(slot.get('program', 'รวม'))
-                        ])
-        
-        w_sched.update(flat_data)
+    return final_schedule, teachers_df, classrooms_df, bell, facilities_df
+
+def push_pending():
+    # ส่งคิวขึ้น Sheets; ถ้าต่อไม่ได้ข้อมูลยังอยู่ในเครื่องและจะซิงก์อัตโนมัติเมื่อกลับมาออนไลน์
+    sync = init_sync()
+    if not sync.sync_now():
+        st.toast(f"📴 ออฟไลน์: บันทึกไว้ในเครื่องแล้ว จะซิงก์อัตโนมัติเมื่อเชื่อมต่อได้ ({sync.last_error})")
+
+def save_data_to_gsheets():
+    # ตารางสอนไม่ถูกเขียนทับที่นี่แล้ว: การแก้คาบเรียนบันทึกเป็น journal ผ่าน save_schedule_changes()
+    store = init_local_store()
+    
+    t_data = []
+    if not st.session_state.teachers_data.empty:
+        t_data = [st.session_state.teachers_data.columns.tolist()] + st.session_state.teachers_data.astype(str).values.tolist()
+    store.enqueue("replace", "Teachers", t_data)
         
-    except Exception as e:
-        st.error(f"⛔ บันทึก Google Sheets ไม่สำเร็จ: {e}")
-        st.stop()
+    c_data = []
+    if not st.session_state.classrooms_data.empty:
+        c_data = [st.session_state.classrooms_data.columns.tolist()] + st.session_state.classrooms_data.astype(str).values.tolist()
+    store.enqueue("replace", "Classrooms", c_data)
+    
+    refresh_data_key()
+    push_pending()
+
+def save_facilities_to_gsheets():
+    # ชีต Facilities เขียนเฉพาะเมื่อแก้รายการสถานที่ (โรงเรียนที่ไม่ใช้จะไม่มีชีตนี้)
+    df = st.session_state.facilities_data
+    f_data = [df.columns.tolist()] + df.astype(str).values.tolist() if not df.empty else [list(FACILITY_HEADERS)]
+    init_local_store().enqueue("replace", FACILITY_SHEET, f_data)
+    push_pending()
+
+def save_schedule_changes(before, rooms, days):
+    # before = capture_cells(...) ก่อนแก้ไข -> append เฉพาะคาบที่เปลี่ยนลง ScheduleLog
+    after = capture_cells(st.session_state.schedule_data, rooms, days, BELL.periods)
+    changes = diff_cells(before, after)
+    if changes:
+        init_local_store().enqueue("append", JOURNAL_SHEET, journal_rows(changes, st.session_state.session_id))
+        st.session_state.search_index.apply_changes(changes)
+        refresh_data_key()
+        push_pending()
+    return changes
+
+def refresh_data_key():
+    # key ของ cache (HTML/สถิติ) = hash ของข้อมูลทั้งชุด คำนวณครั้งเดียวเมื่อข้อมูลเปลี่ยน (โหลดใหม่/บันทึกการแก้ไข) ไม่ใช่ทุก rerun
+    # ข้อมูลเหมือนกัน = key เดียวกัน -> ใช้ cache ร่วมกันทุก session ของโรงเรียนเดียวกัน
+    h = hashlib.sha1()
+    h.update(st.session_state.tenant_id.encode("utf-8"))
+    h.update(st.session_state.bell.key.encode("utf-8"))
+    h.update(json.dumps(st.session_state.schedule_data, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    h.update(st.session_state.teachers_data.to_json(force_ascii=False).encode("utf-8"))
+    h.update(st.session_state.classrooms_data.to_json(force_ascii=False).encode("utf-8"))
+    st.session_state.data_key = h.hexdigest()
 
 def create_default_classrooms():
     default_rooms = []
@@ -128,21 +256,46 @@ def create_default_classrooms():
     return pd.DataFrame(default_rooms)
 
 # --- 3. เตรียมหน่วยความจำ ---
-if 'data_initialized' not in st.session_state:
+# ตรวจการแก้ไขจากผู้อื่นแบบประหยัด: อ่านเวอร์ชันของแต่ละชีตใน Meta (คำขอเล็ก 1 ครั้ง ไม่เกินทุก POLL_SECONDS ต่อโรงเรียน)
+# เวอร์ชันเปลี่ยน -> ดึงเฉพาะชีตนั้น (ScheduleLog ดึงเฉพาะแถวใหม่) ลงสำเนาในเครื่อง แล้วทุก session โหลดจากสำเนาในรอบถัดไป
+if POLL_SECONDS > 0 and 'data_initialized' in st.session_state:
+    init_sync().poll_in_background(POLL_SECONDS)
+
+# โหลดใหม่เมื่อสำเนาในเครื่องถูกอัปเดต (เช่น refresh เบื้องหลังเสร็จ/กลับมาออนไลน์/มีผู้อื่นแก้ไข)
+if 'data_initialized' not in st.session_state or st.session_state.get('dataset_saved_at', 0) < init_local_store().saved_at():
     with st.spinner('กำลังโหลดข้อมูลจาก Google Sheets...'):
-        loaded_sched, loaded_teach, loaded_class = load_data_from_gsheets()
+        loaded_sched, loaded_teach, loaded_class, loaded_bell, loaded_fac = load_data_from_gsheets()
+    st.session_state.dataset_saved_at = init_local_store().saved_at()
     
     if loaded_sched is not None:
         st.session_state.schedule_data = loaded_sched
         st.session_state.teachers_data = loaded_teach
         st.session_state.classrooms_data = loaded_class
+        st.session_state.facilities_data = loaded_fac
+        st.session_state.bell, st.session_state.ruleset = loaded_bell
     else:
+        st.session_state.bell, st.session_state.ruleset = compile_bell(())
         st.session_state.classrooms_data = create_default_classrooms()
         current_rooms = st.session_state.classrooms_data["ห้องเรียน"].unique().tolist()
-        st.session_state.schedule_data = {r: {d: {p: [] for p in range(1, 10)} for d in DAYS} for r in current_rooms}
+        st.session_state.schedule_data = {r: st.session_state.bell.empty_week() for r in current_rooms}
         st.session_state.teachers_data = pd.DataFrame([{"ชื่อ-สกุล": "ครูตัวอย่าง", "วิชาที่สอน": "ทดสอบ", "ระดับชั้นที่สอน": "-"}])
-        
+        st.session_state.facilities_data = pd.DataFrame(columns=FACILITY_HEADERS)
+    
+    # ดัชนีค้นหาคาบ: สร้างครั้งเดียวตอนโหลด แล้วอัปเดตทีละคาบใน save_schedule_changes()
+    st.session_state.search_index = SlotIndex.from_schedule(st.session_state.schedule_data, init_tenant(st.session_state.tenant_id).symbols)
+    refresh_data_key()
     st.session_state.data_initialized = True
+elif st.session_state.search_index.symbols is not init_tenant(st.session_state.tenant_id).symbols:
+    # session อื่นโหลดข้อมูลใหม่ (ตารางสัญลักษณ์ใหม่) หรือโรงเรียนถูกปล่อยจาก cache แล้วสร้างใหม่ -> สร้างดัชนีใหม่บนตารางปัจจุบัน
+    st.session_state.search_index = SlotIndex.from_schedule(st.session_state.schedule_data, init_tenant(st.session_state.tenant_id).symbols)
+
+# ตารางเวลาเรียนของโรงเรียนนี้ (คอมไพล์แล้ว) ใช้ทั้งสคริปต์
+BELL = st.session_state.bell
+DAYS = BELL.days
+RULESET = st.session_state.ruleset
+
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:8]
 
 if 'marathon_confirm_data' not in st.session_state:
     st.session_state.marathon_confirm_data = None
@@ -159,20 +312,20 @@ def get_room_program(room_name):
     return "-"
 
 def get_teacher_subject(teacher_names_str):
-    # รองรับหลายชื่อ: "ครู A, ครู B" -> "วิชา A, วิชา B"
-    t_list = [t.strip() for t in teacher_names_str.split(',')]
-    subjects = []
+    # รองรับหลายชื่อ: "ครู A, ครู B" -> "วิชา A, วิชา B" (ค้นจาก dict ชื่อ->วิชา แทนการกรอง DataFrame ทีละคน)
     df = st.session_state.teachers_data
+    subject_of = {}
+    for name, subject in zip(df["ชื่อ-สกุล"], df["วิชาที่สอน"]):
+        subject_of.setdefault(name, str(subject))
+    subjects = []
     
-    for t in t_list:
+    for t in split_teachers(teacher_names_str):
         clean_name = t.split(" (")[0].strip()
-        row = df[df["ชื่อ-สกุล"] == clean_name]
-        if not row.empty: 
-            s = str(row.iloc[0]["วิชาที่สอน"])
-            if s and s not in subjects:
-                subjects.append(s)
+        s = subject_of.get(clean_name)
+        if s and s not in subjects:
+            subjects.append(s)
     
-    return ", ".join(subjects)
+    return init_symbols().intern(", ".join(subjects))
 
 def is_teacher_assigned_to_room(teacher_name, room_name):
     df = st.session_state.teachers_data
@@ -232,90 +385,137 @@ def get_teachers_with_status_options(current_room, day, period):
                 options.append(t)
     return sorted(options)
 
+def get_room_free_masks(room, target_prog):
+    # คาบที่ห้องนี้ยังรับวิชาของสายที่เลือกได้ (กติกาเดียวกับการล็อคและจำกัด 2 วิชา/คาบ ในฟอร์ม)
+    free = {}
+    for d in DAYS:
+        m = 0
+        for p, slots in st.session_state.schedule_data[room][d].items():
+            progs = [s.get('program', 'รวมทุกสาย') for s in slots]
+            if target_prog == "รวมทุกสาย":
+                ok = not progs
+            else:
+                ok = 'รวมทุกสาย' not in progs and target_prog not in progs and len(progs) < 2
+            if ok:
+                m |= RULESET.bit[p]
+        free[d] = m & BELL.day_mask[d]
+    return free
+
+def get_facility_capacities():
+    return capacities_from_records(st.session_state.facilities_data.to_dict("records"))
+
+def get_teacher_room_rules():
+    # (ชื่อ, วิชา, ห้องที่ได้รับมอบหมาย หรือ None = สอนได้ทุกห้อง) ตามกติกาเดียวกับ is_teacher_assigned_to_room
+    result = []
+    for _, row in st.session_state.teachers_data.iterrows():
+        assigned_str = str(row["ระดับชั้นที่สอน"])
+        if assigned_str == "-" or assigned_str == "nan" or not assigned_str.strip():
+            rooms = None
+        else:
+            rooms = {r.strip() for r in assigned_str.split(",")}
+        result.append((str(row["ชื่อ-สกุล"]), str(row["วิชาที่สอน"]), rooms))
+    return result
+
+def apply_balance_changes(changes):
+    # ตรวจบนสำเนาก่อน: ต้องไม่เพิ่มการสอนซ้อนหรือการผิดกฎภาระงาน (กรณีเลือกใช้เพียงบางรายการ)
+    sched = st.session_state.schedule_data
+    trial = copy.deepcopy(sched)
+    apply_changes(trial, changes)
+    def violation_count(s):
+        symbols = init_symbols()
+        return sum(len(v) for v in RULESET.check_all(teacher_day_masks(s, RULESET, DAYS, symbols=symbols), DAYS, symbols).values())
+    if double_bookings(trial, DAYS) > double_bookings(sched, DAYS) or violation_count(trial) > violation_count(sched):
+        return None
+    all_rooms = get_all_rooms()
+    before = capture_cells(sched, all_rooms, DAYS, BELL.periods)
+    apply_changes(sched, changes)
+    return save_schedule_changes(before, all_rooms, DAYS)
+
 def clean_teacher_name(option_string):
     if "(" in option_string:
         return option_string.split(" (")[0].strip()
     return option_string
 
-def validate_schedule_rules(schedule_updates, current_room, day, target_prog):
+def validate_schedule_rules(schedule_updates, current_room, day, target_prog, facility_updates=None, day_slice=None):
     """
     ตรวจสอบกฎโดยรองรับ Team Teaching (List of teachers per period)
     schedule_updates: { period: [TeacherA, TeacherB] } 
+    facility_updates: { period: สถานที่ } เฉพาะคาบที่ใช้สถานที่ร่วม
+    day_slice: (ครู, สถานที่) ของห้องอื่นในวันนี้ จาก day_occupancy(..., skip_room=current_room, symbols=init_symbols())
+               ที่หน้าแก้ไขสร้างไว้แล้ว -> ไม่ต้องสแกนวันนี้ซ้ำ (ไม่ส่ง = สร้างเอง)
+    สอนซ้อนตรวจจาก index ครู->คาบ->ห้อง, สถานที่เต็มจาก index สถานที่->คาบ->ห้อง (สร้างในรอบเดียวกัน),
+    กฎภาระงานตรวจด้วย bitmask ตาม SCHEDULE_RULES
     """
     conflicts = []
     all_rooms = get_all_rooms()
+    sched = st.session_state.schedule_data
     
-    # 1. Flatten all involved teachers into a set
+    # 1. Flatten all involved teachers into a set + form periods as masks
     involved_teachers = set()
-    for t_list in schedule_updates.values():
+    form_masks = {}
+    for p, t_list in schedule_updates.items():
         if t_list and t_list != ["-- ล็อค --"]:
             for t_opt in t_list:
                 involved_teachers.add(clean_teacher_name(t_opt))
+        for x in t_list:
+            if x != "-- ล็อค --":
+                t = clean_teacher_name(x)
+                form_masks[t] = form_masks.get(t, 0) | RULESET.bit[p]
+    if not involved_teachers:
+        return conflicts
+    
+    # One pass over the day: who teaches where in other rooms, and which rooms use each facility
+    # index ใช้ ID ของชื่อจากตารางสัญลักษณ์ของโรงเรียน (ชื่อจากฟอร์มค้นด้วย symbols.get)
+    symbols = init_symbols()
+    facility_updates = {p: f for p, f in (facility_updates or {}).items() if f and p in schedule_updates}
+    if day_slice is None:
+        booked = {}
+        busy = day_occupancy(sched, all_rooms, day, skip_room=current_room, facilities=booked if facility_updates else None, symbols=symbols)
+    else:
+        busy, booked = day_slice
+    # Current room: programs not being edited still count (kept apart so a shared day_slice is not modified)
+    current_other = {}
+    current_booked = {}
+    for p, slots in sched[current_room][day].items():
+        for s in slots:
+            if s.get('program', 'รวมทุกสาย') != target_prog:
+                for t in split_teachers(s['teacher']):
+                    current_other[t] = current_other.get(t, 0) | RULESET.bit[p]
+                if facility_updates and s.get('facility'):
+                    current_booked.setdefault(symbols.id(s['facility']), {}).setdefault(p, []).append(f"{current_room} ({s.get('program', 'รวมทุกสาย')})")
+
+    # --- Check 0: Facility capacity (แล็บ/โรงยิม ที่ห้องอื่นจองคาบเดียวกันไว้แล้ว) ---
+    if facility_updates:
+        capacities = get_facility_capacities()
+        for p, f in facility_updates.items():
+            facility_id = symbols.get(f)
+            users = booked.get(facility_id, {}).get(p, []) + current_booked.get(facility_id, {}).get(p, [])
+            if len(users) + 1 > capacity_of(capacities, f):
+                conflicts.append(f"⛔ **สถานที่เต็ม:** {f} ในคาบ {p} ใช้โดย {', '.join(users)} แล้ว (รับได้ {capacity_of(capacities, f)} ห้อง)")
+    week_masks = teacher_day_masks(sched, RULESET, [d for d in DAYS if d != day], all_rooms, symbols) if RULESET.week_checks else {}
     
     for teacher in involved_teachers:
-        # --- Check 1: Double Booking ---
-        for p, t_list in schedule_updates.items():
-            current_p_teachers = [clean_teacher_name(x) for x in t_list if x != "-- ล็อค --"]
-            
-            if teacher in current_p_teachers:
-                for r in all_rooms:
-                    if r == current_room: continue
-                    slots = st.session_state.schedule_data[r][day][p]
-                    for s in slots:
-                        # Split DB teachers
-                        db_teachers = [x.strip() for x in s['teacher'].split(',')]
-                        if teacher in db_teachers:
-                            conflicts.append(f"⛔ **สอนซ้อน:** ครู {teacher} สอนที่ห้อง {r} ในคาบ {p} อยู่แล้ว")
-
-        # --- Check 2: Marathon ---
-        teaching_periods = []
-        for r in all_rooms:
-            for p in range(1, 10):
-                is_teaching = False
-                
-                # Check DB Source
-                existing_slots = st.session_state.schedule_data[r][day][p]
-                
-                if r == current_room:
-                    # In current room: Check un-edited slots + edited slots
-                    
-                    # 1. Check un-edited programs
-                    for s in existing_slots:
-                        if s.get('program', 'รวมทุกสาย') != target_prog:
-                            db_teachers = [x.strip() for x in s['teacher'].split(',')]
-                            if teacher in db_teachers: is_teaching = True
-                    
-                    # 2. Check edited program
-                    if p in schedule_updates:
-                        form_teachers = [clean_teacher_name(x) for x in schedule_updates[p] if x != "-- ล็อค --"]
-                        if teacher in form_teachers:
-                            is_teaching = True
-                else:
-                    # In other room: Check DB only
-                    for s in existing_slots:
-                        db_teachers = [x.strip() for x in s['teacher'].split(',')]
-                        if teacher in db_teachers: is_teaching = True
-                
-                if is_teaching:
-                    teaching_periods.append(p)
-        
-        teaching_periods = sorted(list(set(teaching_periods)))
-        consecutive = 1
-        max_consecutive = 1
-        for i in range(1, len(teaching_periods)):
-            if teaching_periods[i] == teaching_periods[i-1] + 1:
-                consecutive += 1
-                max_consecutive = max(max_consecutive, consecutive)
-            else:
-                consecutive = 1
+        teacher_id = symbols.get(teacher)
+        busy_periods = busy.get(teacher_id, {})
         
-        if max_consecutive > 2:
-            conflicts.append(f"⚠️ **มาราธอน:** ครู {teacher} สอนติดกัน {max_consecutive} คาบ (คาบ {teaching_periods})")
+        # --- Check 1: Double Booking ---
+        for p in schedule_updates:
+            if form_masks.get(teacher, 0) & RULESET.bit[p]:
+                for r in busy_periods.get(p, []):
+                    conflicts.append(f"⛔ **สอนซ้อน:** ครู {teacher} สอนที่ห้อง {r} ในคาบ {p} อยู่แล้ว")
+
+        # --- Check 2: Marathon / workload rules ---
+        day_mask = form_masks.get(teacher, 0) | current_other.get(teacher, 0) | RULESET.mask_of(busy_periods)
+        conflicts.extend(RULESET.check_day(teacher, day, day_mask))
+        if RULESET.week_checks:
+            conflicts.extend(RULESET.check_week(teacher, {**week_masks.get(teacher_id, {}), day: day_mask}))
             
     return conflicts
 
-def apply_schedule_updates(grade, day, new_data, target_prog, auto_remove_conflict=False):
+def apply_schedule_updates(grade, day, new_data, target_prog, auto_remove_conflict=False, facilities=None):
+    # facilities: { period: สถานที่ } ของคาบที่ย้ายไปเรียนที่สถานที่ร่วม (ไม่ระบุ = ห้องเรียนประจำ)
     all_rooms = get_all_rooms()
+    before = capture_cells(st.session_state.schedule_data, all_rooms, [day], BELL.periods)
     
     for p, t_list in new_data.items():
         if t_list == ["-- ล็อค --"]: continue
@@ -355,14 +555,24 @@ def apply_schedule_updates(grade, day, new_data, target_prog, auto_remove_confli
         kept_slots = [s for s in current_slots if s.get('program', 'รวมทุกสาย') != target_prog]
         
         if real_names:
-            final_name_str = ", ".join(real_names)
+            final_name_str = init_symbols().intern(", ".join(real_names))
             subj = get_teacher_subject(final_name_str)
-            new_slot = {"teacher": final_name_str, "subject": subj, "program": target_prog}
+            new_slot = make_slot(final_name_str, subj, target_prog, init_symbols().intern((facilities or {}).get(p, "")))
             kept_slots.append(new_slot)
         
         st.session_state.schedule_data[grade][day][p] = kept_slots
         
-    save_data_to_gsheets()
+    save_schedule_changes(before, all_rooms, [day])
+
+def restore_schedule_state(target_state):
+    # คืนค่าตาม snapshot: เขียนเฉพาะคาบที่ต่างจากปัจจุบันลง journal ในคำขอเดียว
+    sched = st.session_state.schedule_data
+    all_rooms = get_all_rooms()
+    before = capture_cells(sched, all_rooms, DAYS, BELL.periods)
+    for (r, d, p, prog), _, new in diff_states(schedule_state(sched), target_state):
+        if r in sched and d in sched[r] and p in sched[r][d]:
+            set_program_slot(sched[r][d][p], prog, new)
+    return save_schedule_changes(before, all_rooms, DAYS)
 
 def natural_sort_key(s):
     try:
@@ -371,6 +581,15 @@ def natural_sort_key(s):
     except: return (s, 0)
 
 # --- 5. UI Renderers ---
+# ตารางรวม (Master View) วาดใน browser จาก JSON ย่อ (ID + ตาราง lookup) แทน HTML ทั้งตารางจาก server
+_master_grid_component = components.declare_component(
+    "master_grid", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "master_grid")
+)
+
+def master_grid(grid, key, data_key):
+    # payload เดิม (data_key เดิม) -> Streamlit ส่งซ้ำจาก message cache และ component ไม่วาดใหม่
+    return _master_grid_component(grid=grid, key=key, data_key=data_key, default=None)
+
 def render_beautiful_table(grade, data_source, filter_program=None):
     html = """<style>
         table { width: 100%; border-collapse: collapse; font-family: sans-serif; background-color: #1E1E1E; color: #E0E0E0; }
@@ -382,15 +601,16 @@ def render_beautiful_table(grade, data_source, filter_program=None):
         .divider { border-top: 1px dashed #555; margin: 4px 0; }
         .empty { color: #555; }
         .program-tag { font-size: 0.75em; background-color: #FFC107; color: #000; padding: 1px 4px; border-radius: 4px; margin-left: 5px; font-weight: normal; }
+        .facility { font-size: 0.75em; color: #A5D6A7; }
         .break-col { background-color: #333; color: #AAA; font-size: 0.8em; width: 40px; vertical-align: middle; font-weight: bold;}
     </style><table><thead><tr><th class="day-col" style="color:#FFF">วัน</th>"""
-    for p in range(1, 10):
-        html += f"<th>{p}<br><span style='font-size:0.75em; color:#AAA'>{PERIODS[p]}</span></th>"
-        if p in BREAKS: html += "<th class='break-col'></th>"
+    for p, p_time, brk in BELL.columns:
+        html += f"<th>{p}<br><span style='font-size:0.75em; color:#AAA'>{p_time}</span></th>"
+        if brk: html += "<th class='break-col'></th>"
     html += "</tr></thead><tbody>"
     for idx, d in enumerate(DAYS):
         html += f"<tr><td class='day-col'>{d}</td>"
-        for p in range(1, 10):
+        for p, _, brk in BELL.columns:
             slots = data_source[grade][d][p]
             cell_items = []
             if slots:
@@ -399,67 +619,23 @@ def render_beautiful_table(grade, data_source, filter_program=None):
                     if filter_program:
                         if prog == filter_program or prog == 'รวมทุกสาย':
                             prog_html = f"<span class='program-tag'>{prog}</span>" if prog != "รวมทุกสาย" else ""
-                            cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>{s['teacher']}</div>")
+                            fac_html = f"<div class='facility'>📍 {s['facility']}</div>" if s.get('facility') else ""
+                            cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>{s['teacher']}</div>{fac_html}")
                     else:
                         prog_html = f"<span class='program-tag'>{prog}</span>" if prog != "รวมทุกสาย" else ""
-                        cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>{s['teacher']}</div>")
+                        fac_html = f"<div class='facility'>📍 {s['facility']}</div>" if s.get('facility') else ""
+                        cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>{s['teacher']}</div>{fac_html}")
             if not cell_items: cell_html = "<span class='empty'>-</span>"
             else: cell_html = "<div class='divider'></div>".join(cell_items)
             html += f"<td>{cell_html}</td>"
-            if p in BREAKS:
-                if idx == 0: html += f"<td class='break-col' rowspan='5'>{BREAKS[p]}</td>"
+            if brk:
+                if idx == 0: html += f"<td class='break-col' rowspan='{len(DAYS)}'>{brk}</td>"
         html += "</tr>"
     html += "</tbody></table>"
     return html
 
-def render_master_matrix_html(room_list, data_source):
-    html = """
-    <style>
-        table { width: 100%; border-collapse: collapse; font-family: sans-serif; background-color: #1E1E1E; color: #E0E0E0; margin-bottom: 20px;}
-        th, td { border: 1px solid #444; padding: 4px; text-align: center; vertical-align: top; font-size: 0.85em; }
-        th { background-color: #333; color: #FFF; position: sticky; top: 0; z-index: 10; }
-        .room-col { background-color: #2D2D2D; color: #FFD700; font-weight: bold; width: 100px; vertical-align: middle; border-bottom: 2px solid #666; }
-        .day-col { background-color: #262626; color: #FFF; width: 60px; font-weight: bold; }
-        .row-separator { border-bottom: 2px solid #666; }
-        .subject { color: #4FC3F7; font-weight: bold; font-size: 0.95em; }
-        .teacher { font-size: 0.85em; color: #B0BEC5; }
-        .prog { font-size: 0.7em; background-color: #FFC107; color: #000; padding: 0 3px; border-radius: 3px; }
-        .empty { color: #333; }
-        .break-col { background-color: #333; color: #AAA; font-size: 0.75em; width: 40px; vertical-align: middle; font-weight: bold;}
-    </style>
-    <table><thead><tr><th class="room-col">ห้องเรียน</th><th class="day-col">วัน</th>"""
-    for p in range(1, 10):
-        html += f"<th>{p}<br><span style='font-size:0.7em; color:#AAA'>{PERIODS[p]}</span></th>"
-        if p in BREAKS: html += "<th class='break-col'></th>"
-    html += "</tr></thead><tbody>"
-    for r in room_list:
-        program = get_room_program(r)
-        for i, d in enumerate(DAYS):
-            row_class = "row-separator" if d == "ศุกร์" else ""
-            html += f"<tr class='{row_class}'>"
-            if i == 0: html += f"<td class='room-col' rowspan='5'>{r}<br><span style='font-size:0.75em; color:#B0BEC5; font-weight:normal;'>{program}</span></td>"
-            html += f"<td class='day-col'>{d}</td>"
-            for p in range(1, 10):
-                if r in data_source:
-                    slots = data_source[r][d][p]
-                    if not slots: cell_html = "<span class='empty'>-</span>"
-                    else:
-                        items = []
-                        for s in slots:
-                            prog_item = s.get('program', '')
-                            prog_html = f"<span class='prog'>{prog_item}</span>" if prog_item != "รวมทุกสาย" else ""
-                            items.append(f"<div><span class='subject'>{s['subject']}</span> {prog_html}<br><span class='teacher'>{s['teacher']}</span></div>")
-                        cell_html = "<hr style='margin:2px; border-color:#444;'>".join(items)
-                else: cell_html = "-"
-                html += f"<td>{cell_html}</td>"
-                if p in BREAKS:
-                    if i == 0: html += f"<td class='break-col' rowspan='5'>{BREAKS[p]}</td>"
-            html += "</tr>"
-    html += "</tbody></table>"
-    return html
-
-def generate_teacher_report_html():
-    teachers = st.session_state.teachers_data["ชื่อ-สกุล"].dropna().unique().tolist()
+def generate_teacher_report_html(schedule_data, teachers_df, rooms):
+    teachers = teachers_df["ชื่อ-สกุล"].dropna().unique().tolist()
     html = """<html><head><title>รายงานครู</title><style>
             body { font-family: 'Sarabun', 'Angsana New', sans-serif; padding: 20px; }
             h1 { text-align: center; font-size: 28px; }
@@ -473,31 +649,32 @@ def generate_teacher_report_html():
             .page-break { page-break-after: always; }
         </style></head><body><h1>รายงานตารางสอนครูรายบุคคล</h1><hr>"""
     for i, t_name in enumerate(teachers):
-        teacher_info = st.session_state.teachers_data[st.session_state.teachers_data["ชื่อ-สกุล"] == t_name].iloc[0]
+        teacher_info = teachers_df[teachers_df["ชื่อ-สกุล"] == t_name].iloc[0]
         grade_info = teacher_info.get("ระดับชั้นที่สอน", "-")
         html += f"""<div class="section"><h3>{i+1}. {t_name} <span style="font-size:0.8em; font-weight:normal;">(วิชา: {teacher_info['วิชาที่สอน']} | สอน: {grade_info})</span></h3>
             <table><thead><tr><th class="day-col">วัน</th>"""
-        for p in range(1, 10):
-            html += f"<th>{p}<br><span style='font-size:0.7em;'>{PERIODS[p]}</span></th>"
-            if p in BREAKS: html += f"<th class='break-col'></th>"
+        for p, p_time, brk in BELL.columns:
+            html += f"<th>{p}<br><span style='font-size:0.7em;'>{p_time}</span></th>"
+            if brk: html += "<th class='break-col'></th>"
         html += "</tr></thead><tbody>"
         for idx, d in enumerate(DAYS):
             html += f"<tr><td class='day-col'>{d}</td>"
-            for p in range(1, 10):
+            for p, _, brk in BELL.columns:
                 cell_content = []
-                for r in get_all_rooms():
-                    if r in st.session_state.schedule_data:
-                        slots = st.session_state.schedule_data[r][d][p]
+                for r in rooms:
+                    if r in schedule_data:
+                        slots = schedule_data[r][d][p]
                         for s in slots:
                             # Handle multiple teachers
                             t_list = [x.strip() for x in s['teacher'].split(',')]
                             if t_name in t_list: 
                                 prog_label = f" <span style='font-size:0.8em; color:#555;'>[{s.get('program', 'รวม')}]</span>"
-                                cell_content.append(f"{s['subject']}{prog_label}<br>({r})")
+                                place = f"{r} @ {s['facility']}" if s.get('facility') else r
+                                cell_content.append(f"{s['subject']}{prog_label}<br>({place})")
                 if cell_content: html += f"<td>{'<hr style=`margin:2px`>'.join(cell_content)}</td>"
                 else: html += "<td>-</td>"
-                if p in BREAKS:
-                    if idx == 0: html += f"<td class='break-col' rowspan='5'>{BREAKS[p]}</td>"
+                if brk:
+                    if idx == 0: html += f"<td class='break-col' rowspan='{len(DAYS)}'>{brk}</td>"
             html += "</tr>"
         html += "</tbody></table></div><div class='page-break'></div>"
     html += "</body></html>"
@@ -518,6 +695,7 @@ def generate_grade_report_html(target_rooms_list, title_text):
             .subject {{ font-weight: bold; font-size: 1.1em; }}
             .teacher {{ font-size: 0.9em; }}
             .prog-badge {{ font-size: 0.8em; background-color: #ddd; padding: 2px 4px; border-radius: 4px; margin-left: 4px; }}
+            .facility {{ font-size: 0.8em; color: #555; }}
         </style></head><body><h1>ตารางเรียน {title_text}</h1><p style='text-align:center'>ข้อมูล ณ {datetime.now().strftime("%d/%m/%Y %H:%M")}</p><hr>"""
     
     for room in target_rooms_list:
@@ -528,27 +706,28 @@ def generate_grade_report_html(target_rooms_list, title_text):
         # 1. Master Table
         html += f"""<div class="section"><h3>ห้องเรียน: {room} (ตารางรวมทุกสาย)</h3>
             <table><thead><tr><th class="day-col">วัน</th>"""
-        for p in range(1, 10):
-            html += f"<th>{p}<br><span style='font-size:0.7em;'>{PERIODS[p]}</span></th>"
-            if p in BREAKS: html += f"<th class='break-col'></th>"
+        for p, p_time, brk in BELL.columns:
+            html += f"<th>{p}<br><span style='font-size:0.7em;'>{p_time}</span></th>"
+            if brk: html += "<th class='break-col'></th>"
         html += "</tr></thead><tbody>"
         for idx, d in enumerate(DAYS):
             html += f"<tr><td class='day-col'>{d}</td>"
-            for p in range(1, 10):
+            for p, _, brk in BELL.columns:
                 slots = st.session_state.schedule_data[room][d][p]
                 cell_items = []
                 if slots:
                     for s in slots:
                         prog_text = s.get('program', 'รวม')
                         prog_html = f"<span class='prog-badge'>{prog_text}</span>" if prog_text != "รวมทุกสาย" else ""
-                        cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>({s['teacher']})</div>")
+                        fac_html = f"<div class='facility'>📍 {s['facility']}</div>" if s.get('facility') else ""
+                        cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>({s['teacher']})</div>{fac_html}")
                 
                 if not cell_items: cell = "-"
                 else: cell = "<hr style='margin:2px'>".join(cell_items)
                 
                 html += f"<td>{cell}</td>"
-                if p in BREAKS:
-                    if idx == 0: html += f"<td class='break-col' rowspan='5'>{BREAKS[p]}</td>"
+                if brk:
+                    if idx == 0: html += f"<td class='break-col' rowspan='{len(DAYS)}'>{brk}</td>"
             html += "</tr>"
         html += "</tbody></table></div>"
 
@@ -558,13 +737,13 @@ def generate_grade_report_html(target_rooms_list, title_text):
             for prog in programs_list:
                 html += f"""<div class="section"><h4>- ห้อง {room} (สาย {prog})</h4>
                     <table><thead><tr><th class="day-col">วัน</th>"""
-                for p in range(1, 10):
-                    html += f"<th>{p}<br><span style='font-size:0.7em;'>{PERIODS[p]}</span></th>"
-                    if p in BREAKS: html += f"<th class='break-col'></th>"
+                for p, p_time, brk in BELL.columns:
+                    html += f"<th>{p}<br><span style='font-size:0.7em;'>{p_time}</span></th>"
+                    if brk: html += "<th class='break-col'></th>"
                 html += "</tr></thead><tbody>"
                 for idx, d in enumerate(DAYS):
                     html += f"<tr><td class='day-col'>{d}</td>"
-                    for p in range(1, 10):
+                    for p, _, brk in BELL.columns:
                         slots = st.session_state.schedule_data[room][d][p]
                         cell_items = []
                         if slots:
@@ -572,14 +751,15 @@ def generate_grade_report_html(target_rooms_list, title_text):
                                 if s.get('program', 'รวมทุกสาย') == prog or s.get('program', 'รวมทุกสาย') == 'รวมทุกสาย':
                                     prog_text = s.get('program', 'รวม')
                                     prog_html = f"<span class='prog-badge'>{prog_text}</span>" if prog_text != "รวมทุกสาย" else ""
-                                    cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>({s['teacher']})</div>")
+                                    fac_html = f"<div class='facility'>📍 {s['facility']}</div>" if s.get('facility') else ""
+                                    cell_items.append(f"<div class='subject'>{s['subject']} {prog_html}</div><div class='teacher'>({s['teacher']})</div>{fac_html}")
                         
                         if not cell_items: cell = "-"
                         else: cell = "<hr style='margin:2px'>".join(cell_items)
                         
                         html += f"<td>{cell}</td>"
-                        if p in BREAKS:
-                            if idx == 0: html += f"<td class='break-col' rowspan='5'>{BREAKS[p]}</td>"
+                        if brk:
+                            if idx == 0: html += f"<td class='break-col' rowspan='{len(DAYS)}'>{brk}</td>"
                     html += "</tr>"
                 html += "</tbody></table></div>"
         
@@ -588,6 +768,89 @@ def generate_grade_report_html(target_rooms_list, title_text):
     html += "</body></html>"
     return html
 
+# --- 5.1 Cache + Fragment ---
+# ผลลัพธ์ที่สร้างช้า (HTML/สถิติ) cache ตาม st.session_state.data_key (ดู refresh_data_key): ข้อมูลเหมือนเดิม = ใช้ของเดิม
+# ข้อมูลส่งเข้าเป็นอาร์กิวเมนต์ที่ขึ้นต้นด้วย _ (Streamlit ไม่ hash ให้ เพราะ data_key แทนเนื้อหาอยู่แล้ว) ไม่อ่าน session_state ใน cache
+# แต่ละ cache จำกัด max_entries และทิ้งรายการที่ไม่ได้ใช้นานที่สุดก่อน
+@st.cache_data(max_entries=64, show_spinner=False)
+def cached_room_table_html(data_key, grade, _schedule, filter_program=None):
+    return render_beautiful_table(grade, _schedule, filter_program=filter_program)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_master_grid_payload(data_key, room_list, _schedule, _classrooms):
+    room_programs = {}
+    for room, prog in zip(_classrooms["ห้องเรียน"], _classrooms["สายการเรียน"]):
+        room_programs.setdefault(room, prog)
+    room_programs = {r: room_programs.get(r, "-") for r in room_list}
+    return encode_master_grid(list(room_list), _schedule, room_programs, DAYS, BELL.times, BELL.breaks)
+
+@st.cache_data(max_entries=4, show_spinner="กำลังสร้างรายงานครู...")
+def cached_teacher_report_html(data_key, _schedule, _teachers, _rooms):
+    return generate_teacher_report_html(_schedule, _teachers, _rooms)
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def cached_teacher_preview_html(data_key, sel_t, _schedule, _rooms):
+    temp_data = { "Report": BELL.empty_week() }
+    for d in DAYS:
+        for p in BELL.day_periods[d]:
+            for g in _rooms:
+                if g in _schedule:
+                    slots = _schedule[g][d][p]
+                    for s in slots:
+                        # Handle multiselect
+                        t_list_in_slot = [x.strip() for x in s['teacher'].split(',')]
+                        if sel_t in t_list_in_slot: 
+                            temp_data["Report"][d][p].append({"subject": s['subject'], "teacher": f"({g})", "facility": s.get('facility', "")})
+    return render_beautiful_table("Report", temp_data)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cached_dashboard_stats(data_key, selected_filter, _schedule, _teachers):
+    teacher_stats = {}
+    all_teachers = _teachers["ชื่อ-สกุล"].tolist()
+    for t in all_teachers:
+        teacher_stats[t] = { "count": 0, "rooms": set(), "programs": set() }
+    
+    total_slots = 0
+    schedule_data = _schedule
+    
+    for room in schedule_data:
+        if selected_filter != "ภาพรวมทั้งโรงเรียน":
+            if not room.startswith(selected_filter):
+                continue
+        for day in DAYS:
+            for period in BELL.day_periods[day]:
+                slots = schedule_data[room][day][period]
+                for s in slots:
+                    # [UPDATED] Split multiple teachers for counting
+                    t_names = [x.strip() for x in s['teacher'].split(',')]
+                    prog = s.get('program', 'รวม')
+                    
+                    for t_name in t_names:
+                        if t_name in teacher_stats:
+                            teacher_stats[t_name]["count"] += 1
+                            teacher_stats[t_name]["rooms"].add(room)
+                            teacher_stats[t_name]["programs"].add(prog)
+                        else:
+                            # In case new teacher not in DB list
+                            teacher_stats[t_name] = { "count": 1, "rooms": {room}, "programs": {prog} }
+                        total_slots += 1
+    
+    filtered_rooms = [r for r in schedule_data if selected_filter == "ภาพรวมทั้งโรงเรียน" or r.startswith(selected_filter)]
+    symbols = init_symbols()
+    rule_violations = RULESET.check_all(teacher_day_masks(schedule_data, RULESET, DAYS, filtered_rooms, symbols), DAYS, symbols)
+    return teacher_stats, total_slots, rule_violations
+
+# วิเคราะห์ข้ามภาคเรียน: อ่านเฉพาะคอลัมน์/ภาคเรียนที่ใช้จากคลัง Parquet แล้วรวมยอดแบบ vectorized (pyarrow)
+# cache ตามเวอร์ชันของคลัง (เปลี่ยนเมื่อเก็บ/แทนที่ภาคเรียน) และชุดภาคเรียนที่เลือก
+@st.cache_data(max_entries=16, show_spinner="กำลังวิเคราะห์ข้อมูลข้ามภาคเรียน...")
+def cached_term_analytics(tenant_id, archive_key, terms):
+    archive = init_tenant(tenant_id).archive
+    t0 = time.perf_counter()
+    loads = archive.teacher_load(list(terms)).to_pandas()
+    rooms = archive.room_usage(list(terms)).to_pandas()
+    programs = archive.program_coverage(list(terms)).to_pandas()
+    return loads, rooms, programs, (time.perf_counter() - t0) * 1000
+
 # --- 6. เมนูหลัก ---
 menu = st.sidebar.radio("เมนูหลัก", [
     "1. 🗓️ ตารางเรียนรวม (Master View)",
@@ -595,23 +858,78 @@ menu = st.sidebar.radio("เมนูหลัก", [
     "3. 👥 ข้อมูลของครู", 
     "4. 🏫 ข้อมูลห้องเรียน", 
     "5. 🖨️ ระบบรายงาน",
-    "6. 📊 Dashboard สรุปยอด"
+    "6. 📊 Dashboard สรุปยอด",
+    "7. 🕘 Snapshot / เปรียบเทียบเวอร์ชัน",
+    "8. 📚 คลังภาคเรียน / วิเคราะห์ข้ามภาคเรียน"
 ])
 
+with st.sidebar.expander("🔌 สถานะการเชื่อมต่อ Google Sheets", expanded=False):
+    gw_stats = init_connection().metrics()
+    st.caption(f"โรงเรียน: {current_tenant().name} | ไฟล์: {current_tenant().sheet}")
+    st.caption(f"คิวรอเขียน: {gw_stats['queue_depth']} | ใช้โควต้า: {gw_stats['requests_last_minute']}/นาที (เหลือ {gw_stats['budget_remaining']})")
+    st.caption(f"คำขอทั้งหมด: {gw_stats['requests']} | retry: {gw_stats['retries']} | ล้มเหลว: {gw_stats['failures']} | รวมการเขียน: {gw_stats['merged_writes']}")
+    st.caption(f"Journal ค้าง: {init_journal().length} แถว | compact แล้ว: {init_journal().compactions} ครั้ง")
+
+    # หน้าที่เปิดค้างไว้เห็นการแก้ไขของผู้อื่นเองโดยไม่ต้องกดอะไร: fragment นี้ตรวจเป็นระยะ แล้ว rerun ทั้งหน้าเมื่อสำเนาในเครื่องเปลี่ยน
+    @st.fragment(run_every=POLL_SECONDS if POLL_SECONDS > 0 else None)
+    def live_updates():
+        if POLL_SECONDS > 0:
+            init_sync().poll_in_background(POLL_SECONDS)
+        if st.session_state.get('dataset_saved_at', 0) < init_local_store().saved_at():
+            st.rerun()
+        last_poll = init_sync().last_poll
+        if last_poll:
+            st.caption(f"อัปเดตจากผู้อื่นล่าสุด: {datetime.fromtimestamp(last_poll[0]).strftime('%H:%M:%S')} ({', '.join(last_poll[1])})")
+    live_updates()
+
+sync_state = init_sync()
+pending_count = init_local_store().pending_count()
+if not sync_state.online or pending_count:
+    st.sidebar.warning(f"📴 ออฟไลน์ — มี {pending_count} รายการรอซิงก์ขึ้น Google Sheets")
+if sync_state.conflicts:
+    st.sidebar.caption(f"⚠️ ซิงก์ทับการแก้ไขของผู้อื่น {len(sync_state.conflicts)} คาบ (ล่าสุด: {sync_state.conflicts[-1]['slot']})")
+
 if menu == "1. 🗓️ ตารางเรียนรวม (Master View)":
     st.header("🗓️ ตารางเรียนรวม (Master Schedule View)")
     st.info("💡 เลือก 'ระดับชั้น' ด้านล่าง ระบบจะแสดงตารางรวมของห้องเรียนทุกห้องในระดับชั้นนั้น พร้อมกัน 5 วันครับ")
+    
+    @st.fragment
+    def slot_search():
+        query = st.text_input(
+            "🔎 ค้นหาคาบเรียน", key="slot_search_query",
+            placeholder="เช่น: วิทยาศาสตร์ ป.5 | สาย:SMEP วัน:พุธ | ครู:ชื่อครู คาบ:3",
+            help="พิมพ์หลายคำเพื่อกรองร่วมกัน (ต้องตรงทุกคำ) ระบุช่องได้ด้วย ครู: วิชา: สาย: ห้อง: ชั้น: วัน: คาบ: ตัวเลขเดี่ยว = คาบ"
+        )
+        if query.strip():
+            t0 = time.perf_counter()
+            hits = st.session_state.search_index.search(query)
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+            st.caption(f"พบ {len(hits)} คาบ ({elapsed_ms:.2f} ms)")
+            if hits:
+                hits.sort(key=lambda h: (natural_sort_key(h[0]), DAYS.index(h[1]) if h[1] in DAYS else len(DAYS), h[2]))
+                st.dataframe(pd.DataFrame([
+                    {"ห้อง": r, "วัน": d, "คาบ": p, "เวลา": BELL.time_of(d, p), "วิชา": subj, "ครู": teacher, "สาย": prog}
+                    for r, d, p, prog, teacher, subj in hits
+                ]), hide_index=True, use_container_width=True)
+
+    slot_search()
+    
     all_rooms = get_all_rooms()
     unique_levels = sorted(list(set([r.split('/')[0] for r in all_rooms if '/' in r])))
     if not unique_levels:
         st.warning("ยังไม่มีข้อมูลห้องเรียนในระบบ")
     else:
-        sel_master_level = st.selectbox("เลือกระดับชั้นที่ต้องการดู:", unique_levels)
-        target_rooms = [r for r in all_rooms if r.startswith(sel_master_level)]
-        target_rooms.sort(key=natural_sort_key) 
-        st.markdown("---")
-        master_html = render_master_matrix_html(target_rooms, st.session_state.schedule_data)
-        st.markdown(master_html, unsafe_allow_html=True)
+        @st.fragment
+        def master_view():
+            sel_master_level = st.selectbox("เลือกระดับชั้นที่ต้องการดู:", unique_levels)
+            target_rooms = [r for r in all_rooms if r.startswith(sel_master_level)]
+            target_rooms.sort(key=natural_sort_key) 
+            st.markdown("---")
+            data_key = st.session_state.data_key
+            grid = cached_master_grid_payload(data_key, tuple(target_rooms), st.session_state.schedule_data, st.session_state.classrooms_data)
+            master_grid(grid=grid, key="master_grid", data_key=f"{data_key}:{sel_master_level}")
+
+        master_view()
 
 # === MENU 2: 📅 จัดตารางสอน (Multiselect) ===
 elif menu == "2. 📅 จัดตารางสอน":
@@ -627,179 +945,248 @@ elif menu == "2. 📅 จัดตารางสอน":
         st.caption(f"🎓 สายการเรียน: **{program_str}**")
         st.markdown("---")
 
-        # --- 1. บันทึกตารางสอน ---
-        st.subheader("📝 บันทึกตารางสอน")
+        # --- 1. บันทึกตารางสอน (fragment: เปลี่ยนวัน/สาย/ครูแนะนำ rerun เฉพาะส่วนนี้) ---
+        @st.fragment
+        def daily_editor():
+            st.subheader("📝 บันทึกตารางสอน")
         
-        c_day, c_prog = st.columns(2)
-        with c_day:
-            edit_day = st.selectbox("1. เลือกวันที่จะแก้ไข:", DAYS)
-        with c_prog:
-            target_prog_for_edit = "รวมทุกสาย"
-            if len(programs_list) > 1:
-                target_prog_for_edit = st.selectbox("2. เลือกสายการเรียน:", ["รวมทุกสาย"] + programs_list)
-            else:
-                st.selectbox("2. สายการเรียน:", ["รวมทุกสาย"], disabled=True)
+            c_day, c_prog = st.columns(2)
+            with c_day:
+                edit_day = st.selectbox("1. เลือกวันที่จะแก้ไข:", DAYS)
+            with c_prog:
+                target_prog_for_edit = "รวมทุกสาย"
+                if len(programs_list) > 1:
+                    target_prog_for_edit = st.selectbox("2. เลือกสายการเรียน:", ["รวมทุกสาย"] + programs_list)
+                else:
+                    st.selectbox("2. สายการเรียน:", ["รวมทุกสาย"], disabled=True)
 
-        with st.form(key="daily_editor_form"):
-            st.info(f"💡 ระบบ Team Teaching: สามารถเลือกครูได้หลายคนใน 1 คาบ")
-            st.markdown(f"#### 📅 วัน{edit_day} ({target_prog_for_edit})")
+            with st.expander("🔎 แนะนำคาบที่เหมาะสม (Best slot)", expanded=False):
+                sug_teachers = [t for t in st.session_state.teachers_data["ชื่อ-สกุล"].unique().tolist() if is_teacher_assigned_to_room(t, selected_grade)]
+                if not sug_teachers:
+                    st.caption("ยังไม่มีครูที่กำหนดให้สอนห้องนี้")
+                else:
+                    c_sug_t, c_sug_n = st.columns([0.7, 0.3])
+                    with c_sug_t:
+                        sug_teacher = st.selectbox("ครูผู้สอน", sug_teachers, key="sug_teacher")
+                    with c_sug_n:
+                        sug_needed = st.number_input("จำนวนคาบที่ต้องการ", min_value=1, max_value=10, value=1, key="sug_needed")
+                    # ประเมินทุก (วัน, คาบ) พร้อมกันจาก mask ที่คำนวณครั้งเดียว
+                    sug_symbols = init_symbols()
+                    sug_masks = teacher_day_masks(st.session_state.schedule_data, RULESET, DAYS, current_rooms_list, sug_symbols).get(sug_symbols.get(sug_teacher), {})
+                    sug_options, sug_plan = suggest_slots(
+                        RULESET, sug_teacher, sug_masks, get_room_free_masks(selected_grade, target_prog_for_edit), DAYS, needed=int(sug_needed)
+                    )
+                    if not sug_options:
+                        st.warning("ไม่พบคาบที่ว่างทั้งห้องและครูโดยไม่ผิดกฎภาระงาน")
+                    else:
+                        plan_text = ", ".join(f"วัน{d} คาบ {p}" for _, d, p, _ in sug_plan)
+                        st.markdown(f"**แผนที่แนะนำ ({len(sug_plan)}/{int(sug_needed)} คาบ):** {plan_text}")
+                        st.dataframe(pd.DataFrame([
+                            {"วัน": d, "คาบ": p, "เวลา": BELL.time_of(d, p), "ภาระวันนั้น (คาบ)": load, "คะแนน": score}
+                            for score, d, p, load in sug_options
+                        ]), hide_index=True, use_container_width=True)
+
+            with st.form(key="daily_editor_form"):
+                st.info(f"💡 ระบบ Team Teaching: สามารถเลือกครูได้หลายคนใน 1 คาบ")
+                st.markdown(f"#### 📅 วัน{edit_day} ({target_prog_for_edit})")
+                if edit_day in BELL.special_days:
+                    st.caption("⏰ วันนี้ใช้ตารางเวลาเฉพาะ: " + ", ".join(f"คาบ {p} ({t})" for p, t in BELL.day_times[edit_day].items()))
             
-            new_schedule_data = {} 
-            cols = st.columns(3)
+                new_schedule_data = {} 
+                new_facility_data = {}
+                # สถานที่ร่วม: ห้องอื่นในวันนี้ (ครู->คาบ->ห้อง, สถานที่->คาบ->ห้อง) สแกนครั้งเดียว
+                # ใช้ทั้งแสดงสถานะในตัวเลือกสถานที่ และส่งต่อให้ validate_schedule_rules ตอนบันทึก
+                facility_caps = get_facility_capacities()
+                fac_symbols = init_symbols()
+                day_facilities = {}
+                day_slice = None
+                if facility_caps:
+                    day_slice = (day_occupancy(st.session_state.schedule_data, current_rooms_list, edit_day, skip_room=selected_grade,
+                                               facilities=day_facilities, symbols=fac_symbols), day_facilities)
+                cols = st.columns(3)
             
-            for p in range(1, 10):
-                col_idx = (p - 1) % 3
-                with cols[col_idx]:
-                    current_slots_all = st.session_state.schedule_data[selected_grade][edit_day][p]
+                for i, p in enumerate(BELL.day_periods[edit_day]):
+                    col_idx = i % 3
+                    with cols[col_idx]:
+                        current_slots_all = st.session_state.schedule_data[selected_grade][edit_day][p]
                     
-                    # 1. LOCK LOGIC
-                    is_locked = False
-                    lock_reason = ""
-                    has_combined = any(s.get('program', 'รวมทุกสาย') == 'รวมทุกสาย' for s in current_slots_all)
-                    has_separate = any(s.get('program', 'รวมทุกสาย') != 'รวมทุกสาย' for s in current_slots_all)
-                    separate_progs_list = list(set([s['program'] for s in current_slots_all if s.get('program', 'รวมทุกสาย') != 'รวมทุกสาย']))
-
-                    if target_prog_for_edit == "รวมทุกสาย":
-                        if has_separate:
-                            is_locked = True
-                            lock_reason = f"🔒 มีเรียนแยกสายแล้ว ({', '.join(separate_progs_list)})"
-                    else:
-                        if has_combined:
-                            teacher_comb = next((s['teacher'] for s in current_slots_all if s.get('program') == 'รวมทุกสาย'), "?")
-                            is_locked = True
-                            lock_reason = f"🔒 เรียนรวมกับ {teacher_comb}"
-
-                    if is_locked:
-                        st.markdown(f"**คาบ {p}**: <span style='color:orange; font-weight:bold'>{lock_reason}</span>", unsafe_allow_html=True)
-                        st.multiselect("ล็อค", ["-- ใช้ตารางเดิม --"], disabled=True, key=f"sel_{p}_locked", label_visibility="collapsed")
-                        new_schedule_data[p] = ["-- ล็อค --"]
-                    else:
-                        # 2. NORMAL EDIT with Multiselect
-                        current_teachers = []
-                        for s in current_slots_all:
-                            if s.get('program', 'รวมทุกสาย') == target_prog_for_edit:
-                                # Split existing teachers if any
-                                raw_teachers = s['teacher'].split(',')
-                                current_teachers = [t.strip() for t in raw_teachers]
-                                break
-                        
-                        if current_teachers:
-                            st.markdown(f"**คาบ {p}**: <span style='color:red; font-weight:bold'>❌ มีคนสอน: {', '.join(current_teachers)}</span>", unsafe_allow_html=True)
+                        # 1. LOCK LOGIC
+                        is_locked = False
+                        lock_reason = ""
+                        has_combined = any(s.get('program', 'รวมทุกสาย') == 'รวมทุกสาย' for s in current_slots_all)
+                        has_separate = any(s.get('program', 'รวมทุกสาย') != 'รวมทุกสาย' for s in current_slots_all)
+                        separate_progs_list = list(set([s['program'] for s in current_slots_all if s.get('program', 'รวมทุกสาย') != 'รวมทุกสาย']))
+
+                        if target_prog_for_edit == "รวมทุกสาย":
+                            if has_separate:
+                                is_locked = True
+                                lock_reason = f"🔒 มีเรียนแยกสายแล้ว ({', '.join(separate_progs_list)})"
+                        else:
+                            if has_combined:
+                                teacher_comb = next((s['teacher'] for s in current_slots_all if s.get('program') == 'รวมทุกสาย'), "?")
+                                is_locked = True
+                                lock_reason = f"🔒 เรียนรวมกับ {teacher_comb}"
+
+                        if is_locked:
+                            st.markdown(f"**คาบ {p}**: <span style='color:orange; font-weight:bold'>{lock_reason}</span>", unsafe_allow_html=True)
+                            st.multiselect("ล็อค", ["-- ใช้ตารางเดิม --"], disabled=True, key=f"sel_{p}_locked", label_visibility="collapsed")
+                            new_schedule_data[p] = ["-- ล็อค --"]
                         else:
-                            st.markdown(f"**คาบ {p}**: <span style='color:green; font-weight:bold'>✅ ว่าง</span>", unsafe_allow_html=True)
+                            # 2. NORMAL EDIT with Multiselect
+                            current_teachers = []
+                            current_facility = ""
+                            for s in current_slots_all:
+                                if s.get('program', 'รวมทุกสาย') == target_prog_for_edit:
+                                    # Split existing teachers if any
+                                    raw_teachers = s['teacher'].split(',')
+                                    current_teachers = [t.strip() for t in raw_teachers]
+                                    current_facility = s.get('facility', "")
+                                    break
+                        
+                            if current_teachers:
+                                st.markdown(f"**คาบ {p}**: <span style='color:red; font-weight:bold'>❌ มีคนสอน: {', '.join(current_teachers)}</span>", unsafe_allow_html=True)
+                            else:
+                                st.markdown(f"**คาบ {p}**: <span style='color:green; font-weight:bold'>✅ ว่าง</span>", unsafe_allow_html=True)
 
-                        options = get_teachers_with_status_options(selected_grade, edit_day, p)
+                            options = get_teachers_with_status_options(selected_grade, edit_day, p)
                         
-                        # Match defaults (handle status text)
-                        defaults = []
-                        if current_teachers:
-                            for ct in current_teachers:
-                                for opt in options:
-                                    if clean_teacher_name(opt) == ct:
-                                        defaults.append(opt)
-                                        break
+                            # Match defaults (handle status text)
+                            defaults = []
+                            if current_teachers:
+                                for ct in current_teachers:
+                                    for opt in options:
+                                        if clean_teacher_name(opt) == ct:
+                                            defaults.append(opt)
+                                            break
                         
-                        selected = st.multiselect(
-                            f"เลือกครู (คาบ {p})",
-                            options=options,
-                            default=defaults,
-                            key=f"sel_{p}",
-                            label_visibility="collapsed"
-                        )
-                        new_schedule_data[p] = selected
+                            selected = st.multiselect(
+                                f"เลือกครู (คาบ {p})",
+                                options=options,
+                                default=defaults,
+                                key=f"sel_{p}",
+                                label_visibility="collapsed"
+                            )
+                            new_schedule_data[p] = selected
 
-            st.markdown("---")
-            submit_btn = st.form_submit_button("💾 บันทึกตารางวันนี้", type="primary", use_container_width=True)
+                            if facility_caps or current_facility:
+                                fac_options = [""] + list(dict.fromkeys([*facility_caps, *([current_facility] if current_facility else [])]))
+                                def facility_label(f, p=p):
+                                    if not f:
+                                        return "🏫 ห้องเรียนประจำ"
+                                    users = day_facilities.get(fac_symbols.get(f), {}).get(p, [])
+                                    if not users:
+                                        return f"📍 {f}"
+                                    return f"📍 {f} (ใช้อยู่ {len(users)}/{capacity_of(facility_caps, f)}: {', '.join(users)})"
+                                new_facility_data[p] = st.selectbox(
+                                    f"สถานที่ (คาบ {p})",
+                                    options=fac_options,
+                                    index=fac_options.index(current_facility),
+                                    format_func=facility_label,
+                                    key=f"fac_{p}",
+                                    label_visibility="collapsed"
+                                )
+
+                st.markdown("---")
+                submit_btn = st.form_submit_button("💾 บันทึกตารางวันนี้", type="primary", use_container_width=True)
             
-            if submit_btn:
-                slot_limit_exceeded = []
-                for p, t_list in new_schedule_data.items():
-                    if t_list == ["-- ล็อค --"]: continue
-                    current_slots_in_db = st.session_state.schedule_data[selected_grade][edit_day][p]
-                    kept_slots = [s for s in current_slots_in_db if s.get('program', 'รวมทุกสาย') != target_prog_for_edit]
-                    new_count = len(kept_slots)
-                    if t_list: new_count += 1
-                    if new_count > 2: slot_limit_exceeded.append(f"คาบ {p}")
-
-                if slot_limit_exceeded:
-                    st.error(f"⛔ **บันทึกไม่ได้!** พบคาบเรียนที่มีวิชาเกิน 2 วิชา (สูงสุด 2 วิชา/ห้อง): **{', '.join(slot_limit_exceeded)}**")
-                else:
-                    updates_map = {}
+                if submit_btn:
+                    slot_limit_exceeded = []
                     for p, t_list in new_schedule_data.items():
-                        if t_list != [] and t_list != ["-- ล็อค --"]:
-                            updates_map[p] = t_list
+                        if t_list == ["-- ล็อค --"]: continue
+                        current_slots_in_db = st.session_state.schedule_data[selected_grade][edit_day][p]
+                        kept_slots = [s for s in current_slots_in_db if s.get('program', 'รวมทุกสาย') != target_prog_for_edit]
+                        new_count = len(kept_slots)
+                        if t_list: new_count += 1
+                        if new_count > 2: slot_limit_exceeded.append(f"คาบ {p}")
+
+                    if slot_limit_exceeded:
+                        st.error(f"⛔ **บันทึกไม่ได้!** พบคาบเรียนที่มีวิชาเกิน 2 วิชา (สูงสุด 2 วิชา/ห้อง): **{', '.join(slot_limit_exceeded)}**")
+                    else:
+                        updates_map = {}
+                        for p, t_list in new_schedule_data.items():
+                            if t_list != [] and t_list != ["-- ล็อค --"]:
+                                updates_map[p] = t_list
                     
-                    conflicts = validate_schedule_rules(updates_map, selected_grade, edit_day, target_prog_for_edit)
+                        conflicts = validate_schedule_rules(updates_map, selected_grade, edit_day, target_prog_for_edit, new_facility_data, day_slice)
                     
-                    if conflicts:
-                        st.session_state.marathon_confirm_data = {
-                            'grade': selected_grade,
-                            'day': edit_day,
-                            'new_data': new_schedule_data,
-                            'target_prog': target_prog_for_edit,
-                            'conflicts': conflicts
-                        }
-                        st.rerun()
-                    else:
-                        apply_schedule_updates(selected_grade, edit_day, new_schedule_data, target_prog_for_edit, auto_remove_conflict=True)
-                        st.success(f"✅ บันทึกตารางวัน{edit_day} เรียบร้อยแล้ว")
-                        time.sleep(1)
-                        st.rerun()
+                        if conflicts:
+                            st.session_state.marathon_confirm_data = {
+                                'grade': selected_grade,
+                                'day': edit_day,
+                                'new_data': new_schedule_data,
+                                'facilities': new_facility_data,
+                                'target_prog': target_prog_for_edit,
+                                'conflicts': conflicts
+                            }
+                            st.rerun()
+                        else:
+                            apply_schedule_updates(selected_grade, edit_day, new_schedule_data, target_prog_for_edit, auto_remove_conflict=True, facilities=new_facility_data)
+                            st.success(f"✅ บันทึกตารางวัน{edit_day} เรียบร้อยแล้ว")
+                            time.sleep(1)
+                            st.rerun()
 
-        # ส่วนยืนยันมาราธอน / สอนซ้อน
-        if st.session_state.marathon_confirm_data:
-            data = st.session_state.marathon_confirm_data
-            st.warning("⚠️ **แจ้งเตือน: พบข้อขัดแย้งของตารางสอน**")
-            for c in data['conflicts']:
-                st.error(c)
+            # ส่วนยืนยันมาราธอน / สอนซ้อน
+            if st.session_state.marathon_confirm_data:
+                data = st.session_state.marathon_confirm_data
+                st.warning("⚠️ **แจ้งเตือน: พบข้อขัดแย้งของตารางสอน**")
+                for c in data['conflicts']:
+                    st.error(c)
             
-            st.info("ต้องการดำเนินการต่อหรือไม่?")
-            auto_remove = st.checkbox("☑️ ลบรายชื่อออกจากห้องเดิมทันที (ย้ายห้องสอน)", value=True)
+                st.info("ต้องการดำเนินการต่อหรือไม่?")
+                auto_remove = st.checkbox("☑️ ลบรายชื่อออกจากห้องเดิมทันที (ย้ายห้องสอน)", value=True)
             
-            col_conf1, col_conf2 = st.columns([0.2, 0.8])
-            if col_conf1.button("✅ ยืนยันการบันทึก", type="primary"):
-                apply_schedule_updates(
-                    data['grade'], 
-                    data['day'], 
-                    data['new_data'], 
-                    data['target_prog'], 
-                    auto_remove_conflict=auto_remove
-                )
-                st.session_state.marathon_confirm_data = None
-                st.success("บันทึกข้อมูลเรียบร้อย")
-                time.sleep(1)
-                st.rerun()
-            if col_conf2.button("❌ ยกเลิก"):
-                st.session_state.marathon_confirm_data = None
-                st.rerun()
+                col_conf1, col_conf2 = st.columns([0.2, 0.8])
+                if col_conf1.button("✅ ยืนยันการบันทึก", type="primary"):
+                    apply_schedule_updates(
+                        data['grade'], 
+                        data['day'], 
+                        data['new_data'], 
+                        data['target_prog'], 
+                        auto_remove_conflict=auto_remove,
+                        facilities=data.get('facilities')
+                    )
+                    st.session_state.marathon_confirm_data = None
+                    st.success("บันทึกข้อมูลเรียบร้อย")
+                    time.sleep(1)
+                    st.rerun()
+                if col_conf2.button("❌ ยกเลิก"):
+                    st.session_state.marathon_confirm_data = None
+                    st.rerun()
+
+        daily_editor()
 
         st.markdown("---")
 
         # --- 2. ส่วนตารางเรียน (View) ---
-        c_head, c_reset = st.columns([0.8, 0.2])
-        with c_head:
-            st.subheader(f"👀 ตารางเรียนปัจจุบัน: {selected_grade}")
-        with c_reset:
-            with st.expander("🗑️ ล้างข้อมูลทั้งหมด", expanded=False):
-                if st.button("ยืนยัน", type="primary", key="btn_reset_confirm"):
-                    for d in DAYS:
-                        for p in range(1, 10):
-                            st.session_state.schedule_data[selected_grade][d][p] = []
-                    save_data_to_gsheets()
-                    st.success("ล้างข้อมูลเรียบร้อย")
-                    time.sleep(1)
-                    st.rerun()
+        @st.fragment
+        def room_timetable_view():
+            c_head, c_reset = st.columns([0.8, 0.2])
+            with c_head:
+                st.subheader(f"👀 ตารางเรียนปัจจุบัน: {selected_grade}")
+            with c_reset:
+                with st.expander("🗑️ ล้างข้อมูลทั้งหมด", expanded=False):
+                    if st.button("ยืนยัน", type="primary", key="btn_reset_confirm"):
+                        before = capture_cells(st.session_state.schedule_data, [selected_grade], DAYS, BELL.periods)
+                        for d in DAYS:
+                            for p in BELL.periods:
+                                st.session_state.schedule_data[selected_grade][d][p] = []
+                        save_schedule_changes(before, [selected_grade], DAYS)
+                        st.success("ล้างข้อมูลเรียบร้อย")
+                        time.sleep(1)
+                        st.rerun()
 
-        html_table = render_beautiful_table(selected_grade, st.session_state.schedule_data)
-        st.markdown(html_table, unsafe_allow_html=True)
+            html_table = cached_room_table_html(st.session_state.data_key, selected_grade, st.session_state.schedule_data)
+            st.markdown(html_table, unsafe_allow_html=True)
         
-        if len(programs_list) > 1:
-            st.markdown("---")
-            st.write("### 📂 ตารางแยกตามสายการเรียน")
-            for prog in programs_list:
-                st.write("")
-                st.subheader(f"🔷 สาย: {prog}")
-                st.markdown(render_beautiful_table(selected_grade, st.session_state.schedule_data, filter_program=prog), unsafe_allow_html=True)
+            if len(programs_list) > 1:
+                st.markdown("---")
+                st.write("### 📂 ตารางแยกตามสายการเรียน")
+                for prog in programs_list:
+                    st.write("")
+                    st.subheader(f"🔷 สาย: {prog}")
+                    st.markdown(cached_room_table_html(st.session_state.data_key, selected_grade, st.session_state.schedule_data, prog), unsafe_allow_html=True)
+
+        room_timetable_view()
 
 elif menu == "3. 👥 ข้อมูลของครู":
     st.header("จัดการข้อมูลครูผู้สอน")
@@ -960,31 +1347,70 @@ elif menu == "4. 🏫 ข้อมูลห้องเรียน":
     st.subheader("📋 รายชื่อห้องเรียนในระบบ")
     st.dataframe(st.session_state.classrooms_data, use_container_width=True)
 
+    # --- สถานที่ใช้ร่วม: ห้องเรียนในรายการด้านบนเป็นห้องประจำ ส่วนแล็บ/โรงยิม/ห้องคอมฯ ใช้ร่วมกันทุกห้อง ---
+    st.markdown("---")
+    st.subheader("🔬 สถานที่ใช้ร่วม (ห้องแล็บ / โรงยิม / ห้องคอมพิวเตอร์)")
+    st.caption("ความจุ = จำนวนห้องเรียนที่ใช้สถานที่นี้พร้อมกันได้ในคาบเดียว | เลือกสถานที่ของแต่ละคาบได้ในเมนู 'จัดตารางสอน'")
+    with st.form("facility_form"):
+        edited_fac = st.data_editor(
+            st.session_state.facilities_data.reindex(columns=FACILITY_HEADERS), num_rows="dynamic",
+            hide_index=True, use_container_width=True, key="facility_editor",
+            column_config={
+                FACILITY_HEADERS[0]: st.column_config.TextColumn(FACILITY_HEADERS[0], required=True),
+                FACILITY_HEADERS[1]: st.column_config.NumberColumn(FACILITY_HEADERS[1], min_value=1, step=1, default=1),
+            }
+        )
+        if st.form_submit_button("💾 บันทึกสถานที่"):
+            caps = capacities_from_records(edited_fac.to_dict("records"))
+            st.session_state.facilities_data = pd.DataFrame([{FACILITY_HEADERS[0]: f, FACILITY_HEADERS[1]: c} for f, c in caps.items()], columns=FACILITY_HEADERS)
+            save_facilities_to_gsheets()
+            st.success(f"✅ บันทึกสถานที่ {len(caps)} แห่งเรียบร้อย")
+            st.rerun()
+
+    # ดัชนี (สถานที่, วัน, คาบ) ทั้งสัปดาห์: การใช้งานต่อสถานที่ และคาบที่จองเกินความจุ
+    fac_caps = get_facility_capacities()
+    fac_index = occupancy(st.session_state.schedule_data, DAYS, existing_rooms)
+    if fac_caps or fac_index:
+        used = {}
+        for (f, _, _), users in fac_index.items():
+            used[f] = used.get(f, 0) + len(users)
+        slots_per_week = sum(len(BELL.day_periods[d]) for d in DAYS)
+        st.dataframe(pd.DataFrame([
+            {"สถานที่": f, "ความจุ": capacity_of(fac_caps, f), "ใช้ (ห้อง-คาบ/สัปดาห์)": used.get(f, 0),
+             "อัตราการใช้": f"{used.get(f, 0) / (capacity_of(fac_caps, f) * slots_per_week):.0%}" if slots_per_week else "-",
+             "ไม่อยู่ในรายการ": "⚠️" if f not in fac_caps else ""}
+            for f in dict.fromkeys([*fac_caps, *used])
+        ]), hide_index=True, use_container_width=True)
+        clashes = over_capacity(fac_index, fac_caps)
+        if clashes:
+            st.error(f"⛔ พบการจองสถานที่เกินความจุ {len(clashes)} คาบ")
+            clashes.sort(key=lambda c: (c[0], DAYS.index(c[1]) if c[1] in DAYS else len(DAYS), c[2]))
+            st.dataframe(pd.DataFrame([
+                {"สถานที่": f, "วัน": d, "คาบ": p, "ความจุ": cap, "ห้องที่จอง": ", ".join(f"{r} ({prog})" if prog != 'รวมทุกสาย' else r for r, prog in users)}
+                for f, d, p, users, cap in clashes
+            ]), hide_index=True, use_container_width=True)
+        else:
+            st.success("✅ ไม่มีการจองสถานที่เกินความจุ")
+
 elif menu == "5. 🖨️ ระบบรายงาน":
     st.header("ระบบออกรายงาน (Print/PDF)")
-    tab_teacher, tab_grade = st.tabs(["📄 Report ครูรายคน", "🏫 Report ระดับชั้น"])
+    tab_teacher, tab_grade, tab_ics = st.tabs(["📄 Report ครูรายคน", "🏫 Report ระดับชั้น", "📱 ปฏิทินมือถือ (.ics)"])
     
     with tab_teacher:
         st.subheader("รายงานตารางสอนรายบุคคล (ครู)")
-        html_report_teacher = generate_teacher_report_html()
+        html_report_teacher = cached_teacher_report_html(st.session_state.data_key, st.session_state.schedule_data, st.session_state.teachers_data, get_all_rooms())
         st.download_button("📥 ดาวน์โหลด Report ครูทั้งหมด", data=html_report_teacher, file_name="teacher_schedule.html", mime="text/html", type="primary")
         st.markdown("---")
-        t_list = st.session_state.teachers_data["ชื่อ-สกุล"].unique().tolist()
-        if t_list:
-            sel_t = st.selectbox("เลือกครูเพื่อดูตัวอย่าง:", t_list, key="rep_t")
-            temp_data = { "Report": { d: { p: [] for p in range(1, 10) } for d in DAYS } }
-            for d in DAYS:
-                for p in range(1, 10):
-                    for g in get_all_rooms():
-                        if g in st.session_state.schedule_data:
-                            slots = st.session_state.schedule_data[g][d][p]
-                            for s in slots:
-                                # Handle multiselect
-                                t_list_in_slot = [x.strip() for x in s['teacher'].split(',')]
-                                if sel_t in t_list_in_slot: 
-                                    prog_label = f" <span style='font-size:0.8em; color:#555;'>[{s.get('program', 'รวม')}]</span>"
-                                    temp_data["Report"][d][p].append({"subject": s['subject'], "teacher": f"({g})"})
-            st.markdown(render_beautiful_table("Report", temp_data), unsafe_allow_html=True)
+        
+        # เปลี่ยนครูที่จะดูตัวอย่าง -> rerun เฉพาะ fragment นี้ ไม่สร้างรายงานทั้งหน้าใหม่
+        @st.fragment
+        def teacher_report_preview():
+            t_list = st.session_state.teachers_data["ชื่อ-สกุล"].unique().tolist()
+            if t_list:
+                sel_t = st.selectbox("เลือกครูเพื่อดูตัวอย่าง:", t_list, key="rep_t")
+                st.markdown(cached_teacher_preview_html(st.session_state.data_key, sel_t, st.session_state.schedule_data, get_all_rooms()), unsafe_allow_html=True)
+
+        teacher_report_preview()
 
     with tab_grade:
         st.subheader("รายงานตารางเรียนรายระดับชั้น")
@@ -1030,101 +1456,329 @@ elif menu == "5. 🖨️ ระบบรายงาน":
                 
                 st.markdown(f"### 🏠 ห้อง: {example_room}")
                 st.write("#### 🟢 ตารางเรียนรวม (Master)")
-                st.markdown(render_beautiful_table(example_room, st.session_state.schedule_data), unsafe_allow_html=True)
+                st.markdown(cached_room_table_html(st.session_state.data_key, example_room, st.session_state.schedule_data), unsafe_allow_html=True)
                 
                 if len(programs_list) > 1:
                     st.write("#### 🟡 ตารางแยกตามสายการเรียน")
                     for prog in programs_list:
                         st.write(f"**🔹 สาย: {prog}**")
-                        st.markdown(render_beautiful_table(example_room, st.session_state.schedule_data, filter_program=prog), unsafe_allow_html=True)
+                        st.markdown(cached_room_table_html(st.session_state.data_key, example_room, st.session_state.schedule_data, prog), unsafe_allow_html=True)
                 st.markdown("---")
 
+    with tab_ics:
+        st.subheader("ปฏิทิน iCalendar (.ics) รายครู / รายห้อง")
+        st.caption("นำเข้า Google Calendar / ปฏิทินบนมือถือได้ทันที เป็นกิจกรรมซ้ำทุกสัปดาห์ตลอดภาคเรียน")
+        term_default = default_term()
+        ic1, ic2 = st.columns(2)
+        term_start = ic1.date_input("วันเปิดภาคเรียน", value=term_default[0], key="ics_term_start")
+        term_end = ic2.date_input("วันปิดภาคเรียน", value=term_default[1], key="ics_term_end")
+        if term_end < term_start:
+            st.error("วันปิดภาคเรียนต้องไม่ก่อนวันเปิดภาคเรียน")
+        else:
+            # แยกตามช่วงภาคเรียน: session ที่เลือกวันต่างกันไม่ทำให้ไฟล์ของกันและกันต้องสร้างใหม่
+            ics, changed = init_ics_builder().build(schedule_state(st.session_state.schedule_data), BELL.day_times, term_start, term_end)
+            st.caption(f"สร้างไฟล์ใหม่ {len(changed)} ไฟล์ (จากทั้งหมด {len(ics.files)} ไฟล์) — รายที่ตารางไม่เปลี่ยนใช้ไฟล์เดิม")
+            
+            ic3, ic4 = st.columns(2)
+            with ic3:
+                ics_teachers = sorted([n for k, n in ics.files if k == "teacher"])
+                ics_teacher = st.selectbox("เลือกครู:", ics_teachers, key="ics_teacher") if ics_teachers else None
+                if ics_teacher:
+                    st.download_button(f"📥 ดาวน์โหลดปฏิทิน {ics_teacher}", data=ics.calendar("teacher", ics_teacher).encode("utf-8"),
+                                       file_name=f"{safe_filename(ics_teacher)}.ics", mime="text/calendar")
+            with ic4:
+                ics_rooms = sorted([n for k, n in ics.files if k == "room"], key=natural_sort_key)
+                ics_room = st.selectbox("เลือกห้อง:", ics_rooms, key="ics_room") if ics_rooms else None
+                if ics_room:
+                    st.download_button(f"📥 ดาวน์โหลดปฏิทินห้อง {ics_room}", data=ics.calendar("room", ics_room).encode("utf-8"),
+                                       file_name=f"room_{safe_filename(ics_room)}.ics", mime="text/calendar")
+
 elif menu == "6. 📊 Dashboard สรุปยอด":
     st.header("Dashboard สรุปภาระงานสอน")
-    all_rooms_list = get_all_rooms()
-    unique_levels = sorted(list(set([r.split('/')[0] for r in all_rooms_list if '/' in r])))
-    filter_options = ["ภาพรวมทั้งโรงเรียน"] + unique_levels
-    selected_filter = st.selectbox("🔍 เลือกดูข้อมูลเฉพาะระดับชั้น:", filter_options)
     
-    teacher_stats = {}
-    all_teachers = st.session_state.teachers_data["ชื่อ-สกุล"].tolist()
-    for t in all_teachers:
-        teacher_stats[t] = { "count": 0, "rooms": set(), "programs": set() }
+    # เปลี่ยนตัวกรองระดับชั้น -> rerun เฉพาะสรุป/กราฟ; สถิติ cache ตามเวอร์ชันข้อมูล
+    @st.fragment
+    def dashboard_charts():
+        all_rooms_list = get_all_rooms()
+        unique_levels = sorted(list(set([r.split('/')[0] for r in all_rooms_list if '/' in r])))
+        filter_options = ["ภาพรวมทั้งโรงเรียน"] + unique_levels
+        selected_filter = st.selectbox("🔍 เลือกดูข้อมูลเฉพาะระดับชั้น:", filter_options)
+        
+        teacher_stats, total_slots, rule_violations = cached_dashboard_stats(st.session_state.data_key, selected_filter, st.session_state.schedule_data, st.session_state.teachers_data)
+        
+        active_teachers_count = sum(1 for t in teacher_stats if teacher_stats[t]["count"] > 0)
+        c1, c2, c3 = st.columns(3)
+        c1.metric("จำนวนครู (ที่มีสอน)", f"{active_teachers_count} คน")
+        c2.metric(f"ยอดสอนรวม ({selected_filter})", f"{total_slots} คาบ")
+        c3.metric("ครูที่ผิดกฎภาระงาน", f"{len(rule_violations)} คน")
+        if rule_violations:
+            with st.expander(f"⚠️ รายการที่ผิดกฎภาระงาน ({sum(len(v) for v in rule_violations.values())} รายการ)"):
+                for msgs in rule_violations.values():
+                    for msg in msgs:
+                        st.markdown(f"- {msg}")
+        
+        st.markdown("---")
     
-    total_slots = 0
-    schedule_data = st.session_state.schedule_data
+        data_list = []
+        for t_name, stats in teacher_stats.items():
+            show_teacher = True
+            if selected_filter != "ภาพรวมทั้งโรงเรียน":
+                if stats["count"] == 0:
+                    show_teacher = False
+        
+            if show_teacher:
+                sorted_rooms = sorted(list(stats["rooms"]), key=natural_sort_key)
+                sorted_progs = sorted(list(stats["programs"]))
+                data_list.append({
+                    "ชื่อครู": t_name,
+                    "จำนวนคาบ/สัปดาห์": stats["count"],
+                    "ห้องที่สอน": ", ".join(sorted_rooms),
+                    "สายการเรียน": ", ".join(sorted_progs)
+                })
+            
+        if data_list:
+            df_stats = pd.DataFrame(data_list)
+            df_stats = df_stats.sort_values(by="จำนวนคาบ/สัปดาห์", ascending=False).reset_index(drop=True)
+        
+            st.subheader(f"📊 กราฟแสดงจำนวนคาบสอน ({selected_filter})")
+            if not df_stats.empty:
+                st.bar_chart(df_stats.set_index("ชื่อครู")["จำนวนคาบ/สัปดาห์"])
+            else:
+                st.info("ไม่พบข้อมูลการสอนในเงื่อนไขนี้")
+        
+            st.markdown("---")
+            st.subheader("📋 ตารางจัดลำดับภาระงาน")
+            st.dataframe(
+                df_stats, 
+                column_config={
+                    "จำนวนคาบ/สัปดาห์": st.column_config.ProgressColumn(
+                        "จำนวนคาบ", 
+                        format="%d", 
+                        min_value=0, 
+                        max_value=30
+                    ),
+                    "ห้องที่สอน": st.column_config.TextColumn("ห้องที่สอน", width="medium"),
+                    "สายการเรียน": st.column_config.TextColumn("สายการเรียน", width="small")
+                },
+                use_container_width=True
+            )
+        else:
+            st.warning("ไม่พบข้อมูลการสอนในระดับชั้นที่เลือก")
+
+    dashboard_charts()
     
-    for room in schedule_data:
-        if selected_filter != "ภาพรวมทั้งโรงเรียน":
-            if not room.startswith(selected_filter):
-                continue
-        for day in DAYS:
-            for period in range(1, 10):
-                slots = schedule_data[room][day][period]
-                for s in slots:
-                    # [UPDATED] Split multiple teachers for counting
-                    t_names = [x.strip() for x in s['teacher'].split(',')]
-                    prog = s.get('program', 'รวม')
-                    
-                    for t_name in t_names:
-                        if t_name in teacher_stats:
-                            teacher_stats[t_name]["count"] += 1
-                            teacher_stats[t_name]["rooms"].add(room)
-                            teacher_stats[t_name]["programs"].add(prog)
+    st.markdown("---")
+    
+    @st.fragment
+    def balance_optimizer():
+        with st.expander("⚖️ ปรับสมดุลภาระงาน (Optimizer)"):
+            st.caption("เสนอการสลับ/โอนคาบระหว่างครูวิชาเดียวกัน ให้จำนวนคาบต่อสัปดาห์และต่อวันใกล้เคียงกัน "
+                       "โดยคงห้อง วัน คาบ และสายการเรียนเดิม เคารพห้องที่ได้รับมอบหมาย การสอนซ้อน และกฎภาระงาน")
+            ob1, ob2 = st.columns([3, 1])
+            opt_iterations = ob1.select_slider("จำนวนรอบการค้นหา", options=[10000, 50000, 100000, 200000], value=50000, key="opt_iterations")
+            if ob2.button("🔄 คำนวณข้อเสนอ", use_container_width=True):
+                optimizer = WorkloadOptimizer(st.session_state.schedule_data, get_teacher_room_rules(), RULESET, DAYS)
+                result = optimizer.run(opt_iterations)
+                result["loads"] = optimizer.loads()
+                st.session_state.balance_proposal = result
+        
+            proposal = st.session_state.get("balance_proposal")
+            if proposal:
+                m1, m2, m3 = st.columns(3)
+                m1.metric("คาบที่เปลี่ยนผู้สอน", len(proposal["changes"]))
+                m2.metric("ค่าความไม่สมดุล", f"{proposal['cost_after']:.1f}", f"{proposal['cost_after'] - proposal['cost_before']:.1f}", delta_color="inverse")
+                m3.metric("ความเร็วการค้นหา", f"{proposal['moves_per_second']:,.0f} moves/s")
+                if not proposal["changes"]:
+                    st.success("ภาระงานสมดุลแล้ว ไม่มีข้อเสนอเพิ่มเติม")
+                else:
+                    df_changes = pd.DataFrame([
+                        {"ใช้": True, "ห้อง": r, "วัน": d, "คาบ": p, "สาย": prog, "จากครู": old, "เป็นครู": new}
+                        for r, d, p, prog, old, new in proposal["changes"]
+                    ])
+                    edited = st.data_editor(
+                        df_changes, hide_index=True, use_container_width=True, key="opt_changes",
+                        disabled=["ห้อง", "วัน", "คาบ", "สาย", "จากครู", "เป็นครู"]
+                    )
+                    df_loads = pd.DataFrame([
+                        {"ชื่อครู": t, "ก่อน": a, "หลัง": b}
+                        for t, (a, b) in proposal["loads"].items() if a != b
+                    ])
+                    if not df_loads.empty:
+                        st.dataframe(df_loads, hide_index=True, use_container_width=True)
+                    if st.button("✅ ใช้รายการที่เลือก", type="primary"):
+                        selected = [c for c, use in zip(proposal["changes"], edited["ใช้"]) if use]
+                        applied = apply_balance_changes(selected)
+                        if applied is None:
+                            st.error("รายการที่เลือกทำให้เกิดการสอนซ้อนหรือผิดกฎภาระงาน กรุณาเลือกใหม่หรือคำนวณใหม่")
                         else:
-                            # In case new teacher not in DB list
-                            teacher_stats[t_name] = { "count": 1, "rooms": {room}, "programs": {prog} }
-                        total_slots += 1
+                            del st.session_state.balance_proposal
+                            st.success(f"บันทึกแล้ว {len(applied)} คาบ")
+                            time.sleep(1)
+                            st.rerun()
 
-    active_teachers_count = sum(1 for t in teacher_stats if teacher_stats[t]["count"] > 0)
-    c1, c2, c3 = st.columns(3)
-    c1.metric("จำนวนครู (ที่มีสอน)", f"{active_teachers_count} คน")
-    c2.metric(f"ยอดสอนรวม ({selected_filter})", f"{total_slots} คาบ")
+    balance_optimizer()
+
+elif menu == "7. 🕘 Snapshot / เปรียบเทียบเวอร์ชัน":
+    st.header("Snapshot ตารางสอน และเปรียบเทียบเวอร์ชัน")
+    snap_store = init_snapshots()
+    
+    with st.form("snapshot_form"):
+        snap_name = st.text_input("ชื่อ snapshot (เช่น term 1 final, before reshuffle)")
+        if st.form_submit_button("📸 บันทึก snapshot จากตารางปัจจุบัน"):
+            if not snap_name.strip():
+                st.error("กรุณาตั้งชื่อ snapshot")
+            else:
+                try:
+                    size = snap_store.create(snap_name.strip(), schedule_state(st.session_state.schedule_data))
+                    st.success(f"✅ บันทึก snapshot '{snap_name.strip()}' แล้ว ({size:,} ตัวอักษร)")
+                except Exception as e:
+                    st.error(f"⛔ บันทึก snapshot ไม่สำเร็จ: {e}")
+    
+    try:
+        snap_names = snap_store.names()
+    except Exception as e:
+        st.error(f"โหลดรายการ snapshot ไม่ได้: {e}")
+        snap_names = []
+    
+    LIVE_LABEL = "🟢 ตารางปัจจุบัน (Live)"
+    version_options = snap_names + [LIVE_LABEL]
+    live_state = schedule_state(st.session_state.schedule_data)
     
     st.markdown("---")
+    st.subheader("🔍 เปรียบเทียบ")
+    c_a, c_b, c_refresh = st.columns([0.4, 0.4, 0.2])
+    with c_a:
+        sel_a = st.selectbox("เวอร์ชันเดิม (A)", version_options, index=max(0, len(version_options) - 2))
+    with c_b:
+        sel_b = st.selectbox("เวอร์ชันใหม่ (B)", version_options, index=len(version_options) - 1)
+    with c_refresh:
+        st.write("")
+        if st.button("🔄 โหลดรายการใหม่"):
+            snap_store.entries(refresh=True)
+            st.rerun()
     
-    data_list = []
-    for t_name, stats in teacher_stats.items():
-        show_teacher = True
-        if selected_filter != "ภาพรวมทั้งโรงเรียน":
-            if stats["count"] == 0:
-                show_teacher = False
-        
-        if show_teacher:
-            sorted_rooms = sorted(list(stats["rooms"]), key=natural_sort_key)
-            sorted_progs = sorted(list(stats["programs"]))
-            data_list.append({
-                "ชื่อครู": t_name,
-                "จำนวนคาบ/สัปดาห์": stats["count"],
-                "ห้องที่สอน": ", ".join(sorted_rooms),
-                "สายการเรียน": ", ".join(sorted_progs)
-            })
-            
-    if data_list:
-        df_stats = pd.DataFrame(data_list)
-        df_stats = df_stats.sort_values(by="จำนวนคาบ/สัปดาห์", ascending=False).reset_index(drop=True)
+    t_diff = time.perf_counter()
+    state_a = live_state if sel_a == LIVE_LABEL else snap_store.load(sel_a)
+    state_b = live_state if sel_b == LIVE_LABEL else snap_store.load(sel_b)
+    changes = diff_states(state_a, state_b)
+    diff_ms = (time.perf_counter() - t_diff) * 1000
+    
+    kinds = [change_kind(c) for c in changes]
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("เพิ่ม", kinds.count("added"))
+    m2.metric("ลบ", kinds.count("removed"))
+    m3.metric("เปลี่ยน", kinds.count("changed"))
+    m4.metric("เวลาคำนวณ", f"{diff_ms:.1f} ms")
+    
+    kind_labels = {"added": "➕ เพิ่ม", "removed": "➖ ลบ", "changed": "✏️ เปลี่ยน"}
+    def slot_label(v):
+        # (ครู, วิชา, สถานที่) -> "วิชา (ครู) @ สถานที่"
+        return f"{v[1]} ({v[0]})" + (f" @ {v[2]}" if v[2] else "") if v else "-"
+    def changes_df(change_list):
+        return pd.DataFrame([{
+            "ห้อง": r, "วัน": d, "คาบ": p, "สาย": prog, "ประเภท": kind_labels[change_kind(c)],
+            "เดิม": slot_label(a), "ใหม่": slot_label(b),
+        } for c in change_list for (r, d, p, prog), a, b in [c]])
+    
+    if not changes:
+        st.info("ไม่มีความแตกต่างระหว่างสองเวอร์ชันนี้")
+    else:
+        tab_by_room, tab_by_teacher = st.tabs(["🏫 ตามห้องเรียน", "👥 ตามครู"])
+        with tab_by_room:
+            for room, room_changes in sorted(group_by_room(changes).items(), key=lambda x: natural_sort_key(x[0])):
+                with st.expander(f"{room} ({len(room_changes)} รายการ)"):
+                    st.dataframe(changes_df(room_changes), hide_index=True, use_container_width=True)
+        with tab_by_teacher:
+            for teacher, t_changes in sorted(group_by_teacher(changes).items()):
+                with st.expander(f"{teacher} ({len(t_changes)} รายการ)"):
+                    st.dataframe(changes_df(t_changes), hide_index=True, use_container_width=True)
+    
+    st.markdown("---")
+    st.subheader("♻️ คืนค่าตาม snapshot")
+    if not snap_names:
+        st.caption("ยังไม่มี snapshot")
+    else:
+        restore_name = st.selectbox("เลือก snapshot ที่ต้องการคืนค่า", snap_names, index=len(snap_names) - 1)
+        restore_changes = diff_states(live_state, snap_store.load(restore_name))
+        st.caption(f"จะเปลี่ยนตารางปัจจุบัน {len(restore_changes)} คาบ (ห้องที่ไม่มีในระบบแล้วจะถูกข้าม)")
+        confirm_restore = st.checkbox("ยืนยันว่าต้องการคืนค่าตาราง")
+        if st.button("♻️ คืนค่า", type="primary", disabled=not confirm_restore or not restore_changes):
+            applied = restore_schedule_state(snap_store.load(restore_name))
+            st.success(f"✅ คืนค่าตาม '{restore_name}' แล้ว ({len(applied)} คาบ)")
+            time.sleep(1)
+            st.rerun()
+
+elif menu == "8. 📚 คลังภาคเรียน / วิเคราะห์ข้ามภาคเรียน":
+    st.header("คลังข้อมูลภาคเรียน และวิเคราะห์ข้ามภาคเรียน")
+    archive = init_term_archive()
+    archived = archive.terms()
+    
+    # เก็บตารางที่เป็นฉบับสุดท้ายของภาคเรียน (แถวเดียวกับชีต Schedule + รหัสภาคเรียน) ลงไฟล์ Parquet
+    with st.expander("📦 เก็บตารางปัจจุบันลงคลัง (ทำเมื่อตารางของภาคเรียนนี้เป็นฉบับสุดท้าย)", expanded=not archived):
+        with st.form("archive_form"):
+            term_key = st.text_input("รหัสภาคเรียน (ปีการศึกษา-ภาคเรียน)", value=default_term_key())
+            replace_term = st.checkbox("เขียนทับ หากมีภาคเรียนนี้ในคลังแล้ว")
+            if st.form_submit_button("📦 เก็บลงคลัง", type="primary"):
+                try:
+                    term_key = check_term(term_key)
+                    if term_key in [t[0] for t in archived] and not replace_term:
+                        st.error(f"มีภาคเรียน {term_key} ในคลังแล้ว — เลือก 'เขียนทับ' หากต้องการแทนที่")
+                    else:
+                        slots_per_week = sum(len(ps) for ps in BELL.day_periods.values())
+                        n_slots = archive.archive(term_key, flatten_schedule(st.session_state.schedule_data), slots_per_week)
+                        st.success(f"✅ เก็บภาคเรียน {term_key} ลงคลังแล้ว ({n_slots:,} คาบ)")
+                        archived = archive.terms()
+                except ValueError as e:
+                    st.error(f"⛔ รหัสภาคเรียนไม่ถูกต้อง: {e}")
+    
+    if not archived:
+        st.info("ยังไม่มีภาคเรียนในคลัง — เก็บตารางปัจจุบันด้านบนเพื่อเริ่มต้น")
+    else:
+        with st.expander(f"🗂️ ภาคเรียนในคลัง ({len(archived)} ภาคเรียน, {sum(t[4] for t in archived) / 1024:,.0f} KB)"):
+            st.dataframe(pd.DataFrame([
+                {"ภาคเรียน": t, "จำนวนคาบ": n, "คาบเรียน/สัปดาห์/ห้อง": spw, "เก็บเมื่อ": at, "ขนาดไฟล์ (KB)": round(size / 1024, 1)}
+                for t, n, at, spw, size in archived
+            ]), hide_index=True, use_container_width=True)
         
-        st.subheader(f"📊 กราฟแสดงจำนวนคาบสอน ({selected_filter})")
-        if not df_stats.empty:
-            st.bar_chart(df_stats.set_index("ชื่อครู")["จำนวนคาบ/สัปดาห์"])
+        term_names = [t[0] for t in archived]
+        slots_per_week_of = {t: spw for t, _, _, spw, _ in archived}
+        sel_terms = st.multiselect("เลือกภาคเรียนที่ต้องการเปรียบเทียบ", term_names, default=term_names[-6:])
+        if not sel_terms:
+            st.warning("กรุณาเลือกอย่างน้อย 1 ภาคเรียน")
         else:
-            st.info("ไม่พบข้อมูลการสอนในเงื่อนไขนี้")
-        
-        st.markdown("---")
-        st.subheader("📋 ตารางจัดลำดับภาระงาน")
-        st.dataframe(
-            df_stats, 
-            column_config={
-                "จำนวนคาบ/สัปดาห์": st.column_config.ProgressColumn(
-                    "จำนวนคาบ", 
-                    format="%d", 
-                    min_value=0, 
-                    max_value=30
-                ),
-                "ห้องที่สอน": st.column_config.TextColumn("ห้องที่สอน", width="medium"),
-                "สายการเรียน": st.column_config.TextColumn("สายการเรียน", width="small")
-            },
-            use_container_width=True
-        )
-    else:
-        st.warning("ไม่พบข้อมูลการสอนในระดับชั้นที่เลือก")
+            sel_terms = sorted(sel_terms)
+            loads, room_use, coverage, query_ms = cached_term_analytics(st.session_state.tenant_id, archive.key(), tuple(sel_terms))
+            st.caption(f"วิเคราะห์ {len(sel_terms)} ภาคเรียน ในเวลา {query_ms:.0f} ms")
+            tab_load, tab_room, tab_prog = st.tabs(["👥 ภาระงานครู", "🏫 การใช้ห้องเรียน", "🎓 สายการเรียน"])
+            
+            with tab_load:
+                per_term = loads.groupby("term")["periods"].agg(["mean", "max"]).reindex(sel_terms)
+                st.subheader("คาบสอน/สัปดาห์ของครู (เฉลี่ยและสูงสุด)")
+                st.line_chart(per_term.rename(columns={"mean": "เฉลี่ย", "max": "สูงสุด"}))
+                pivot = loads.pivot_table(index="teacher", columns="term", values="periods", fill_value=0).reindex(columns=sel_terms, fill_value=0)
+                if len(sel_terms) > 1:
+                    pivot["เปลี่ยนแปลง"] = pivot[sel_terms[-1]] - pivot[sel_terms[0]]
+                st.dataframe(pivot.sort_values(sel_terms[-1], ascending=False).rename_axis("ชื่อครู"), use_container_width=True)
+            
+            with tab_room:
+                # สัดส่วนช่องเวลาที่ห้องถูกใช้ เทียบกับจำนวนคาบเรียนต่อสัปดาห์ของตารางเวลาในภาคเรียนนั้น
+                room_use["ใช้ (%)"] = [
+                    100 * used / slots_per_week_of[t] if slots_per_week_of.get(t) else 0
+                    for t, used in zip(room_use["term"], room_use["used"])
+                ]
+                by_level = room_use.pivot_table(index="level", columns="term", values="ใช้ (%)", aggfunc="mean").reindex(columns=sel_terms)
+                st.subheader("อัตราการใช้ห้องเรียนเฉลี่ยตามระดับชั้น (%)")
+                st.bar_chart(by_level.T)
+                st.dataframe(by_level.round(1).rename_axis("ระดับชั้น"), use_container_width=True)
+                with st.expander("รายห้อง"):
+                    by_room = room_use.pivot_table(index="room", columns="term", values="used", fill_value=0).reindex(columns=sel_terms, fill_value=0)
+                    st.dataframe(by_room.loc[sorted(by_room.index, key=natural_sort_key)].rename_axis("ห้อง"), use_container_width=True)
+            
+            with tab_prog:
+                slots_by_prog = coverage.pivot_table(index="program", columns="term", values="slots", fill_value=0).reindex(columns=sel_terms, fill_value=0)
+                rooms_by_prog = coverage.pivot_table(index="program", columns="term", values="rooms", fill_value=0).reindex(columns=sel_terms, fill_value=0)
+                st.subheader("จำนวนคาบต่อสัปดาห์ของแต่ละสายการเรียน")
+                st.bar_chart(slots_by_prog.T)
+                st.dataframe(slots_by_prog.rename_axis("สายการเรียน"), use_container_width=True)
+                st.caption("จำนวนห้องที่มีคาบของสายการเรียนนั้น")
+                st.dataframe(rooms_by_prog.rename_axis("สายการเรียน"), use_container_width=True)
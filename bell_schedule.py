@@ -0,0 +1,122 @@
+"""
+Bell schedule as data, compiled once into lookup tables.
+
+The optional ``BellSchedule`` worksheet has the columns Day, Period, Time,
+Break::
+
+    Day     Period  Time          Break
+    *       1       08.15-09.00
+    *       2       09.00-09.45
+    ...
+    ศุกร์    1       08.15-09.00                 <- Friday half-day: only these periods
+    ศุกร์    2       09.00-09.45
+    ศุกร์    3       10.00-10.45   กิจกรรม
+
+Rows with Day "*" (or empty) are the normal day. A day with rows of its own
+uses exactly those rows (half-days, exam days); days not in ``DAYS`` are
+appended (e.g. Saturday classes). Break labels the break after a period;
+when empty it is derived from the gap to the next period, and the longest
+gap of the normal day is lunch. For an exam week or a new term, replace the
+worksheet contents. Without the worksheet the constants in school_config
+apply.
+
+Compiled tables (all plain dicts/tuples, built once per bell schedule)::
+
+    days         teaching days in order
+    periods      every period number in column order (union of all days)
+    ordinal      period -> column index, also the bit index in RuleSet masks
+    day_periods  day -> tuple of periods held that day
+    day_mask     day -> bitmask of those periods
+    times        period -> time on the normal day (column headers)
+    day_times    day -> {period: time}
+    breaks       period -> label of the break column after it
+    columns      [(period, time, break label or None)] for the table renderers
+    key          short hash that changes whenever the bell schedule does
+"""
+import hashlib
+import html
+import json
+
+from rules import RuleSet, period_gaps
+from school_config import DAYS, PERIODS
+
+BELL_SHEET = "BellSchedule"
+BELL_HEADERS = ["Day", "Period", "Time", "Break"]
+ALL_DAYS = "*"
+
+
+def default_rows():
+    return [[ALL_DAYS, p, t, ""] for p, t in PERIODS.items()]
+
+
+def rows_from_records(records):
+    """[day, period, time, break] rows from the worksheet records; [] when the sheet is empty."""
+    rows = []
+    for rec in records:
+        if str(rec.get('Period', '')).strip() == "":
+            continue
+        rows.append([str(rec.get('Day', '')).strip() or ALL_DAYS, int(rec['Period']),
+                     str(rec['Time']).strip(), str(rec.get('Break', '')).strip()])
+    return rows
+
+
+class BellSchedule:
+    def __init__(self, rows=None, days=DAYS):
+        rows = [list(r) for r in (rows or default_rows())]
+        self.rows = rows
+        self.key = hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+        normal, own, labels = {}, {}, {}
+        for day, p, time, label in rows:
+            target = normal if day == ALL_DAYS else own.setdefault(day, {})
+            target[int(p)] = time
+            if label:
+                labels[(day, int(p))] = label
+        if not normal:
+            # No "*" rows: the longest listed day stands in for the normal one
+            normal = max(own.values(), key=len)
+        for times in [normal, *own.values()]:
+            period_gaps(times)  # raises on a malformed time, before anything is half-built
+
+        self.days = list(days) + [d for d in own if d not in days]
+        self.day_times = {d: dict(sorted(own.get(d, normal).items())) for d in self.days}
+        self.periods = tuple(sorted(set(normal).union(*self.day_times.values())))
+        self.ordinal = {p: i for i, p in enumerate(self.periods)}
+        self.day_periods = {d: tuple(times) for d, times in self.day_times.items()}
+        self.day_mask = {d: sum(1 << self.ordinal[p] for p in ps) for d, ps in self.day_periods.items()}
+        self.times = {p: normal.get(p, "") for p in self.periods}
+        self.normal_times = dict(sorted(normal.items()))
+        self.special_days = {d: t for d, t in self.day_times.items() if t != self.normal_times}
+
+        gaps = period_gaps(normal)
+        lunch = RuleSet.lunch_of(gaps)
+        self.breaks = {}
+        for p, (_, minutes) in gaps.items():
+            label = labels.get((ALL_DAYS, p))
+            if label:
+                self.breaks[p] = html.escape(label).replace(" ", "<br>", 1)
+            elif p == lunch:
+                self.breaks[p] = "พัก<br>กลางวัน"
+            elif minutes > 0:
+                self.breaks[p] = f"พัก<br>{minutes} นาที"
+        self.columns = [(p, self.times[p], self.breaks.get(p)) for p in self.periods]
+
+    @classmethod
+    def from_records(cls, records, days=DAYS):
+        return cls(rows_from_records(records) or None, days)
+
+    def time_of(self, day, period):
+        return self.day_times.get(day, self.times).get(period, "")
+
+    def held(self, day, period):
+        return period in self.day_times.get(day, ())
+
+    def empty_week(self):
+        """{day: {period: []}} over every column, so any (day, period) lookup works on every day."""
+        return {d: {p: [] for p in self.periods} for d in self.days}
+
+    def ruleset(self, rules):
+        return RuleSet(rules, self.normal_times, self.special_days)
+
+    def to_rows(self):
+        return [list(BELL_HEADERS)] + [list(r) for r in self.rows]
@@ -0,0 +1,584 @@
+"""
+Randomised differential test: optimised scheduling logic vs reference logic.
+
+    python difftest.py                          # every property, 200 cases, seed 0
+    python difftest.py --cases 3000 --seed 7
+    python difftest.py --only edits rules
+
+Reference side: plain period-list implementations of the original app logic
+(no indexes, bitmasks or caches), kept here on purpose as the executable
+specification. Optimised side: the real ``validate_schedule_rules``,
+``apply_schedule_updates`` and ``get_teacher_subject`` lifted out of app.py
+with ``ast`` and run against a stub ``st``, plus the helper modules they
+lean on (rules, schedule_store, snapshots, search_index, optimizer).
+
+Properties:
+
+    edits      random school + edit sequence; after every edit the conflicts,
+               the resulting schedule, the journal replay, the snapshot delta
+               and the search index must all match the reference
+    rules      RuleSet bitmask checks vs period lists on random bell schedules
+    optimizer  double_bookings vs a naive count; an optimizer proposal never
+               adds a double booking or a rule violation
+
+Generated schools use several programs next to 'รวมทุกสาย', team-taught
+comma strings (with and without spaces), "(ติดสอน …)" option suffixes, the
+"-- ล็อค --" marker, empty forms, unknown teachers and auto-remove. A
+failing case is shrunk greedily (edits, form rows, slots, rooms, teachers)
+and printed as JSON. Runs offline; exit status 1 on any mismatch.
+"""
+import argparse
+import ast
+import copy
+import json
+import os
+import random
+import sys
+import time
+import types
+
+import pandas as pd
+
+from bell_schedule import BellSchedule
+from optimizer import WorkloadOptimizer, apply_changes, double_bookings
+from rules import RuleSet, split_teachers, teacher_day_masks
+from schedule_store import JOURNAL_HEADERS, JOURNAL_SHEET, replay_journal
+from search_index import SlotIndex, level_of
+from snapshots import decode_state, encode_state, schedule_state
+
+LOCK = "-- ล็อค --"
+ALL_PROGRAMS = "รวมทุกสาย"
+PROGRAMS = [ALL_PROGRAMS, "IEP", "SMEP", "EEP"]
+SUBJECTS = ["คณิตศาสตร์", "วิทยาศาสตร์", "ภาษาไทย", "ภาษาอังกฤษ", "สังคมศึกษา"]
+APP_FUNCTIONS = ["get_all_rooms", "clean_teacher_name", "get_teacher_subject",
+                 "validate_schedule_rules", "apply_schedule_updates", "save_schedule_changes"]
+BELL = BellSchedule()
+DAYS, PERIODS = BELL.days, BELL.normal_times
+# The original app had a single rule: more than 2 periods in a row, every period adjacent
+LEGACY_RULES = [{"rule": "max_consecutive", "limit": 2}]
+
+
+# --- reference implementations ---
+
+def ref_split(teacher_str):
+    return [x.strip() for x in str(teacher_str).split(',')]
+
+
+def ref_clean(option):
+    return option.split(" (")[0].strip() if "(" in option else option
+
+
+def ref_subject(teachers, names_str):
+    subjects = []
+    for t in ref_split(names_str):
+        name = t.split(" (")[0].strip()
+        for n, s in teachers:
+            if n == name:
+                if s and s not in subjects:
+                    subjects.append(s)
+                break
+    return ", ".join(subjects)
+
+
+def ref_validate(schedule, rooms, form, current_room, day, target_prog):
+    conflicts = []
+    involved = set()
+    for t_list in form.values():
+        if t_list and t_list != [LOCK]:
+            for t in t_list:
+                involved.add(ref_clean(t))
+    for teacher in involved:
+        for p, t_list in form.items():
+            if teacher in [ref_clean(x) for x in t_list if x != LOCK]:
+                for r in rooms:
+                    if r == current_room:
+                        continue
+                    for s in schedule[r][day][p]:
+                        if teacher in ref_split(s['teacher']):
+                            conflicts.append(f"⛔ **สอนซ้อน:** ครู {teacher} สอนที่ห้อง {r} ในคาบ {p} อยู่แล้ว")
+        teaching = set()
+        for r in rooms:
+            for p in PERIODS:
+                for s in schedule[r][day][p]:
+                    if (r != current_room or s.get('program', ALL_PROGRAMS) != target_prog) and teacher in ref_split(s['teacher']):
+                        teaching.add(p)
+                if r == current_room and p in form and teacher in [ref_clean(x) for x in form[p] if x != LOCK]:
+                    teaching.add(p)
+        teaching = sorted(teaching)
+        run = longest = 1
+        for a, b in zip(teaching, teaching[1:]):
+            run = run + 1 if b == a + 1 else 1
+            longest = max(longest, run)
+        if longest > 2:
+            conflicts.append(f"⚠️ **มาราธอน:** ครู {teacher} สอนติดกัน {longest} คาบ (คาบ {teaching})")
+    return conflicts
+
+
+def ref_apply(schedule, rooms, teachers, grade, day, form, target_prog, auto_remove):
+    for p, t_list in form.items():
+        if t_list == [LOCK]:
+            continue
+        names = [ref_clean(t) for t in t_list]
+        if auto_remove:
+            for r in rooms:
+                if r == grade:
+                    continue
+                kept_cell, changed = [], False
+                for s in schedule[r][day][p]:
+                    kept = [t for t in ref_split(s['teacher']) if t not in names]
+                    if len(kept) != len(ref_split(s['teacher'])):
+                        changed = True
+                        if kept:
+                            s['teacher'] = ", ".join(kept)
+                            kept_cell.append(s)
+                    else:
+                        kept_cell.append(s)
+                if changed:
+                    schedule[r][day][p] = kept_cell
+        cell = [s for s in schedule[grade][day][p] if s.get('program', ALL_PROGRAMS) != target_prog]
+        if names:
+            joined = ", ".join(names)
+            cell.append({"teacher": joined, "subject": ref_subject(teachers, joined), "program": target_prog})
+        schedule[grade][day][p] = cell
+
+
+def ref_search(state, query):
+    fields = {"teacher": 0, "subject": 1, "program": 2, "room": 3, "level": 4, "day": 5, "period": 6}
+    aliases = {"ครู": "teacher", "วิชา": "subject", "สาย": "program", "ห้อง": "room", "ชั้น": "level", "วัน": "day", "คาบ": "period"}
+
+    def values(key, value):
+        r, d, p, prog = key
+        return [set(t for t in ref_split(value[0]) if t), {value[1]}, {prog}, {r}, {level_of(r)}, {d}, {str(p)}]
+
+    slots = [(k, values(k, v)) for k, v in state.items()]
+    hits = set(state)
+    for term in query.split():
+        field, sep, token = term.partition(":")
+        if sep and field in aliases:
+            wanted, token = [fields[aliases[field]]], token.strip()
+        elif term.isdigit():
+            wanted, token = [fields["period"]], term
+        else:
+            wanted, token = list(fields.values()), term
+        matched = {k for k, vals in slots if any(token in vals[i] for i in wanted)}
+        if not matched:
+            partial = [i for i in wanted if i in (0, 1)]
+            matched = {k for k, vals in slots if any(token in v for i in partial for v in vals[i])}
+        hits &= matched
+    return sorted(k + state[k][:2] for k in hits) if query.split() else []
+
+
+def ref_rule_messages(rules, periods, teacher, day_periods, day_bells=None):
+    day_bells = day_bells or {}
+    order = sorted(set(periods).union(*day_bells.values()))
+
+    def minutes(hhmm):
+        h, m = hhmm.strip().split(".")
+        return int(h) * 60 + int(m)
+
+    def gaps_of(bell):
+        ps = sorted(bell)
+        return {a: (b, minutes(bell[b].split("-")[0]) - minutes(bell[a].split("-")[1])) for a, b in zip(ps, ps[1:])}
+
+    msgs = []
+    for d, taught in day_periods.items():
+        taught = [p for p in order if p in taught]
+        if not taught:
+            continue
+        gap = gaps_of(day_bells.get(d, periods))
+        for rule in rules:
+            kind = rule["rule"]
+            if kind == "max_consecutive":
+                longest = run = 0
+                for i, p in enumerate(order):
+                    if p not in taught:
+                        run = 0
+                        continue
+                    prev = order[i - 1] if i > 0 else None
+                    linked = prev in taught and gap.get(prev, (None,))[0] == p and (
+                        rule.get("min_break_minutes") is None or gap[prev][1] < rule["min_break_minutes"])
+                    run = run + 1 if linked else 1
+                    longest = max(longest, run)
+                if longest > rule["limit"]:
+                    msgs.append(f"⚠️ **มาราธอน:** ครู {teacher} สอนติดกัน {longest} คาบ (คาบ {taught})")
+            elif kind == "max_per_day" and len(taught) > rule["limit"]:
+                msgs.append(f"⚠️ **สอนเกินต่อวัน:** ครู {teacher} สอนวัน{d} {len(taught)} คาบ (สูงสุด {rule['limit']})")
+            elif kind == "required_free" and (rule.get("days") is None or d in rule["days"]):
+                hit = [p for p in taught if p in rule["periods"]]
+                if hit:
+                    msgs.append(f"⚠️ **ต้องว่าง:** ครู {teacher} มีสอนวัน{d} คาบ {hit} ซึ่งกำหนดให้ว่าง")
+            elif kind == "no_lunch_straddle" and gap:
+                lunch = max(gap, key=lambda p: gap[p][1])
+                after = gap[lunch][0]
+                if gap[lunch][1] > 0 and lunch in taught and after in taught:
+                    msgs.append(f"⚠️ **คร่อมพักกลางวัน:** ครู {teacher} สอนทั้งคาบ {lunch} และคาบ {after} วัน{d}")
+    for rule in rules:
+        if rule["rule"] == "max_per_week":
+            n = sum(len(ps) for ps in day_periods.values())
+            if n > rule["limit"]:
+                msgs.append(f"⚠️ **สอนเกินต่อสัปดาห์:** ครู {teacher} สอน {n} คาบ/สัปดาห์ (สูงสุด {rule['limit']})")
+    return msgs
+
+
+def ref_double_bookings(schedule, days):
+    count = {}
+    for r in schedule:
+        for d in days:
+            for p, cell in schedule[r][d].items():
+                for s in cell:
+                    for t in ref_split(s['teacher']):
+                        if t and t != LOCK:
+                            count[(t, d, p)] = count.get((t, d, p), 0) + 1
+    return sum(n - 1 for n in count.values())
+
+
+# --- the app's own functions ---
+
+class _SessionState(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class _JournalRecorder:
+    def __init__(self):
+        self.rows = []
+
+    def enqueue(self, kind, title, rows):
+        if title == JOURNAL_SHEET:
+            self.rows.extend(rows)
+
+
+def load_app(path=None):
+    """Namespace with the selected app.py functions, the app's local imports and stubs for Streamlit and the sync layer."""
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    local = {os.path.splitext(n)[0] for n in os.listdir(os.path.dirname(path)) if n.endswith(".py")}
+    body = [n for n in tree.body if isinstance(n, ast.ImportFrom) and n.module in local]
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in APP_FUNCTIONS:
+            node.decorator_list = []
+            body.append(node)
+    from symbols import SymbolTable
+    ns = {"st": types.SimpleNamespace(session_state=_SessionState())}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), ns)
+    symbols, recorder = SymbolTable(), _JournalRecorder()
+    ns.update(BELL=BELL, DAYS=DAYS, RULESET=BELL.ruleset(LEGACY_RULES), init_symbols=lambda: symbols,
+              init_local_store=lambda: recorder, push_pending=lambda: None, refresh_data_key=lambda: None,
+              journal=recorder)
+    return ns
+
+
+# --- case generation ---
+
+def gen_edits_case(rng, size):
+    levels = rng.sample(["ป.4", "ป.5", "ม.1"], rng.randint(1, 2))
+    rooms = [[f"{lv}/{i}", rng.choice(PROGRAMS[1:] + ["-"])] for lv in levels for i in range(1, rng.randint(2, 2 + size))]
+    teachers = [[f"ครู{chr(0x0E01 + i)} ใจดี{i}", rng.choice(SUBJECTS)] for i in range(rng.randint(2, 3 + size))]
+    names = [t[0] for t in teachers] + ["ครูพิเศษ"]  # not in the teacher table -> no subject
+
+    def team():
+        members = rng.sample(names, rng.choice([1, 1, 1, 2, 3]))
+        return rng.choice([", ", ",", " , "]).join(members)
+
+    slots = []
+    for r, _ in rooms:
+        for d in DAYS:
+            for p in PERIODS:
+                for prog in rng.sample(PROGRAMS, rng.choice([0, 0, 1, 1, 2])):
+                    teacher = LOCK if rng.random() < 0.02 else team()
+                    slots.append([r, d, p, prog, teacher, rng.choice(SUBJECTS)])
+
+    def option(t):
+        return f"{t} (ติดสอน {rng.choice(rooms)[0]})" if rng.random() < 0.3 else t
+
+    edits = []
+    for _ in range(rng.randint(1, 3 + 2 * size)):
+        form = []
+        for p in rng.sample(list(PERIODS), rng.randint(1, len(PERIODS))):
+            roll = rng.random()
+            if roll < 0.15:
+                form.append([p, [LOCK]])
+            elif roll < 0.22:
+                form.append([p, []])
+            elif roll < 0.25:
+                form.append([p, [LOCK, option(rng.choice(names))]])
+            else:
+                form.append([p, [option(t) for t in rng.sample(names, rng.choice([1, 1, 1, 2]))]])
+        edits.append({"room": rng.choice(rooms)[0], "day": rng.choice(DAYS), "program": rng.choice(PROGRAMS),
+                      "form": form, "auto_remove": rng.random() < 0.4})
+    return {"rooms": rooms, "teachers": teachers, "slots": slots, "edits": edits}
+
+
+def build_schedule_of(case, periods=PERIODS):
+    rooms = [r for r, _ in case["rooms"]]
+    schedule = {r: {d: {p: [] for p in periods} for d in DAYS} for r in rooms}
+    for r, d, p, prog, t, s in case["slots"]:
+        if r in schedule and p in schedule[r][d] and all(x['program'] != prog for x in schedule[r][d][p]):
+            schedule[r][d][p].append({"teacher": t, "subject": s, "program": prog})
+    return rooms, schedule
+
+
+def random_queries(rng, state, n=4):
+    queries = []
+    for _ in range(n):
+        terms = []
+        for _ in range(rng.randint(1, 2)):
+            if state and rng.random() < 0.8:
+                (r, d, p, prog), (t, s, _) = rng.choice(list(state.items()))
+                terms.append(rng.choice([
+                    rng.choice(split_teachers(t)), s, prog, r, level_of(r), d, str(p),
+                    f"วัน:{d}", f"ชั้น:{level_of(r)}", f"สาย:{prog}", f"ครู:{split_teachers(t)[0]}",
+                    split_teachers(t)[0][-3:], s[:3],
+                ]))
+            else:
+                terms.append(rng.choice(["ไม่มีชื่อนี้", "9", "คาบ:1", "วิชา:ดนตรี"]))
+        queries.append(" ".join(x for x in terms if x.strip()) or "1")
+    return queries
+
+
+# --- properties: each returns None or (check, detail) ---
+
+def check_edits(case, app):
+    rooms, initial = build_schedule_of(case)
+    if not rooms:
+        return None
+    teachers = [tuple(t) for t in case["teachers"]]
+    ref = copy.deepcopy(initial)
+    ss = app["st"].session_state
+    ss.clear()
+    ss.update(schedule_data=copy.deepcopy(initial), session_id="difftest",
+              classrooms_data=pd.DataFrame(case["rooms"], columns=["ห้องเรียน", "สายการเรียน"]),
+              teachers_data=pd.DataFrame(case["teachers"], columns=["ชื่อ-สกุล", "วิชาที่สอน"]),
+              search_index=SlotIndex.from_schedule(initial, app["init_symbols"]()))
+    app["journal"].rows = []
+    rng = random.Random(json.dumps(case["edits"], ensure_ascii=False))
+    prev_state = schedule_state(initial)
+    for step, e in enumerate(case["edits"]):
+        if e["room"] not in ref:
+            continue
+        form = {p: list(opts) for p, opts in e["form"]}
+        where = f"edit {step} ({e['room']} {e['day']} {e['program']})"
+        expected = ref_validate(ref, rooms, form, e["room"], e["day"], e["program"])
+        got = app["validate_schedule_rules"](form, e["room"], e["day"], e["program"])
+        if sorted(expected) != sorted(got):
+            return "validate", f"{where}: reference {sorted(expected)} != app {sorted(got)}"
+        # The editor passes the day slice it already built for the facility labels
+        booked = {}
+        busy = app["day_occupancy"](ss.schedule_data, app["get_all_rooms"](), e["day"], skip_room=e["room"],
+                                    facilities=booked, symbols=app["init_symbols"]())
+        with_slice = app["validate_schedule_rules"](form, e["room"], e["day"], e["program"], None, (busy, booked))
+        if sorted(with_slice) != sorted(got):
+            return "validate", f"{where}: with the editor's day slice {sorted(with_slice)} != {sorted(got)}"
+        ref_apply(ref, rooms, teachers, e["room"], e["day"], form, e["program"], e["auto_remove"])
+        app["apply_schedule_updates"](e["room"], e["day"], form, e["program"], e["auto_remove"])
+        if ss.schedule_data != ref:
+            return "apply", f"{where}: schedules differ"
+        state = schedule_state(ref)
+        records = [dict(zip(JOURNAL_HEADERS, row)) for row in app["journal"].rows]
+        if schedule_state(replay_journal(copy.deepcopy(initial), records)) != state:
+            return "journal", f"{where}: snapshot + journal replay differs from the schedule"
+        if decode_state(encode_state(state, base=prev_state), base=prev_state) != state:
+            return "snapshot", f"{where}: delta snapshot does not round-trip"
+        prev_state = state
+        for q in random_queries(rng, state):
+            if ss.search_index.search(q) != ref_search(state, q):
+                return "search", f"{where}: query {q!r}"
+    return None
+
+
+def gen_bell(rng, numbers):
+    bell, clock = {}, 7 * 60 + rng.randint(0, 90)
+    for p in numbers:
+        length = rng.choice([40, 45, 50, 60])
+        bell[p] = f"{clock // 60:02d}.{clock % 60:02d}-{(clock + length) // 60:02d}.{(clock + length) % 60:02d}"
+        clock += length + rng.choice([0, 0, 5, 10, 15, 30, 45, 60])
+    return bell
+
+
+def gen_rules_case(rng, size):
+    n = rng.randint(2, 7 + size)
+    periods = gen_bell(rng, range(1, n + 1))
+    # Half-days, exam days, an extra period: a day with a bell of its own
+    day_bells = {}
+    for d in rng.sample(DAYS, rng.choice([0, 0, 1, 2])):
+        numbers = sorted(rng.sample(range(1, n + 2), rng.randint(1, n + 1)))
+        day_bells[d] = gen_bell(rng, numbers)
+    rules = []
+    for _ in range(rng.randint(1, 4)):
+        kind = rng.choice(["max_consecutive", "max_per_day", "max_per_week", "required_free", "no_lunch_straddle"])
+        if kind == "max_consecutive":
+            rule = {"rule": kind, "limit": rng.randint(1, 4)}
+            if rng.random() < 0.6:
+                rule["min_break_minutes"] = rng.choice([5, 15, 30])
+        elif kind in ("max_per_day", "max_per_week"):
+            rule = {"rule": kind, "limit": rng.randint(1, 6 if kind == "max_per_day" else 15)}
+        elif kind == "required_free":
+            rule = {"rule": kind, "periods": rng.sample(list(periods), rng.randint(1, 2))}
+            if rng.random() < 0.5:
+                rule["days"] = rng.sample(DAYS, 2)
+        else:
+            rule = {"rule": kind}
+        rules.append(rule)
+    week = {}
+    for d in DAYS:
+        held = list(day_bells.get(d, periods))
+        week[d] = sorted(rng.sample(held, rng.randint(0, len(held))))
+    return {"periods": [[p, t] for p, t in periods.items()], "rules": rules, "week": [[d, ps] for d, ps in week.items()],
+            "day_bells": [[d, [[p, t] for p, t in bell.items()]] for d, bell in day_bells.items()]}
+
+
+def check_rules(case, app):
+    periods = {p: t for p, t in case["periods"]}
+    day_bells = {d: {p: t for p, t in bell} for d, bell in case.get("day_bells", [])}
+    week = {d: [p for p in ps if p in day_bells.get(d, periods)] for d, ps in case["week"]}
+    try:
+        ruleset = RuleSet(case["rules"], periods, day_bells)
+    except (ValueError, IndexError, KeyError):
+        return None
+    masks = {d: ruleset.mask_of(ps) for d, ps in week.items() if ps}
+    got = ruleset.check_all({"ครูทดสอบ": masks}, DAYS).get("ครูทดสอบ", [])
+    expected = ref_rule_messages(case["rules"], periods, "ครูทดสอบ", week, day_bells)
+    if sorted(got) != sorted(expected):
+        return "rules", f"reference {sorted(expected)} != RuleSet {sorted(got)}"
+    return None
+
+
+def check_optimizer(case, app):
+    rooms, schedule = build_schedule_of(case)
+    if double_bookings(schedule, DAYS) != ref_double_bookings(schedule, DAYS):
+        return "double_bookings", f"{double_bookings(schedule, DAYS)} != {ref_double_bookings(schedule, DAYS)}"
+    ruleset = BELL.ruleset(LEGACY_RULES)
+    teachers = [(t, s, None) for t, s in case["teachers"]]
+    opt = WorkloadOptimizer(schedule, teachers, ruleset, DAYS, seed=0)
+    opt.run(iterations=300)
+    after = copy.deepcopy(schedule)
+    apply_changes(after, opt.changes())
+    if ref_double_bookings(after, DAYS) > ref_double_bookings(schedule, DAYS):
+        return "optimizer", "proposal adds a double booking"
+
+    def violations(sched):
+        per_teacher = {}
+        for r in rooms:
+            for d in DAYS:
+                for p in PERIODS:
+                    for s in sched[r][d][p]:
+                        for t in ref_split(s['teacher']):
+                            per_teacher.setdefault(t, {}).setdefault(d, set()).add(p)
+        return {t: len(ref_rule_messages(LEGACY_RULES, PERIODS, t, ds)) for t, ds in per_teacher.items()}
+
+    before_v, after_v = violations(schedule), violations(after)
+    worse = [t for t in after_v if after_v[t] > before_v.get(t, 0)]
+    if worse:
+        return "optimizer", f"proposal adds rule violations for {worse}"
+    if teacher_day_masks(after, ruleset, DAYS) != {t: {d: ruleset.mask_of(ps) for d, ps in ds.items()} for t, ds in
+                                                   _ref_periods(after).items()}:
+        return "optimizer", "teacher_day_masks disagrees with the slot lists"
+    return None
+
+
+def _ref_periods(schedule):
+    result = {}
+    for r in schedule:
+        for d in DAYS:
+            for p in PERIODS:
+                for s in schedule[r][d][p]:
+                    for t in ref_split(s['teacher']):
+                        result.setdefault(t, {}).setdefault(d, set()).add(p)
+    return result
+
+
+PROPERTIES = {
+    "edits": (gen_edits_case, check_edits),
+    "rules": (gen_rules_case, check_rules),
+    "optimizer": (gen_edits_case, check_optimizer),
+}
+
+
+# --- shrinking ---
+
+def _candidates(case):
+    """Smaller variants of a case: chunks of top-level lists, then form rows inside each edit."""
+    for field in ("edits", "slots", "week", "rules", "day_bells", "rooms", "teachers", "periods"):
+        items = case.get(field)
+        if not items:
+            continue
+        chunk = max(1, len(items) // 2)
+        while chunk >= 1:
+            for start in range(0, len(items), chunk):
+                yield {**case, field: items[:start] + items[start + chunk:]}
+            chunk //= 2
+    for i, e in enumerate(case.get("edits", [])):
+        for j in range(len(e["form"])):
+            form = e["form"][:j] + e["form"][j + 1:]
+            if form:
+                yield {**case, "edits": case["edits"][:i] + [{**e, "form": form}] + case["edits"][i + 1:]}
+        if e["auto_remove"]:
+            yield {**case, "edits": case["edits"][:i] + [{**e, "auto_remove": False}] + case["edits"][i + 1:]}
+
+
+def shrink(case, check, app, label, budget=2000):
+    progress = True
+    while progress and budget > 0:
+        progress = False
+        for smaller in _candidates(case):
+            budget -= 1
+            failure = check(smaller, app)
+            if failure and failure[0] == label:
+                case, progress = smaller, True
+                break
+            if budget <= 0:
+                break
+    return case
+
+
+def format_case(case):
+    """JSON with one line per list item, so a shrunk case can be pasted back into ``check_*``."""
+    lines = ["{"]
+    for i, (field, value) in enumerate(case.items()):
+        end = "," if i < len(case) - 1 else ""
+        items = [json.dumps(x, ensure_ascii=False) for x in value]
+        lines.append(f' "{field}": [' + ("\n  " + ",\n  ".join(items) + "\n ]" if items else "]") + end)
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def run(cases=200, seed=0, only=None):
+    app = load_app()
+    failures = 0
+    for name, (gen, check) in PROPERTIES.items():
+        if only and name not in only:
+            continue
+        rng = random.Random(f"{seed}:{name}")
+        started = time.perf_counter()
+        for i in range(cases):
+            case = gen(rng, size=1 + i * 3 // max(cases, 1))
+            failure = check(case, app)
+            if failure:
+                failures += 1
+                small = shrink(case, check, app, failure[0])
+                print(f"FAIL {name} case {i}: {check(small, app) or failure}")
+                print(format_case(small))
+                break
+        else:
+            print(f"ok   {name}: {cases} cases in {time.perf_counter() - started:.2f}s")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Differential test of optimised scheduling logic against the reference")
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", choices=sorted(PROPERTIES))
+    args = parser.parse_args(argv)
+    sys.exit(1 if run(args.cases, args.seed, args.only) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Shared facilities (science labs, gym, computer room) that slots can book.
+
+Classrooms are homerooms; the optional ``Facilities`` worksheet lists the
+rooms every class shares, with a capacity = how many classes can use it in
+the same period (a gym with two courts is 2)::
+
+    สถานที่              ความจุ
+    ห้องปฏิบัติการวิทย์ 1   1
+    โรงยิม               2
+
+A slot books a facility through its optional ``facility`` field (the
+Facility column of the Schedule worksheet); a slot without one is taught in
+its homeroom and never conflicts. Occupancy is indexed by (facility, day,
+period): the editor fills the one-day slice in the same pass that finds
+double-booked teachers (``rules.day_occupancy``), and ``occupancy`` builds
+the whole week for the overview.
+"""
+FACILITY_SHEET = "Facilities"
+FACILITY_HEADERS = ["สถานที่", "ความจุ"]
+
+
+def capacities_from_records(records):
+    """{facility: capacity} in sheet order; an empty or invalid capacity counts as 1."""
+    capacities = {}
+    for rec in records:
+        name = str(rec.get(FACILITY_HEADERS[0], '')).strip()
+        if not name:
+            continue
+        try:
+            capacity = int(float(rec.get(FACILITY_HEADERS[1]) or 1))
+        except (TypeError, ValueError):
+            capacity = 1
+        capacities[name] = max(1, capacity)
+    return capacities
+
+
+def capacity_of(capacities, facility):
+    # A facility removed from the sheet but still booked keeps the strictest capacity
+    return capacities.get(facility, 1)
+
+
+def occupancy(schedule, days, rooms=None, symbols=None):
+    """{(facility, day, period): [(room, program)]} over the given rooms (default: all); facility is an ID of ``symbols`` when given."""
+    key = symbols.id if symbols is not None else None
+    index = {}
+    for r in (rooms if rooms is not None else schedule):
+        if r not in schedule:
+            continue
+        for d in days:
+            for p, slots in schedule[r][d].items():
+                for s in slots:
+                    if s.get('facility'):
+                        index.setdefault((key(s['facility']) if key else s['facility'], d, p), []).append((r, s.get('program', 'รวมทุกสาย')))
+    return index
+
+
+def over_capacity(index, capacities):
+    """[(facility, day, period, [(room, program)], capacity)] for every booking past capacity."""
+    return [(f, d, p, users, capacity_of(capacities, f))
+            for (f, d, p), users in index.items() if len(users) > capacity_of(capacities, f)]
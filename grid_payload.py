@@ -0,0 +1,48 @@
+"""
+Compact, dictionary-encoded payload for the master-grid browser component.
+
+Teacher, subject, program and facility strings are sent once in lookup tables and
+every slot refers to them by index, so a level of 13 rooms × 5 days ×
+9 periods is a few kB of JSON instead of a fully styled HTML table.
+The lookup tables are fresh SymbolTables per payload, so IDs are dense and
+the output is deterministic for the same data, which lets Streamlit's
+message cache recognise an unchanged grid between reruns.
+"""
+from symbols import SymbolTable
+
+
+def encode_master_grid(room_list, schedule, room_programs, days, periods, breaks):
+    """
+    {"days", "periods": [[p, time]], "breaks": {p: label}, "t", "s", "g", "f": lookup
+    tables, "rooms": [[room, program, cells]]} where ``cells`` has one entry per
+    (day, period) in day-major order: 0 for an empty cell, otherwise a flat list
+    [teacher_id, subject_id, program_id, facility_id, ...] with four ids per slot.
+    Facility id 0 is "" (taught in the homeroom).
+    """
+    teachers, subjects, programs, facilities = SymbolTable(), SymbolTable(), SymbolTable(), SymbolTable()
+    facilities.id("")
+    rooms = []
+    for r in room_list:
+        cells = []
+        for d in days:
+            for p in periods:
+                slots = schedule.get(r, {}).get(d, {}).get(p, [])
+                if not slots:
+                    cells.append(0)
+                    continue
+                flat = []
+                for s in slots:
+                    flat += [teachers.id(s['teacher']), subjects.id(s['subject']), programs.id(s.get('program', 'รวมทุกสาย')),
+                             facilities.id(s.get('facility', ''))]
+                cells.append(flat)
+        rooms.append([str(r), str(room_programs.get(r, "-")), cells])
+    return {
+        "days": list(days),
+        "periods": [[p, periods[p]] for p in periods],
+        "breaks": {str(p): label for p, label in breaks.items()},
+        "t": list(teachers),
+        "s": list(subjects),
+        "g": list(programs),
+        "f": list(facilities),
+        "rooms": rooms,
+    }
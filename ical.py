@@ -0,0 +1,218 @@
+"""
+iCalendar (.ics) feeds per teacher and per room.
+
+Every slot becomes a weekly recurring event from the first matching weekday
+on or after the term start until the term end, with times taken from
+that day's bell schedule (``day_times``: {day: {period: time}}). ``IcsBuilder`` keeps a content hash per entity (the entity's
+slots plus the term and bell schedule) for each term and only rebuilds the
+calendars whose hash changed since the previous build of that term.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta, timezone
+
+from rules import split_teachers
+
+THAI_WEEKDAYS = {"จันทร์": 0, "อังคาร": 1, "พุธ": 2, "พฤหัสบดี": 3, "ศุกร์": 4, "เสาร์": 5, "อาทิตย์": 6}
+RRULE_DAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+TZID = "Asia/Bangkok"
+TZ_OFFSET = timedelta(hours=7)  # no DST in Thailand
+PRODID = "-//school-scheduler//TH"
+
+
+def _escape(text):
+    return (str(text).replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+
+def _fold(line):
+    # RFC 5545: lines longer than 75 octets continue on the next line after a space
+    raw = line.encode("utf-8")
+    if len(raw) <= 75:
+        return line
+    parts, start = [], 0
+    while start < len(raw):
+        end = min(len(raw), start + (75 if not parts else 74))
+        while end < len(raw) and (raw[end] & 0xC0) == 0x80:
+            end -= 1  # don't cut inside a UTF-8 sequence
+        parts.append(raw[start:end].decode("utf-8"))
+        start = end
+    return "\r\n ".join(parts)
+
+
+def _local(dt):
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+
+def _time_of(text):
+    h, m = text.strip().split(".")
+    return int(h), int(m)
+
+
+def entity_slots(state):
+    """{("teacher"|"room", name): sorted [(day, period, program, room, teacher, subject, facility)]} from ``schedule_state``."""
+    entities = {}
+    for (r, d, p, prog), (teacher, subject, facility) in state.items():
+        item = (d, p, prog, r, teacher, subject, facility)
+        entities.setdefault(("room", r), []).append(item)
+        for t in split_teachers(teacher):
+            if t and t != "-- ล็อค --":
+                entities.setdefault(("teacher", t), []).append(item)
+    for items in entities.values():
+        items.sort()
+    return entities
+
+
+def content_hash(items, term_start, term_end, day_times):
+    bell = sorted((d, sorted(times.items())) for d, times in day_times.items())
+    payload = json.dumps([items, str(term_start), str(term_end), bell],
+                         ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def build_calendar(kind, name, items, day_times, term_start, term_end, stamp=None):
+    stamp = (stamp or datetime.now(timezone.utc)).strftime("%Y%m%dT%H%M%SZ")
+    until = (datetime.combine(term_end, time(23, 59, 59)) - TZ_OFFSET).strftime("%Y%m%dT%H%M%SZ")
+    lines = [
+        "BEGIN:VCALENDAR", "VERSION:2.0", f"PRODID:{PRODID}", "CALSCALE:GREGORIAN", "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{_escape(('ครู ' if kind == 'teacher' else 'ห้อง ') + name)}",
+        f"X-WR-TIMEZONE:{TZID}",
+        "BEGIN:VTIMEZONE", f"TZID:{TZID}",
+        "BEGIN:STANDARD", "DTSTART:19700101T000000", "TZOFFSETFROM:+0700", "TZOFFSETTO:+0700", "TZNAME:+07",
+        "END:STANDARD", "END:VTIMEZONE",
+    ]
+    for d, p, prog, room, teacher, subject, facility in items:
+        weekday = THAI_WEEKDAYS.get(d)
+        periods = day_times.get(d, {})
+        if weekday is None or p not in periods:
+            continue
+        first = term_start + timedelta(days=(weekday - term_start.weekday()) % 7)
+        if first > term_end:
+            continue
+        start_text, end_text = periods[p].split("-")
+        start = datetime.combine(first, time(*_time_of(start_text)))
+        end = datetime.combine(first, time(*_time_of(end_text)))
+        program = "" if prog == "รวมทุกสาย" else f" ({prog})"
+        summary = f"{subject or teacher} - {room}{program}" if kind == "teacher" else f"{subject or teacher}{program}"
+        uid = hashlib.sha1(f"{kind}|{name}|{d}|{p}|{prog}|{room}".encode("utf-8")).hexdigest()
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{uid}@school-scheduler",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART;TZID={TZID}:{_local(start)}",
+            f"DTEND;TZID={TZID}:{_local(end)}",
+            f"RRULE:FREQ=WEEKLY;BYDAY={RRULE_DAYS[weekday]};UNTIL={until}",
+            f"SUMMARY:{_escape(summary)}",
+            f"LOCATION:{_escape(f'{facility} ({room})' if facility else room)}",
+            f"DESCRIPTION:{_escape(f'คาบ {p} ({periods[p]}) ครู {teacher}')}",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(_fold(line) for line in lines) + "\r\n"
+
+
+def safe_filename(name):
+    return "".join("-" if c in '/\\:*?"<>|' else "_" if c.isspace() else c for c in name).strip(".") or "_"
+
+
+class TermCalendars:
+    """
+    The last build of every calendar for one term. ``build()`` re-hashes
+    each entity and regenerates only those whose hash changed; calendars of
+    entities that disappeared are dropped. With ``out_dir`` the changed
+    files are also written to ``out_dir/<kind>/<name>.ics``.
+    """
+
+    def __init__(self, term_start, term_end, out_dir=None):
+        self.term_start = term_start
+        self.term_end = term_end
+        self.out_dir = out_dir
+        self.hashes = {}
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def build(self, state, day_times):
+        with self._lock:
+            entities = entity_slots(state)
+            changed = []
+            for key, items in entities.items():
+                h = content_hash(items, self.term_start, self.term_end, day_times)
+                if self.hashes.get(key) == h:
+                    continue
+                self.files[key] = build_calendar(key[0], key[1], items, day_times, self.term_start, self.term_end)
+                self.hashes[key] = h
+                changed.append(key)
+                if self.out_dir:
+                    self._write(key)
+            for key in [k for k in self.files if k not in entities]:
+                del self.files[key]
+                del self.hashes[key]
+                if self.out_dir:
+                    path = self.path_of(key)
+                    if os.path.exists(path):
+                        os.remove(path)
+            return changed
+
+    def path_of(self, key):
+        return os.path.join(self.out_dir, key[0], safe_filename(key[1]) + ".ics")
+
+    def _write(self, key):
+        path = self.path_of(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(self.files[key])
+
+    def calendar(self, kind, name):
+        return self.files.get((kind, name))
+
+
+class IcsBuilder:
+    """
+    One ``TermCalendars`` per (term start, term end), so sessions that pick
+    different term dates don't invalidate each other's hashes. Only the
+    ``max_terms`` most recently built terms are kept; with ``out_dir`` each
+    term writes under ``out_dir/<start>_<end>/``.
+    """
+
+    def __init__(self, out_dir=None, max_terms=4):
+        self.out_dir = out_dir
+        self.max_terms = max_terms
+        self.terms = OrderedDict()
+        self.builds = 0
+        self.regenerated = 0
+        self._lock = threading.Lock()
+
+    def term(self, term_start, term_end):
+        if isinstance(term_start, datetime):
+            term_start = term_start.date()
+        if isinstance(term_end, datetime):
+            term_end = term_end.date()
+        key = (term_start, term_end)
+        with self._lock:
+            calendars = self.terms.get(key)
+            if calendars is None:
+                out_dir = os.path.join(self.out_dir, f"{term_start:%Y%m%d}_{term_end:%Y%m%d}") if self.out_dir else None
+                calendars = self.terms[key] = TermCalendars(term_start, term_end, out_dir)
+                while len(self.terms) > self.max_terms:
+                    self.terms.popitem(last=False)
+            self.terms.move_to_end(key)
+            return calendars
+
+    def build(self, state, day_times, term_start, term_end):
+        """Build the calendars of one term; returns (its TermCalendars, keys regenerated)."""
+        calendars = self.term(term_start, term_end)
+        changed = calendars.build(state, day_times)
+        with self._lock:
+            self.builds += 1
+            self.regenerated += len(changed)
+        return calendars, changed
+
+
+def default_term(today=None):
+    # About a 20-week term starting on this week's Monday
+    today = today or date.today()
+    start = today - timedelta(days=today.weekday())
+    return start, start + timedelta(weeks=20) - timedelta(days=3)
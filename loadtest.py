@@ -0,0 +1,410 @@
+"""
+End-to-end load test: N concurrent sessions driving app.py headlessly.
+
+    python loadtest.py                                  # 8 sessions, 12 rooms
+    python loadtest.py --sessions 32 --rooms 40 --latency 0.15
+    python loadtest.py --json baseline.json             # also write the numbers
+    python loadtest.py --compare baseline.json          # exit 1 on a regression
+
+Each session is a Streamlit ``AppTest`` running the real app.py against the
+in-memory fake Sheets backend (``SCHEDULER_FAKE_SHEETS``), seeded with a
+generated school in a temporary directory. AppTest swaps process-wide
+globals (runtime, config) on every run, so two sessions cannot rerun in one
+process at the same time; every session therefore runs in its own worker
+process, driven over a pipe, and the reruns of different sessions really
+overlap, backend waits included. The price is that sessions don't share
+server-side caches (tenant services, compiled bell, cached renders) or the
+fake backend: each worker is one warmed-up server process with its own
+copy of the seeded school and its own local cache file.
+
+Flows, in order; every session runs a flow at the same time and the next
+flow starts when all sessions are done:
+
+    open       first page load (master view)
+    master     switch the level shown in the master view
+    edit       editor: pick the session's room and a day, put one teacher in
+               periods 1-3, save, confirm the marathon warning
+    reports    open the report page
+    dashboard  open the dashboard
+
+Per flow it reports the rerun latency (p50/p95/max over every ``run()`` of
+every session), the peak RSS of the largest worker process and of all of
+them together while the flow ran, and the fake backend calls made, total
+and per session. ``--latency`` adds a delay to every backend call so
+reruns that reach Sheets cost what they would in production. Each worker
+loads the app untimed before the first flow unless ``--warmup 0``.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+
+from school_config import DAYS, PERIODS, SHEET_NAME
+from sheets_client import FakeSheetsClient
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+FLOWS = ("open", "master", "edit", "reports", "dashboard")
+PAGES = {
+    "master": "1. 🗓️ ตารางเรียนรวม (Master View)",
+    "edit": "2. 📅 จัดตารางสอน",
+    "reports": "5. 🖨️ ระบบรายงาน",
+    "dashboard": "6. 📊 Dashboard สรุปยอด",
+}
+LEVELS = ["ป.1", "ป.2", "ป.3", "ป.4", "ป.5", "ป.6", "ม.1", "ม.2", "ม.3"]
+SUBJECTS = ["คณิตศาสตร์", "วิทยาศาสตร์", "ภาษาไทย", "ภาษาอังกฤษ", "สังคมศึกษา", "ศิลปะ", "พลศึกษา"]
+PROGRAMS = ["IEP", "IEP, SMEP", "EEP, TEP", "-"]
+
+
+# --- fake school ---
+
+def make_seed(rooms, teachers, fill=0.6, seed=0):
+    """Fake-backend seed: {spreadsheet: {worksheet: rows}} for a school without double bookings."""
+    rng = random.Random(seed)
+    # Four rooms per level, then a second round of rooms 5-8 and so on
+    room_names = []
+    for i in range(rooms):
+        round_, slot = divmod(i, 4 * len(LEVELS))
+        room_names.append(f"{LEVELS[slot // 4]}/{round_ * 4 + slot % 4 + 1}")
+    teacher_rows = [[f"ครู{i:03d} ใจดี", SUBJECTS[i % len(SUBJECTS)],
+                     ", ".join(rng.sample(room_names, min(4, len(room_names)))) if i % 3 == 0 else "-"]
+                    for i in range(teachers)]
+    schedule, busy = [], set()
+    for r in room_names:
+        for d in DAYS:
+            for p in PERIODS:
+                if rng.random() > fill:
+                    continue
+                t = rng.choice(teacher_rows)
+                if (t[0], d, p) not in busy:
+                    busy.add((t[0], d, p))
+                    schedule.append([r, d, p, t[0], t[1], "รวมทุกสาย"])
+    return {SHEET_NAME: {
+        "Teachers": [["ชื่อ-สกุล", "วิชาที่สอน", "ระดับชั้นที่สอน"]] + teacher_rows,
+        "Classrooms": [["ห้องเรียน", "สายการเรียน"]] + [[r, PROGRAMS[i % len(PROGRAMS)]] for i, r in enumerate(room_names)],
+        "Schedule": [["Room", "Day", "Period", "Teacher", "Subject", "Program"]] + schedule,
+    }}, room_names
+
+
+# --- measurements ---
+
+class BackendCounter:
+    """Counts every fake backend call by method, whichever session or worker thread makes it."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def install(self):
+        original = FakeSheetsClient._hit
+        counter = self
+
+        def _hit(client, name):
+            with counter._lock:
+                counter.calls[name] += 1
+            return original(client, name)
+        FakeSheetsClient._hit = _hit
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+
+class RssSampler(threading.Thread):
+    """Samples the process RSS every ``interval`` seconds; ``take_peak()`` returns and resets the peak."""
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.page = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.peak = self.current()
+        self._lock = threading.Lock()
+
+    def current(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self.page
+        except OSError:
+            # No /proc (macOS): the lifetime peak is the best available
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def run(self):
+        while True:
+            rss = self.current()
+            with self._lock:
+                self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+    def take_peak(self):
+        with self._lock:
+            peak, self.peak = max(self.peak, self.current()), self.current()
+        return peak
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)] if ordered else 0.0
+
+
+# --- sessions ---
+
+class Session:
+    def __init__(self, index, room, timeout):
+        from streamlit.testing.v1 import AppTest
+        self.index = index
+        self.room = room
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.timings = {}
+        self.errors = []
+        self.confirmed = False
+
+    def _rerun(self, flow, step):
+        started = time.perf_counter()
+        step()
+        self.timings.setdefault(flow, []).append(time.perf_counter() - started)
+        for exc in self.at.exception:
+            self.errors.append(f"session {self.index} {flow}: {exc.message}")
+
+    def _goto(self, flow):
+        self._rerun(flow, lambda: self.at.sidebar.radio[0].set_value(PAGES[flow]).run())
+
+    def _selectbox(self, label):
+        return next((s for s in self.at.selectbox if s.label == label), None)
+
+    def open(self):
+        self._rerun("open", self.at.run)
+
+    def master(self):
+        self._goto("master")
+        levels = self._selectbox("เลือกระดับชั้นที่ต้องการดู:")
+        if levels is not None and len(levels.options) > 1:
+            other = levels.options[(self.index + 1) % len(levels.options)]
+            self._rerun("master", lambda: levels.set_value(other).run())
+
+    def edit(self):
+        self._goto("edit")
+        room = self._selectbox("เลือกห้องเรียน:")
+        if room is not None and self.room in room.options:
+            self._rerun("edit", lambda: room.set_value(self.room).run())
+        day = self._selectbox("1. เลือกวันที่จะแก้ไข:")
+        if day is not None:
+            target = DAYS[self.index % len(DAYS)]
+            self._rerun("edit", lambda: day.set_value(target).run())
+        # One teacher free in periods 1-3 of that day -> marathon warning -> confirm
+        boxes = [next((m for m in self.at.multiselect if m.key == f"sel_{p}"), None) for p in (1, 2, 3)]
+        if any(b is None for b in boxes):
+            return
+        free = set(o for o in boxes[0].options if "ติดสอน" not in o)
+        for b in boxes[1:]:
+            free &= set(b.options)
+        if not free:
+            return
+        teacher = sorted(free)[self.index % len(free)]
+        for b in boxes:
+            b.set_value([teacher])
+        save = next((b for b in self.at.button if "บันทึกตารางวันนี้" in str(b.label)), None)
+        if save is None:
+            return
+        self._rerun("edit", lambda: save.click().run())
+        confirm = next((b for b in self.at.button if "ยืนยันการบันทึก" in str(b.label)), None)
+        if confirm is not None:
+            self._rerun("edit", lambda: confirm.click().run())
+            self.confirmed = True
+
+    def reports(self):
+        self._goto("reports")
+
+    def dashboard(self):
+        self._goto("dashboard")
+
+
+# --- driver ---
+
+def setup_environment(workdir, rooms, teachers, latency):
+    seed, room_names = make_seed(rooms, teachers)
+    seed_path = os.path.join(workdir, "seed.json")
+    with open(seed_path, "w", encoding="utf-8") as f:
+        json.dump(seed, f, ensure_ascii=False)
+    os.environ.update(SCHEDULER_FAKE_SHEETS=seed_path, SCHEDULER_FAKE_LATENCY=str(latency),
+                      SCHEDULER_CACHE_PATH=os.path.join(workdir, "cache.sqlite3"),
+                      SCHEDULER_ICS_DIR=os.path.join(workdir, "ics"))
+    os.environ.pop("SCHEDULER_TENANTS", None)
+    return room_names
+
+
+def worker(index, room, warmup, timeout, conn):
+    """One session in its own process: answers each flow name from ``conn`` with that flow's numbers, stops on None."""
+    try:
+        # Own local cache file: the fake backend behind it is this process's own copy
+        os.environ["SCHEDULER_CACHE_PATH"] = os.path.join(os.environ["LOADTEST_WORKDIR"], f"cache-{index}.sqlite3")
+        counter, sampler = BackendCounter(), RssSampler()
+        counter.install()
+        for i in range(warmup):
+            Session(-1 - i, room, timeout).open()
+        session = Session(index, room, timeout)
+        sampler.start()
+        conn.send({"baseline_rss": sampler.current()})
+        while True:
+            flow = conn.recv()
+            if flow is None:
+                break
+            before, seen = counter.snapshot(), len(session.errors)
+            sampler.take_peak()
+            getattr(session, flow)()
+            conn.send({"timings": session.timings.get(flow, []), "peak_rss": sampler.take_peak(),
+                       "calls": dict(counter.snapshot() - before), "errors": session.errors[seen:],
+                       "confirmed": session.confirmed})
+    except Exception:
+        conn.send({"crashed": traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def run(sessions=8, rooms=12, teachers=30, latency=0.0, warmup=1, timeout=120):
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        room_names = setup_environment(workdir, rooms, teachers, latency)
+        os.environ["LOADTEST_WORKDIR"] = workdir
+        workers = []
+        for i in range(sessions):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=worker, args=(i, room_names[i % len(room_names)], warmup, timeout, child), daemon=True)
+            proc.start()
+            child.close()
+            workers.append((proc, parent))
+        errors, crashed, confirmed = [], set(), [False] * sessions
+
+        def collect():
+            # Every live worker's answer to the last message; doubles as the barrier between flows
+            answers = []
+            for i, (_, conn) in enumerate(workers):
+                if i in crashed:
+                    continue
+                try:
+                    answer = conn.recv()
+                except EOFError:
+                    answer = {"crashed": "worker exited"}
+                if "crashed" in answer:
+                    crashed.add(i)
+                    errors.append(f"session {i} crashed: {answer['crashed'].strip().splitlines()[-1]}")
+                    continue
+                answers.append((i, answer))
+            return answers
+
+        ready = collect()
+        report = {"config": {"sessions": sessions, "rooms": rooms, "teachers": teachers, "latency": latency,
+                             "warmup": warmup},
+                  "baseline_rss_mb": max((a["baseline_rss"] for _, a in ready), default=0) / 2 ** 20, "flows": {}}
+        started = time.perf_counter()
+        try:
+            for flow in FLOWS:
+                flow_started = time.perf_counter()
+                for i, (_, conn) in enumerate(workers):
+                    if i not in crashed:
+                        conn.send(flow)
+                answers = collect()
+                timings = [t for _, a in answers for t in a["timings"]]
+                calls = sum((Counter(a["calls"]) for _, a in answers), Counter())
+                for i, a in answers:
+                    errors.extend(a["errors"])
+                    confirmed[i] = a["confirmed"]
+                report["flows"][flow] = {
+                    "reruns": len(timings),
+                    "p50_ms": percentile(timings, 0.50) * 1000,
+                    "p95_ms": percentile(timings, 0.95) * 1000,
+                    "max_ms": max(timings, default=0.0) * 1000,
+                    "wall_s": time.perf_counter() - flow_started,
+                    "peak_rss_mb": max((a["peak_rss"] for _, a in answers), default=0) / 2 ** 20,
+                    "total_rss_mb": sum(a["peak_rss"] for _, a in answers) / 2 ** 20,
+                    "backend_calls": dict(sorted(calls.items())),
+                    "calls_per_session": sum(calls.values()) / sessions,
+                }
+        finally:
+            for i, (proc, conn) in enumerate(workers):
+                if i not in crashed:
+                    conn.send(None)
+                proc.join(timeout)
+                if proc.is_alive():
+                    proc.terminate()
+        report["wall_s"] = time.perf_counter() - started
+        report["peak_rss_mb"] = max((f["peak_rss_mb"] for f in report["flows"].values()), default=0)
+        report["total_rss_mb"] = max((f["total_rss_mb"] for f in report["flows"].values()), default=0)
+        report["confirmed_edits"] = sum(confirmed)
+        report["errors"] = errors
+    return report
+
+
+def format_report(report):
+    c = report["config"]
+    lines = [f"{c['sessions']} sessions, {c['rooms']} rooms, {c['teachers']} teachers, "
+             f"backend latency {c['latency'] * 1000:.0f} ms/call",
+             f"{'flow':<10} {'reruns':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'RSS MB':>7} {'all MB':>7} {'calls':>6} {'/session':>8}"]
+    for flow, f in report["flows"].items():
+        lines.append(f"{flow:<10} {f['reruns']:>6} {f['p50_ms']:>8.0f} {f['p95_ms']:>8.0f} {f['max_ms']:>8.0f} "
+                     f"{f['peak_rss_mb']:>7.0f} {f['total_rss_mb']:>7.0f} {sum(f['backend_calls'].values()):>6} {f['calls_per_session']:>8.1f}")
+    for flow, f in report["flows"].items():
+        if f["backend_calls"]:
+            lines.append(f"  {flow}: " + ", ".join(f"{k}={v}" for k, v in f["backend_calls"].items()))
+    lines.append(f"wall {report['wall_s']:.1f}s, peak RSS {report['peak_rss_mb']:.0f} MB per process, "
+                 f"{report['total_rss_mb']:.0f} MB all processes (after warm-up {report['baseline_rss_mb']:.0f} MB), "
+                 f"marathon confirmed in {report['confirmed_edits']}/{c['sessions']} sessions")
+    for e in report["errors"][:10]:
+        lines.append(f"ERROR {e}")
+    return "\n".join(lines)
+
+
+def compare(report, baseline, tolerance):
+    """Regressions against an earlier ``--json`` report: slower p95, more RSS or more backend calls per session."""
+    problems = []
+    for flow, f in report["flows"].items():
+        base = baseline.get("flows", {}).get(flow)
+        if not base:
+            continue
+        if f["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{flow}: p95 {f['p95_ms']:.0f} ms vs {base['p95_ms']:.0f} ms")
+        if f["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            problems.append(f"{flow}: peak RSS {f['peak_rss_mb']:.0f} MB vs {base['peak_rss_mb']:.0f} MB")
+        if f["calls_per_session"] > base["calls_per_session"] + 0.5:
+            problems.append(f"{flow}: {f['calls_per_session']:.1f} backend calls/session vs {base['calls_per_session']:.1f}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent-session load test of app.py against the fake Sheets backend")
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--rooms", type=int, default=12)
+    parser.add_argument("--teachers", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every backend call")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed page loads before the sessions start")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed per rerun")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="earlier --json report; exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95/RSS growth for --compare")
+    args = parser.parse_args(argv)
+
+    report = run(args.sessions, args.rooms, args.teachers, args.latency, args.warmup, args.timeout)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+    failed = bool(report["errors"])
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        for p in problems:
+            print(f"REGRESSION {p}")
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
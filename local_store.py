@@ -0,0 +1,315 @@
+"""
+On-disk cache of the last good dataset plus a queue of edits not yet pushed.
+
+The cache is a small SQLite file holding the raw cell values of each
+worksheet as zlib-compressed JSON, so the app can render from disk
+immediately and keep working while Google Sheets is unreachable. Edits are
+written to the ``pending`` table first and removed only after they reached
+the spreadsheet; ``SyncWorker`` retries them in the background until the
+connection is back.
+
+``SyncWorker.poll`` keeps the copy near-live cheaply: it reads the
+per-worksheet versions from the ``Meta`` worksheet (one small request) and
+re-reads only the worksheets whose version moved since the last read, and
+for the journal only the rows appended after the ones already read.
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+from bell_schedule import BELL_SHEET
+from facilities import FACILITY_SHEET
+from schedule_store import (SNAPSHOT_SHEET, JOURNAL_SHEET, JOURNAL_HEADERS, current_journal, fold_journal)
+from sheets_client import META_SHEET, meta_from_values, rows_to_records
+
+DATASET_SHEETS = ["Teachers", "Classrooms", SNAPSHOT_SHEET, JOURNAL_SHEET, BELL_SHEET, FACILITY_SHEET]
+
+
+_STORE_LOCKS = {}
+_STORE_LOCKS_GUARD = threading.Lock()
+
+
+def store_lock(path):
+    """One lock per cache file in this process, shared by every SyncWorker on it."""
+    with _STORE_LOCKS_GUARD:
+        return _STORE_LOCKS.setdefault(os.path.abspath(path), threading.RLock())
+
+
+def _pack(obj):
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+def _unpack(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class LocalStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS dataset (title TEXT PRIMARY KEY, cells BLOB NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "kind TEXT NOT NULL, title TEXT NOT NULL, cells BLOB NOT NULL)"
+            )
+
+    # --- last good dataset ---
+    def save_dataset(self, values):
+        with self._lock, self._db:
+            for title, rows in values.items():
+                self._db.execute("INSERT OR REPLACE INTO dataset VALUES (?, ?)", (title, _pack(rows)))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('saved_at', ?)", (repr(time.time()),))
+
+    def load_dataset(self):
+        with self._lock:
+            rows = self._db.execute("SELECT title, cells FROM dataset").fetchall()
+        if not rows:
+            return None
+        values = {t: [] for t in DATASET_SHEETS}
+        values.update({t: _unpack(c) for t, c in rows})
+        return values
+
+    def saved_at(self):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'saved_at'").fetchone()
+        return float(row[0]) if row else 0.0
+
+    # --- what the cached copy was read at ---
+    def remote_state(self):
+        """(versions {title: (version, epoch)}, journal rows read incl. header) of the last read."""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'remote'").fetchone()
+        if not row:
+            return {}, 0
+        state = json.loads(row[0])
+        return {t: tuple(v) for t, v in state["versions"].items()}, state["journal_rows"]
+
+    def set_remote_state(self, versions, journal_rows):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('remote', ?)",
+                             (json.dumps({"versions": versions, "journal_rows": journal_rows}, ensure_ascii=False),))
+
+    # --- pending edits ---
+    def enqueue(self, kind, title, rows):
+        """kind is 'append' (journal rows) or 'replace' (whole worksheet)."""
+        with self._lock, self._db:
+            if kind == "replace":
+                # Only the newest replacement of a worksheet matters
+                self._db.execute("DELETE FROM pending WHERE kind = 'replace' AND title = ?", (title,))
+            self._db.execute("INSERT INTO pending (kind, title, cells) VALUES (?, ?, ?)", (kind, title, _pack(rows)))
+
+    def pending(self):
+        with self._lock:
+            rows = self._db.execute("SELECT id, kind, title, cells FROM pending ORDER BY id").fetchall()
+        return [(i, kind, title, _unpack(c)) for i, kind, title, c in rows]
+
+    def pending_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def mark_pushed(self, item_id, kind, title, rows):
+        # Drop the queue entry and fold it into the cached copy in one transaction
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM pending WHERE id = ?", (item_id,))
+            row = self._db.execute("SELECT cells FROM dataset WHERE title = ?", (title,)).fetchone()
+            cached = _unpack(row[0]) if row else []
+            if kind == "append":
+                cached = (cached or [list(JOURNAL_HEADERS)]) + [[str(c) for c in r] for r in rows]
+            else:
+                cached = rows
+            self._db.execute("INSERT OR REPLACE INTO dataset VALUES (?, ?)", (title, _pack(cached)))
+
+
+def apply_pending(values, pending):
+    """Cached worksheet values with the not-yet-pushed edits laid on top."""
+    values = dict(values)
+    for _, kind, title, rows in pending:
+        if kind == "append":
+            values[title] = (values.get(title) or [list(JOURNAL_HEADERS)]) + [[str(c) for c in r] for r in rows]
+        else:
+            values[title] = rows
+    return values
+
+
+class SyncWorker:
+    """
+    Pushes the pending queue to the spreadsheet. ``sync_now()`` tries once in
+    the caller's thread; when that fails ``start()`` keeps retrying in a
+    daemon thread with jittered backoff. Before pushing edits that were made
+    offline it re-reads the spreadsheet and counts slots whose remote value
+    no longer matches the edit's old value (the offline edit still wins).
+
+    Pushes are serialised on the cache file (``store_lock``), not on the
+    worker: a worker created again for the same file (e.g. after its school
+    was evicted and reopened) waits for the old one and then finds the
+    items it already pushed gone from the queue. ``stop()`` ends the retry
+    thread; the queue stays on disk for the next worker.
+    """
+
+    def __init__(self, store, gateway, journal, base_delay=5.0, max_delay=120.0):
+        self.store = store
+        self.gateway = gateway
+        self.journal = journal
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.online = True
+        self.last_error = None
+        self.conflicts = []
+        self.last_poll = None      # (time, titles re-read) of the last poll that found changes
+        self._lock = store_lock(store.path)
+        self._stop = threading.Event()
+        self._thread = None
+        self._poll_lock = threading.Lock()
+        self._polled_at = 0.0
+
+    def refresh(self):
+        # Serialised with pushes so a slow read can't overwrite rows pushed meanwhile
+        with self._lock:
+            values = self.gateway.read_values([META_SHEET] + DATASET_SHEETS)
+            versions = meta_from_values(values.pop(META_SHEET))
+            self.store.save_dataset(values)
+            self.store.set_remote_state(versions, len(values[JOURNAL_SHEET]))
+            self.journal.observe(values[JOURNAL_SHEET])
+            return values
+
+    def poll(self):
+        """Re-read what changed remotely since the last read; returns the titles re-read ([] = nothing changed)."""
+        with self._lock:
+            versions = self.gateway.read_meta()
+            seen, journal_rows = self.store.remote_state()
+            changed = [t for t in DATASET_SHEETS if versions.get(t) != seen.get(t)]
+            if not changed:
+                return []
+            cached = self.store.load_dataset() or {}
+            # Same epoch = rows were only appended since, so the rows already read are still in place.
+            # Rows this process pushed meanwhile sit after them in the cached copy and come back in the tail.
+            tail_only = (JOURNAL_SHEET in changed and SNAPSHOT_SHEET not in changed and journal_rows
+                         and cached.get(JOURNAL_SHEET)
+                         and versions[JOURNAL_SHEET][1] == seen.get(JOURNAL_SHEET, (None, None))[1])
+            full = [t for t in changed if not (tail_only and t == JOURNAL_SHEET)]
+            values = self.gateway.read_values(full) if full else {}
+            if tail_only:
+                tail = self.gateway.read_rows_from(JOURNAL_SHEET, journal_rows + 1)
+                values[JOURNAL_SHEET] = cached[JOURNAL_SHEET][:journal_rows] + tail
+            self.store.save_dataset(values)
+            if JOURNAL_SHEET in values:
+                journal_rows = len(values[JOURNAL_SHEET])
+                self.journal.observe(values[JOURNAL_SHEET])
+            self.store.set_remote_state(versions, journal_rows)
+            self.last_poll = (time.time(), changed)
+            return changed
+
+    def poll_in_background(self, interval):
+        """Start poll() in a daemon thread unless one ran (or is running) in the last ``interval`` seconds."""
+        with self._poll_lock:
+            now = time.monotonic()
+            if now - self._polled_at < interval:
+                return False
+            self._polled_at = now
+
+        def run():
+            try:
+                self.poll()
+                self.online = True
+            except Exception as e:
+                self.last_error = e
+                self.online = False
+                self.start()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    def refresh_in_background(self):
+        def run():
+            try:
+                self.refresh()
+                self.online = True
+            except Exception as e:
+                self.last_error = e
+                self.online = False
+                self.start()
+        threading.Thread(target=run, daemon=True).start()
+
+    def _push(self, reconcile):
+        with self._lock:
+            items = self.store.pending()
+            if not items:
+                return 0
+            if reconcile:
+                self._check_conflicts(items, self.refresh())
+            try:
+                for item_id, kind, title, rows in items:
+                    if kind == "append":
+                        self.journal.append_rows(rows)
+                    else:
+                        self.gateway.replace_table(title, rows)
+                        self.gateway.flush()
+                    self.store.mark_pushed(item_id, kind, title, rows)
+            except Exception:
+                # The durable copy is in the pending table; don't let the gateway resend it too
+                self.gateway.discard_queue()
+                raise
+            return len(items)
+
+    def _check_conflicts(self, items, values):
+        current = {}
+        for row in fold_journal(rows_to_records(values[SNAPSHOT_SHEET]), rows_to_records(current_journal(values[JOURNAL_SHEET])))[1:]:
+            current[(row[0], row[1], int(row[2]), row[5])] = (row[3], row[4], row[6])
+        for _, kind, _, rows in items:
+            if kind != "append":
+                continue
+            for rec in rows_to_records([JOURNAL_HEADERS] + [[str(c) for c in r] for r in rows]):
+                key = (str(rec['Room']), str(rec['Day']), int(rec['Period']), str(rec['Program']))
+                old = (str(rec['OldTeacher']), str(rec['OldSubject']), str(rec['OldFacility'])) if str(rec['OldTeacher']) else None
+                remote = current.get(key)
+                if remote != old:
+                    self.conflicts.append({"slot": key, "remote": remote, "local": rec['NewTeacher']})
+                # Later pending rows for the same slot compare against this one
+                current[key] = (str(rec['NewTeacher']), str(rec['NewSubject']), str(rec['NewFacility'])) if str(rec['NewTeacher']) else None
+
+    def sync_now(self):
+        try:
+            self._push(reconcile=not self.online)
+            self.online = True
+            self.last_error = None
+            return True
+        except Exception as e:
+            self.last_error = e
+            self.online = False
+            self.start()
+            return False
+
+    def start(self):
+        if self._stop.is_set() or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        attempt = 0
+        while self.store.pending_count() or not self.online:
+            if self._stop.wait(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))):
+                return
+            try:
+                self._push(reconcile=True)
+                if not self.store.pending_count():
+                    self.refresh()
+                self.online = True
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+                self.online = False
+                attempt = min(attempt + 1, 10)
+
+    def stop(self, timeout=None):
+        """End the retry thread (after a push in progress, if any); pending edits stay in the store."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
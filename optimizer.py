@@ -0,0 +1,248 @@
+"""
+Local-search optimizer that evens out teaching loads within a subject.
+
+Only the teacher of a slot changes; rooms, days, periods and programs stay
+put, so room occupancy and the program lock rules are untouched. Two move
+types are tried at random:
+
+- reassign: slot of teacher A goes to teacher B of the same subject,
+- swap: A takes one of B's slots and B takes one of A's.
+
+Cost per subject is the squared distance of each teacher's weekly load
+from the subject mean, plus ``day_weight`` times the sum of squared daily
+loads (which prefers spreading a teacher's periods over the week), plus a
+tiny penalty per changed slot so the proposal stays minimal. Every move is
+checked and scored incrementally from per-teacher day bitmasks: a teacher
+must be free, assigned to the room, and the move may not add a rule
+violation (looked up in a precomputed table per day and mask).
+Team-taught slots are left alone.
+"""
+import math
+import random
+import time
+
+from rules import split_teachers, teacher_day_masks
+
+CHURN_PENALTY = 0.01
+
+
+class WorkloadOptimizer:
+    def __init__(self, schedule, teachers, ruleset, days, day_weight=0.5, seed=0):
+        """teachers: list of (name, subject, allowed_rooms or None for any room)."""
+        self.ruleset = ruleset
+        self.days = list(days)
+        self.day_index = {d: i for i, d in enumerate(self.days)}
+        self.day_weight = day_weight
+        self.rng = random.Random(seed)
+
+        self.names = [t[0] for t in teachers]
+        self.tid = {name: i for i, name in enumerate(self.names)}
+        self.allowed = [t[2] for t in teachers]
+        by_subject = {}
+        for name, subject, _ in teachers:
+            if str(subject).strip():
+                by_subject.setdefault(str(subject), []).append(self.tid[name])
+        self.group_of = {}
+        self.groups = []
+        for subject, members in by_subject.items():
+            if len(members) > 1:
+                g = len(self.groups)
+                self.groups.append((subject, members))
+                for t in members:
+                    self.group_of[t] = g
+
+        # Occupancy of every teacher, including slots we can't move
+        all_masks = teacher_day_masks(schedule, ruleset, self.days)
+        self.masks = [[all_masks.get(name, {}).get(d, 0) for d in self.days] for name in self.names]
+        self.week = [sum(m.bit_count() for m in row) for row in self.masks]
+        self.mean = [sum(self.week[t] for t in members) / len(members) for _, members in self.groups]
+
+        # A teacher already double-booked at (day, period) keeps those slots: moving one
+        # away would clear a mask bit the other slot still occupies
+        booked = {}
+        for r in schedule:
+            for d in self.days:
+                for p, cell in schedule[r][d].items():
+                    for s in cell:
+                        for t in split_teachers(s['teacher']):
+                            booked[(t, d, p)] = booked.get((t, d, p), 0) + 1
+
+        # Movable slots: (room, day_idx, period, program, bit), current and original teacher
+        self.slots, self.owner, self.origin = [], [], []
+        for r in schedule:
+            for d in self.days:
+                for p, cell in schedule[r][d].items():
+                    bit = ruleset.bit.get(p)
+                    if bit is None:
+                        continue
+                    for s in cell:
+                        names = split_teachers(s['teacher'])
+                        if len(names) != 1 or names[0] not in self.tid or booked[(names[0], d, p)] > 1:
+                            continue
+                        t = self.tid[names[0]]
+                        if t in self.group_of:
+                            self.slots.append((r, self.day_index[d], p, s.get('program', 'รวมทุกสาย'), bit))
+                            self.owner.append(t)
+                            self.origin.append(t)
+
+        # Rule violations per (day, mask), so a move is checked with a list lookup
+        n = len(ruleset.order)
+        self.violations = [[len(ruleset.check_day("", d, m)) for m in range(1 << n)] for d in self.days]
+        self.week_limit = min((r["limit"] for r in ruleset.rules if r["rule"] == "max_per_week"), default=None)
+
+    # --- cost ---
+    def cost(self):
+        total = 0.0
+        for g, (_, members) in enumerate(self.groups):
+            for t in members:
+                total += (self.week[t] - self.mean[g]) ** 2
+                total += self.day_weight * sum(m.bit_count() ** 2 for m in self.masks[t])
+        total += CHURN_PENALTY * sum(1 for a, b in zip(self.owner, self.origin) if a != b)
+        return total
+
+    def _can_take(self, t, slot_idx, extra_free=(None, 0)):
+        room, d, _, _, bit = self.slots[slot_idx]
+        allowed = self.allowed[t]
+        if allowed is not None and room not in allowed:
+            return False
+        mask = self.masks[t][d]
+        if extra_free[0] == d:
+            mask &= ~extra_free[1]
+        return not mask & bit
+
+    def _delta_move(self, t_from, t_to, d, bit, slot_idx, week_from=0, week_to=0):
+        """Cost change of moving one slot at day d between two teachers of the same group."""
+        g = self.group_of[t_from]
+        mu = self.mean[g]
+        wf, wt = self.week[t_from] + week_from, self.week[t_to] + week_to
+        delta = (1 - 2 * (wf - mu)) + (1 + 2 * (wt - mu))
+        lf, lt = self.masks[t_from][d].bit_count(), self.masks[t_to][d].bit_count()
+        delta += self.day_weight * ((1 - 2 * lf) + (1 + 2 * lt))
+        origin = self.origin[slot_idx]
+        delta += CHURN_PENALTY * ((t_to != origin) - (t_from != origin))
+        return delta
+
+    def _rules_ok(self, t, d, old_mask, new_mask):
+        return self.violations[d][new_mask] <= self.violations[d][old_mask]
+
+    # --- moves ---
+    def _try_reassign(self, i):
+        a = self.owner[i]
+        members = self.groups[self.group_of[a]][1]
+        b = members[self.rng.randrange(len(members))]
+        if b == a or not self._can_take(b, i):
+            return False
+        _, d, _, _, bit = self.slots[i]
+        if self.week_limit is not None and self.week[b] + 1 > self.week_limit:
+            return False
+        new_b = self.masks[b][d] | bit
+        if not self._rules_ok(b, d, self.masks[b][d], new_b):
+            return False
+        new_a = self.masks[a][d] & ~bit
+        if not self._rules_ok(a, d, self.masks[a][d], new_a):
+            return False
+        if self._delta_move(a, b, d, bit, i) >= 0:
+            return False
+        self.masks[a][d], self.masks[b][d] = new_a, new_b
+        self.week[a] -= 1
+        self.week[b] += 1
+        self.owner[i] = b
+        return True
+
+    def _try_swap(self, i, j):
+        a, b = self.owner[i], self.owner[j]
+        if a == b or self.group_of[a] != self.group_of[b]:
+            return False
+        _, di, _, _, bi = self.slots[i]
+        _, dj, _, _, bj = self.slots[j]
+        if di == dj and bi == bj:
+            return False
+        # a gives up i and takes j; b gives up j and takes i
+        if not self._can_take(a, j, (di, bi)) or not self._can_take(b, i, (dj, bj)):
+            return False
+        ma, mb = list(self.masks[a]), list(self.masks[b])
+        ma[di] &= ~bi
+        ma[dj] |= bj
+        mb[dj] &= ~bj
+        mb[di] |= bi
+        for d in {di, dj}:
+            if not self._rules_ok(a, d, self.masks[a][d], ma[d]) or not self._rules_ok(b, d, self.masks[b][d], mb[d]):
+                return False
+        # Weekly loads are unchanged by a swap; only daily loads and churn move
+        old = sum(self.masks[a][d].bit_count() ** 2 + self.masks[b][d].bit_count() ** 2 for d in {di, dj})
+        new = sum(ma[d].bit_count() ** 2 + mb[d].bit_count() ** 2 for d in {di, dj})
+        churn = ((b != self.origin[i]) - (a != self.origin[i])) + ((a != self.origin[j]) - (b != self.origin[j]))
+        if self.day_weight * (new - old) + CHURN_PENALTY * churn >= 0:
+            return False
+        self.masks[a], self.masks[b] = ma, mb
+        self.owner[i], self.owner[j] = b, a
+        return True
+
+    def run(self, iterations=50000, time_limit=None):
+        start = time.perf_counter()
+        cost_before = self.cost()
+        accepted = evaluated = 0
+        n = len(self.slots)
+        if n:
+            for evaluated in range(1, iterations + 1):
+                i = self.rng.randrange(n)
+                if self.rng.random() < 0.5:
+                    ok = self._try_reassign(i)
+                else:
+                    ok = self._try_swap(i, self.rng.randrange(n))
+                accepted += ok
+                if time_limit and not evaluated % 1000 and time.perf_counter() - start > time_limit:
+                    break
+        elapsed = time.perf_counter() - start
+        return {
+            "changes": self.changes(),
+            "cost_before": cost_before,
+            "cost_after": self.cost(),
+            "evaluated": evaluated,
+            "accepted": accepted,
+            "moves_per_second": evaluated / elapsed if elapsed > 0 else math.inf,
+        }
+
+    def changes(self):
+        """[(room, day, period, program, old_teacher, new_teacher)] relative to the input schedule."""
+        return [
+            (r, self.days[d], p, prog, self.names[self.origin[i]], self.names[self.owner[i]])
+            for i, (r, d, p, prog, _) in enumerate(self.slots)
+            if self.owner[i] != self.origin[i]
+        ]
+
+    def loads(self):
+        """{teacher: (original weekly load, proposed weekly load)} for optimised teachers."""
+        original = {}
+        for t in self.group_of:
+            original[t] = self.week[t]
+        for i, t in enumerate(self.owner):
+            if t != self.origin[i]:
+                original[t] -= 1
+                original[self.origin[i]] += 1
+        return {self.names[t]: (original[t], self.week[t]) for t in self.group_of}
+
+
+def apply_changes(schedule, changes):
+    """Write a change set from ``WorkloadOptimizer.changes()`` into the schedule in place."""
+    for r, d, p, prog, old, new in changes:
+        for s in schedule[r][d][p]:
+            if s.get('program', 'รวมทุกสาย') == prog and str(s['teacher']).strip() == old:
+                s['teacher'] = new
+
+
+def double_bookings(schedule, days):
+    """Number of (teacher, day, period) taught in more than one slot."""
+    seen, clashes = set(), 0
+    for r in schedule:
+        for d in days:
+            for p, cell in schedule[r][d].items():
+                for s in cell:
+                    for t in split_teachers(s['teacher']):
+                        if not t or t == "-- ล็อค --":
+                            continue
+                        key = (t, d, p)
+                        if key in seen:
+                            clashes += 1
+                        seen.add(key)
+    return clashes
@@ -0,0 +1,268 @@
+"""
+Declarative teaching-load rules evaluated on per-teacher day bitmasks.
+
+Each teacher's day is an int with one bit per period (bit 0 = first
+period). Rules are plain dicts, compiled once against the bell schedule
+into closures over precomputed masks, so checking every rule for a
+teacher costs a handful of integer operations.
+
+Supported rules::
+
+    {"rule": "max_consecutive", "limit": 2, "min_break_minutes": 30}
+        A break of at least ``min_break_minutes`` ends a run; omit it to
+        treat every period as adjacent to the next one.
+    {"rule": "max_per_day", "limit": 6}
+    {"rule": "max_per_week", "limit": 30}
+    {"rule": "required_free", "periods": [8, 9], "days": ["พุธ"]}
+        ``days`` is optional (default: every day).
+    {"rule": "no_lunch_straddle"}
+        Not both the last period before and the first period after the
+        longest break of the day.
+
+Days with their own bell (``day_periods``) get their own adjacency and
+lunch break; masks use one bit per period of the union of all days, so a
+mask means the same on every day.
+"""
+import sys
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def split_teachers(teacher_str):
+    # Memoised: a schedule has few distinct team strings but splits them in every hot loop.
+    # Interned, so the names are the canonical objects of any SymbolTable.
+    return tuple(sys.intern(x.strip()) for x in str(teacher_str).split(','))
+
+
+def parse_minutes(hhmm):
+    h, m = hhmm.strip().split(".")
+    return int(h) * 60 + int(m)
+
+
+def period_gaps(periods):
+    """{period: (next period, minutes between the end of one and the start of the next)} for one day's bell."""
+    order = sorted(periods)
+    gaps = {}
+    for a, b in zip(order, order[1:]):
+        end_a = parse_minutes(periods[a].split("-")[1])
+        start_b = parse_minutes(periods[b].split("-")[0])
+        gaps[a] = (b, start_b - end_a)
+    return gaps
+
+
+class RuleSet:
+    def __init__(self, rules, periods, day_periods=None):
+        """``day_periods``: {day: {period: time}} for days whose bell differs from ``periods`` (half-days, exam days)."""
+        self.rules = [dict(r) for r in rules]
+        self.order = sorted(set(periods).union(*(day_periods or {}).values()))
+        self.bit = {p: 1 << i for i, p in enumerate(self.order)}
+        self.full = (1 << len(self.order)) - 1
+        self.gaps = period_gaps(periods)
+        self.day_gaps = {d: period_gaps(times) for d, times in (day_periods or {}).items()}
+        self.lunch_after = self.lunch_of(self.gaps)
+        self.day_checks = []
+        self.week_checks = []
+        for rule in self.rules:
+            self._compile(rule)
+
+    # --- mask helpers ---
+    def mask_of(self, periods):
+        m = 0
+        for p in periods:
+            m |= self.bit[p]
+        return m
+
+    def periods_of(self, mask):
+        return [p for p in self.order if mask & self.bit[p]]
+
+    def link_mask(self, min_break_minutes=None, gaps=None):
+        # bit i set when period i and i+1 are back-to-back on a day with these ``gaps`` (default: the normal day)
+        gaps = self.gaps if gaps is None else gaps
+        link = 0
+        for i, p in enumerate(self.order[:-1]):
+            nxt, minutes = gaps.get(p, (None, 0))
+            if nxt == self.order[i + 1] and (min_break_minutes is None or minutes < min_break_minutes):
+                link |= 1 << i
+        return link
+
+    @staticmethod
+    def lunch_of(gaps):
+        """Last period before the longest break of a day, or None when the day has no break."""
+        p = max(gaps, key=lambda p: gaps[p][1]) if gaps else None
+        return p if p is not None and gaps[p][1] > 0 else None
+
+    def per_day(self, build):
+        """build(gaps) for the normal day and for every day with its own bell, as a lookup by day."""
+        default = build(self.gaps)
+        special = {d: build(g) for d, g in self.day_gaps.items()}
+        return lambda day: special.get(day, default)
+
+    @staticmethod
+    def longest_run(mask, link):
+        run, length = mask, 0
+        while run:
+            length += 1
+            run = mask & ((run & link) << 1)
+        return length
+
+    # --- compilation ---
+    def _compile(self, rule):
+        kind = rule["rule"]
+        if kind == "max_consecutive":
+            limit, min_break = rule["limit"], rule.get("min_break_minutes")
+            link_of = self.per_day(lambda gaps: self.link_mask(min_break, gaps))
+
+            def check(teacher, day, mask):
+                run = self.longest_run(mask, link_of(day))
+                if run > limit:
+                    return f"⚠️ **มาราธอน:** ครู {teacher} สอนติดกัน {run} คาบ (คาบ {self.periods_of(mask)})"
+            self.day_checks.append(check)
+        elif kind == "max_per_day":
+            limit = rule["limit"]
+
+            def check(teacher, day, mask):
+                n = mask.bit_count()
+                if n > limit:
+                    return f"⚠️ **สอนเกินต่อวัน:** ครู {teacher} สอนวัน{day} {n} คาบ (สูงสุด {limit})"
+            self.day_checks.append(check)
+        elif kind == "required_free":
+            required, days = self.mask_of(rule["periods"]), rule.get("days")
+
+            def check(teacher, day, mask):
+                if (days is None or day in days) and mask & required:
+                    return f"⚠️ **ต้องว่าง:** ครู {teacher} มีสอนวัน{day} คาบ {self.periods_of(mask & required)} ซึ่งกำหนดให้ว่าง"
+            self.day_checks.append(check)
+        elif kind == "no_lunch_straddle":
+            def straddle(gaps):
+                # (last period before lunch, first after, mask of both); None on a day without breaks
+                p = self.lunch_of(gaps)
+                return None if p is None else (p, gaps[p][0], self.bit[p] | self.bit[gaps[p][0]])
+            lunch_of = self.per_day(straddle)
+
+            def check(teacher, day, mask):
+                lunch = lunch_of(day)
+                if lunch and mask & lunch[2] == lunch[2]:
+                    return f"⚠️ **คร่อมพักกลางวัน:** ครู {teacher} สอนทั้งคาบ {lunch[0]} และคาบ {lunch[1]} วัน{day}"
+            self.day_checks.append(check)
+        elif kind == "max_per_week":
+            limit = rule["limit"]
+
+            def check(teacher, masks):
+                n = sum(m.bit_count() for m in masks.values())
+                if n > limit:
+                    return f"⚠️ **สอนเกินต่อสัปดาห์:** ครู {teacher} สอน {n} คาบ/สัปดาห์ (สูงสุด {limit})"
+            self.week_checks.append(check)
+        else:
+            raise ValueError(f"unknown rule: {kind}")
+
+    # --- evaluation ---
+    def check_day(self, teacher, day, mask):
+        return [msg for msg in (c(teacher, day, mask) for c in self.day_checks) if msg]
+
+    def check_week(self, teacher, masks):
+        return [msg for msg in (c(teacher, masks) for c in self.week_checks) if msg]
+
+    def check_all(self, teacher_masks, days, symbols=None):
+        """Every violation for every teacher: {teacher: [messages]}; masks keyed by ID of ``symbols`` when given."""
+        result = {}
+        for teacher, masks in teacher_masks.items():
+            if symbols is not None:
+                teacher = symbols.name(teacher)
+            msgs = []
+            for d in days:
+                if masks.get(d):
+                    msgs.extend(self.check_day(teacher, d, masks[d]))
+            msgs.extend(self.check_week(teacher, masks))
+            if msgs:
+                result[teacher] = msgs
+        return result
+
+
+def teacher_day_masks(schedule, ruleset, days, rooms=None, symbols=None):
+    """{teacher: {day: mask}} over the given rooms (default: all), keyed by teacher ID of ``symbols`` when given."""
+    key = symbols.id if symbols is not None else None
+    masks = {}
+    for r in (rooms if rooms is not None else schedule):
+        if r not in schedule:
+            continue
+        for d in days:
+            for p, slots in schedule[r][d].items():
+                bit = ruleset.bit.get(p)
+                if bit is None:
+                    continue
+                for s in slots:
+                    for t in split_teachers(s['teacher']):
+                        day_masks = masks.setdefault(key(t) if key else t, {})
+                        day_masks[d] = day_masks.get(d, 0) | bit
+    return masks
+
+
+def day_occupancy(schedule, rooms, day, skip_room=None, facilities=None, symbols=None):
+    """
+    {teacher: {period: [rooms]}} for one day, in room order. A ``facilities``
+    dict is filled in the same pass as {facility: {period: [rooms]}}. With
+    ``symbols`` both are keyed by ID instead of name.
+    """
+    key = symbols.id if symbols is not None else None
+    index = {}
+    for r in rooms:
+        if r == skip_room or r not in schedule:
+            continue
+        for p, slots in schedule[r][day].items():
+            for s in slots:
+                for t in split_teachers(s['teacher']):
+                    index.setdefault(key(t) if key else t, {}).setdefault(p, []).append(r)
+                if facilities is not None and s.get('facility'):
+                    facilities.setdefault(key(s['facility']) if key else s['facility'], {}).setdefault(p, []).append(r)
+    return index
+
+
+def suggest_slots(ruleset, teacher, teacher_masks, room_free, days, needed=1, top=10):
+    """
+    Rank every (day, period) where ``room_free`` has a free bit and the
+    teacher is free, in one pass over precomputed masks. Candidates that
+    would add a rule violation are dropped; the rest score higher on
+    lighter days and when they don't sit right next to another period of
+    the teacher.
+
+    Returns (options, plan): the ``top`` ranked candidates as
+    (score, day, period, day_load) tuples and a greedy pick of ``needed``
+    slots that re-scores after each pick so the plan spreads over the week.
+    """
+    masks = {d: teacher_masks.get(d, 0) for d in days}
+
+    def score_all():
+        scored = []
+        week_before = len(ruleset.check_week(teacher, masks))
+        for d in days:
+            current = masks[d]
+            cand = room_free.get(d, 0) & ~current & ruleset.full
+            if not cand:
+                continue
+            load = current.bit_count()
+            day_before = len(ruleset.check_day(teacher, d, current))
+            neighbours = ((current << 1) | (current >> 1)) & ruleset.full
+            for p in ruleset.order:
+                b = ruleset.bit[p]
+                if not cand & b:
+                    continue
+                new = current | b
+                if len(ruleset.check_day(teacher, d, new)) > day_before:
+                    continue
+                if ruleset.week_checks and len(ruleset.check_week(teacher, {**masks, d: new})) > week_before:
+                    continue
+                score = 100 - 10 * load - (5 if neighbours & b else 0)
+                scored.append((score, d, p, load))
+        scored.sort(key=lambda x: (-x[0], days.index(x[1]), x[2]))
+        return scored
+
+    options = score_all()[:top]
+    plan = []
+    for _ in range(needed):
+        ranked = score_all()
+        if not ranked:
+            break
+        plan.append(ranked[0])
+        _, d, p, _ = ranked[0]
+        masks[d] |= ruleset.bit[p]
+    return options, plan
@@ -0,0 +1,286 @@
+"""
+Schedule persistence: snapshot sheet + append-only change journal.
+
+The ``Schedule`` worksheet holds a snapshot of every slot. Edits no longer
+rewrite it; each changed (room, day, period, program) slot is appended to
+the ``ScheduleLog`` worksheet as one row with the old and new value. Loading
+reads the snapshot and replays the journal tail on top of it. Compaction
+folds the journal back into the snapshot once it grows past a threshold.
+
+Journal rows are absolute "set slot to value" operations, so replaying a
+prefix that is already contained in the snapshot is harmless.
+
+A slot's value is (teacher, subject, facility); facility is "" for a slot
+taught in its homeroom. Columns are only ever added at the end, so a
+worksheet started before a column existed still reads (``current_journal``
+reads old journal rows under today's header; the snapshot gets the new
+header at the next compaction).
+"""
+import threading
+import time
+from datetime import datetime
+
+from sheets_client import rows_to_records
+
+SNAPSHOT_SHEET = "Schedule"
+JOURNAL_SHEET = "ScheduleLog"
+SNAPSHOT_HEADERS = ["Room", "Day", "Period", "Teacher", "Subject", "Program", "Facility"]
+CLAIM_PREFIX = "claim-"   # snapshot version while a compaction is writing it
+CLAIM_TIMEOUT = 120.0     # seconds after which a claim left by a crashed compaction is ignored
+JOURNAL_HEADERS = ["Timestamp", "Session", "Room", "Day", "Period", "Program",
+                   "OldTeacher", "OldSubject", "NewTeacher", "NewSubject", "OldFacility", "NewFacility"]
+
+
+def make_slot(teacher, subject, program, facility=""):
+    slot = {"teacher": teacher, "subject": subject, "program": program}
+    if facility:
+        slot["facility"] = str(facility)
+    return slot
+
+
+def current_journal(values):
+    """Raw journal cells with the header brought up to JOURNAL_HEADERS when the sheet still has an older prefix of it."""
+    if values and len(values[0]) < len(JOURNAL_HEADERS) and list(values[0]) == JOURNAL_HEADERS[:len(values[0])]:
+        return [list(JOURNAL_HEADERS)] + values[1:]
+    return values
+
+
+def build_schedule(rooms, snapshot_records, days, periods):
+    schedule = {r: {d: {p: [] for p in periods} for d in days} for r in rooms}
+    for row in snapshot_records:
+        r = row['Room']
+        d = row['Day']
+        p = int(row['Period'])
+        if r in schedule and d in days and p in periods:
+            schedule[r][d][p].append(make_slot(row['Teacher'], row['Subject'], row['Program'], row.get('Facility', "")))
+    return schedule
+
+
+def flatten_schedule(sched):
+    flat_data = [list(SNAPSHOT_HEADERS)]
+    for r in sched:
+        for d in sched[r]:
+            for p in sched[r][d]:
+                for slot in sched[r][d][p]:
+                    flat_data.append([
+                        str(r), str(d), int(p),
+                        str(slot['teacher']), str(slot['subject']), str(slot.get('program', 'รวม')),
+                        str(slot.get('facility', ''))
+                    ])
+    return flat_data
+
+
+# --- change capture ---
+
+def capture_cells(schedule, rooms, days, periods):
+    """Immutable copy of the given cells: (room, day, period) -> [(program, teacher, subject, facility)]."""
+    return {
+        (r, d, p): [(s.get('program', 'รวมทุกสาย'), str(s['teacher']), str(s['subject']), str(s.get('facility', '')))
+                    for s in schedule[r][d][p]]
+        for r in rooms if r in schedule
+        for d in days
+        for p in periods
+    }
+
+
+def diff_cells(before, after):
+    """Changed slots between two captures as (room, day, period, program, old, new); old/new are (teacher, subject, facility) or None."""
+    changes = []
+    for key, old_cell in before.items():
+        new_cell = after.get(key, [])
+        if old_cell == new_cell:
+            continue
+        old_by_prog = {prog: tuple(value) for prog, *value in old_cell}
+        new_by_prog = {prog: tuple(value) for prog, *value in new_cell}
+        for prog in dict.fromkeys(list(old_by_prog) + list(new_by_prog)):
+            old, new = old_by_prog.get(prog), new_by_prog.get(prog)
+            if old != new:
+                changes.append((key[0], key[1], key[2], prog, old, new))
+    return changes
+
+
+def journal_rows(changes, session_id, timestamp=None):
+    ts = timestamp or datetime.now().isoformat(timespec="seconds")
+    rows = []
+    for r, d, p, prog, old, new in changes:
+        # (teacher, subject) without a facility is accepted too
+        old_t, old_s, old_f = (*old, "")[:3] if old else ("", "", "")
+        new_t, new_s, new_f = (*new, "")[:3] if new else ("", "", "")
+        rows.append([ts, session_id, str(r), str(d), int(p), str(prog), old_t, old_s, new_t, new_s, old_f, new_f])
+    return rows
+
+
+# --- replay ---
+
+def set_program_slot(cell, program, new):
+    """Replace the slot of ``program`` in a cell list in place; new=None removes it, new[2] (optional) is the facility."""
+    idx = next((i for i, s in enumerate(cell) if s.get('program', 'รวมทุกสาย') == program), None)
+    cell[:] = [s for s in cell if s.get('program', 'รวมทุกสาย') != program]
+    if new:
+        cell.insert(len(cell) if idx is None else idx, make_slot(new[0], new[1], program, new[2] if len(new) > 2 else ""))
+
+
+def record_change(row):
+    new = (str(row['NewTeacher']), str(row['NewSubject']), str(row.get('NewFacility', ''))) if str(row['NewTeacher']) else None
+    return row['Room'], row['Day'], int(row['Period']), str(row['Program']), new
+
+
+def replay_journal(schedule, journal_records):
+    for row in journal_records:
+        r, d, p, prog, new = record_change(row)
+        if r in schedule and d in schedule[r] and p in schedule[r][d]:
+            set_program_slot(schedule[r][d][p], prog, new)
+    return schedule
+
+
+def schedule_from_tables(tables, rooms, days, periods):
+    """Snapshot records plus the journal tail, as the nested schedule dict."""
+    schedule = build_schedule(rooms, tables[SNAPSHOT_SHEET], days, periods)
+    return replay_journal(schedule, tables.get(JOURNAL_SHEET, []))
+
+
+def fold_journal(snapshot_records, journal_records):
+    """Snapshot rows with the journal applied, without needing the room list."""
+    cells = {}
+    for row in snapshot_records:
+        key = (str(row['Room']), str(row['Day']), int(row['Period']))
+        cells.setdefault(key, []).append(make_slot(row['Teacher'], row['Subject'], row['Program'], row.get('Facility', "")))
+    for row in journal_records:
+        r, d, p, prog, new = record_change(row)
+        set_program_slot(cells.setdefault((str(r), str(d), p), []), prog, new)
+    flat = [list(SNAPSHOT_HEADERS)]
+    for (r, d, p), cell in cells.items():
+        for s in cell:
+            flat.append([r, d, p, str(s['teacher']), str(s['subject']), str(s['program']), str(s.get('facility', ''))])
+    return flat
+
+
+class ScheduleJournal:
+    """
+    Appends slot changes to the journal worksheet through a ``SheetsGateway``
+    and compacts it in a background thread once ``compact_threshold`` rows
+    have piled up.
+    """
+
+    def __init__(self, gateway, compact_threshold=300):
+        self.gateway = gateway
+        self.compact_threshold = compact_threshold
+        self.length = 0
+        self.has_header = False
+        self._compact_lock = threading.Lock()
+        self.compactions = 0
+        self.last_error = None
+        self._claims_seen = {}  # claim version -> when this process first saw it
+
+    def observe(self, journal_values):
+        # Called after a load with the raw journal cells so the process knows how long it is.
+        self.has_header = bool(journal_values)
+        self.length = max(0, len(journal_values) - 1)
+
+    def append(self, changes, session_id):
+        return self.append_rows(journal_rows(changes, session_id))
+
+    def append_rows(self, rows):
+        if not rows:
+            return 0
+        count = len(rows)
+        if not self.has_header:
+            rows = [list(JOURNAL_HEADERS)] + rows
+        self.gateway.append_rows(JOURNAL_SHEET, rows)
+        self.gateway.flush()
+        self.has_header = True
+        self.length += count
+        if self.length >= self.compact_threshold:
+            self.compact_in_background()
+        return count
+
+    def compact_in_background(self):
+        if self._compact_lock.locked():
+            return
+        threading.Thread(target=self._compact_quietly, daemon=True).start()
+
+    def _compact_quietly(self):
+        try:
+            self.compact()
+        except Exception as e:
+            self.last_error = e
+
+    def compact(self):
+        """
+        Fold the journal into the snapshot and delete the folded rows; returns
+        how many were folded (0 when another writer compacts or compacted
+        meanwhile).
+
+        Other processes compact the same spreadsheet, so the snapshot is
+        claimed in Meta before it is written: a version starting with
+        ``CLAIM_PREFIX`` tells other compactions to back off, and the write
+        goes out only while Meta still shows this claim. Afterwards the
+        snapshot gets a normal version again. Folded rows are deleted only
+        when the claim held, the snapshot reads back as written and the rows
+        are still the first ones of the journal; rows left behind are
+        harmless, replaying them over the new snapshot sets the same values.
+        """
+        with self._compact_lock:
+            before = self.gateway.read_meta()
+            if self._claimed(before):
+                return 0
+            values = self.gateway.read_values([SNAPSHOT_SHEET, JOURNAL_SHEET])
+            raw = values[JOURNAL_SHEET]
+            journal = rows_to_records(current_journal(raw))
+            if not journal:
+                return 0
+            snapshot = fold_journal(rows_to_records(values[SNAPSHOT_SHEET]), journal)
+            if self._compacted_since(before):
+                return 0
+            claim = self.gateway.stamp([SNAPSHOT_SHEET], resets=[SNAPSHOT_SHEET], prefix=CLAIM_PREFIX)[SNAPSHOT_SHEET]
+            if not self._holds(claim, before):
+                return 0
+            # Not queued: a failed flush or a discard_queue() elsewhere must not drop it behind our back
+            self.gateway.write_table(SNAPSHOT_SHEET, snapshot, stamp=False)
+            held = self._holds(claim, before)
+            # Stamped either way, so readers that saw the claim re-read the rows now behind it
+            self.gateway.stamp([SNAPSHOT_SHEET], resets=[SNAPSHOT_SHEET])
+            if not held:
+                return 0
+            # Header is row 1; rows appended meanwhile come after the folded ones and stay
+            now = self.gateway.read_values([SNAPSHOT_SHEET, JOURNAL_SHEET])
+            if (_cells(now[SNAPSHOT_SHEET]) != _cells(snapshot)
+                    or now[JOURNAL_SHEET][1:len(journal) + 1] != raw[1:len(journal) + 1]):
+                return 0
+            self.gateway.delete_rows(JOURNAL_SHEET, 2, len(journal) + 1)
+            self.length = max(0, self.length - len(journal))
+            self.compactions += 1
+            return len(journal)
+
+    def _claimed(self, meta):
+        # Another compaction is writing the snapshot, unless its claim has been there too long to be alive
+        version = meta.get(SNAPSHOT_SHEET, ("", ""))[0]
+        if not version.startswith(CLAIM_PREFIX):
+            return False
+        seen = self._claims_seen.setdefault(version, time.monotonic())
+        return time.monotonic() - seen < CLAIM_TIMEOUT
+
+    def _compacted_since(self, before):
+        # A new snapshot or a journal epoch reset means another writer folded (part of) what we read
+        after = self.gateway.read_meta()
+        no_stamp = (None, None)
+        return (after.get(SNAPSHOT_SHEET) != before.get(SNAPSHOT_SHEET)
+                or after.get(JOURNAL_SHEET, no_stamp)[1] != before.get(JOURNAL_SHEET, no_stamp)[1])
+
+    def _holds(self, claim, before):
+        # Meta still shows our claim on the snapshot and nobody has trimmed the journal
+        after = self.gateway.read_meta()
+        no_stamp = (None, None)
+        return (after.get(SNAPSHOT_SHEET, no_stamp)[0] == claim
+                and after.get(JOURNAL_SHEET, no_stamp)[1] == before.get(JOURNAL_SHEET, no_stamp)[1])
+
+
+def _cells(rows):
+    # Rows as Sheets reads them back: strings, without trailing empty cells
+    result = []
+    for row in rows:
+        row = [str(c) for c in row]
+        while row and row[-1] == "":
+            row.pop()
+        result.append(row)
+    return result
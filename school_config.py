@@ -0,0 +1,16 @@
+"""
+School-wide constants shared by the Streamlit app and the standalone
+services: the spreadsheet name, the bell schedule and the teaching days.
+The bell schedule here is the default; a school's ``BellSchedule``
+worksheet overrides it (see bell_schedule.py).
+"""
+SHEET_NAME = "SchoolSchedulerDB"
+
+PERIODS = {
+    1: "08.15-09.00", 2: "09.00-09.45",
+    3: "10.00-10.45", 4: "10.45-11.30",
+    5: "12.20-13.05", 6: "13.05-13.50",
+    7: "14.00-14.45", 8: "14.45-15.30",
+    9: "15.45-16.30"
+}
+DAYS = ["จันทร์", "อังคาร", "พุธ", "พฤหัสบดี", "ศุกร์"]
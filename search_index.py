@@ -0,0 +1,144 @@
+"""
+Inverted index over schedule slots for the search box.
+
+Each slot (room, day, period, program) gets an integer position. Postings
+map (field, token ID) -> set of positions for the fields teacher (every
+member of a team), subject, program, room, level, day and period; token
+IDs come from the school's SymbolTable. A query
+is a list of terms; each term resolves to the union of the postings it
+matches and the terms are intersected, smallest set first.
+
+Query syntax (terms separated by spaces)::
+
+    วิทยาศาสตร์ ป.5          subject and level, field guessed from the vocabulary
+    สาย:SMEP วัน:พุธ          explicit field (ครู, วิชา, สาย, ห้อง, ชั้น, วัน, คาบ)
+    3                        a bare number is a period
+    ใจดี                      no exact token -> substring match on teacher/subject names
+
+``apply_changes`` takes the change tuples produced by ``diff_cells`` so the
+index follows edits without a rebuild.
+"""
+from rules import split_teachers
+from symbols import SymbolTable
+
+FIELDS = ("teacher", "subject", "program", "room", "level", "day", "period")
+FIELD_ALIASES = {
+    "ครู": "teacher", "teacher": "teacher",
+    "วิชา": "subject", "subject": "subject",
+    "สาย": "program", "program": "program",
+    "ห้อง": "room", "room": "room",
+    "ชั้น": "level", "ระดับชั้น": "level", "level": "level",
+    "วัน": "day", "day": "day",
+    "คาบ": "period", "period": "period",
+}
+SUBSTRING_FIELDS = ("teacher", "subject")
+
+
+def level_of(room):
+    return room.split("/")[0] if "/" in room else room
+
+
+class SlotIndex:
+    def __init__(self, symbols=None):
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.positions = {}   # slot key -> position
+        self.keys = []        # position -> slot key
+        self.values = {}      # position -> (teacher, subject), only for occupied slots
+        self.postings = {}    # (field, token ID) -> set of positions
+        self.free = []        # positions of removed slots, reused on add
+
+    @classmethod
+    def from_schedule(cls, schedule, symbols=None):
+        index = cls(symbols)
+        for r, days in schedule.items():
+            for d, periods in days.items():
+                for p, cell in periods.items():
+                    for s in cell:
+                        index.add((str(r), str(d), int(p), str(s.get('program', 'รวมทุกสาย'))), (str(s['teacher']), str(s['subject'])))
+        return index
+
+    # --- maintenance ---
+    def _tokens(self, key, value):
+        r, d, p, prog = key
+        teacher, subject = value
+        tokens = [("subject", subject), ("program", prog), ("room", r), ("level", level_of(r)), ("day", d), ("period", str(p))]
+        tokens += [("teacher", t) for t in split_teachers(teacher) if t]
+        return [(f, self.symbols.id(t)) for f, t in tokens]
+
+    def add(self, key, value):
+        if key in self.positions:
+            self.remove(key)
+        if self.free:
+            pos = self.free.pop()
+            self.keys[pos] = key
+        else:
+            pos = len(self.keys)
+            self.keys.append(key)
+        self.positions[key] = pos
+        self.values[pos] = value
+        for token in self._tokens(key, value):
+            self.postings.setdefault(token, set()).add(pos)
+
+    def remove(self, key):
+        pos = self.positions.pop(key, None)
+        if pos is None:
+            return
+        value = self.values.pop(pos, None)
+        if value is not None:
+            for token in self._tokens(key, value):
+                bucket = self.postings.get(token)
+                if bucket is not None:
+                    bucket.discard(pos)
+                    if not bucket:
+                        del self.postings[token]
+        self.keys[pos] = None
+        self.free.append(pos)
+
+    def apply_changes(self, changes):
+        """Changes as (room, day, period, program, old, new) from ``diff_cells``; new=None removes the slot."""
+        for r, d, p, prog, _, new in changes:
+            key = (str(r), str(d), int(p), str(prog))
+            if new is None:
+                self.remove(key)
+            else:
+                self.add(key, (str(new[0]), str(new[1])))
+
+    def __len__(self):
+        return len(self.values)
+
+    # --- queries ---
+    def _term_postings(self, term):
+        field, sep, token = term.partition(":")
+        if sep and field in FIELD_ALIASES:
+            fields, token = [FIELD_ALIASES[field]], token.strip()
+        elif term.isdigit():
+            fields, token = ["period"], term
+        else:
+            fields, token = FIELDS, term
+        result = set()
+        token_id = self.symbols.get(token)
+        if token_id is not None:
+            for f in fields:
+                result |= self.postings.get((f, token_id), set())
+        if not result:
+            # Partial names, e.g. a surname or "คณิต"
+            for f in fields:
+                if f not in SUBSTRING_FIELDS:
+                    continue
+                for (pf, pt), positions in self.postings.items():
+                    if pf == f and token in self.symbols.name(pt):
+                        result |= positions
+        return result
+
+    def search(self, query):
+        """Sorted [(room, day, period, program, teacher, subject)] matching every term of the query."""
+        terms = query.split()
+        if not terms:
+            return []
+        sets = sorted((self._term_postings(t) for t in terms), key=len)
+        hits = set(sets[0])
+        for s in sets[1:]:
+            if not hits:
+                break
+            hits &= s
+        return sorted(self.keys[pos] + self.values[pos] for pos in hits)
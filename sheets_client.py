@@ -0,0 +1,503 @@
+"""
+Rate-limit-aware access to the SchoolSchedulerDB spreadsheet.
+
+Google Sheets allows roughly 60 requests per minute per user. Many teachers
+saving at once used to hit 429 errors which ended in ``st.stop()``. This
+module wraps the gspread client so that:
+
+- every request is counted against a per-minute budget and waits when the
+  budget is spent,
+- transient errors (429 / 5xx / network) are retried with jittered
+  exponential backoff,
+- writes are queued per worksheet and merged, then sent as one batched
+  request when flushed,
+- queue depth and request counters are exposed through ``metrics()``,
+- every flush stamps the written worksheets with a new version in the
+  ``Meta`` worksheet (one row per worksheet: Sheet, Version, Epoch,
+  UpdatedAt), so readers can tell what changed with one small request
+  (``read_meta``). The epoch changes only when existing rows move
+  (replace, delete); while it stays put a worksheet has only been
+  appended to and ``read_rows_from`` can fetch just the new rows.
+
+``FakeSheetsClient`` is an in-memory stand-in for ``gspread.Client`` so the
+app and this module can be exercised without Google.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+
+import requests
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import absolute_range_name, numericise_all
+
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+META_SHEET = "Meta"
+META_HEADERS = ["Sheet", "Version", "Epoch", "UpdatedAt"]
+
+
+def is_transient_error(exc):
+    if isinstance(exc, APIError):
+        return exc.code in TRANSIENT_STATUS
+    return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError, TimeoutError))
+
+
+def rows_to_records(values):
+    # Same result as Worksheet.get_all_records(): first row is the header,
+    # short rows are padded and cells are numericised.
+    if not values:
+        return []
+    headers = values[0]
+    records = []
+    for row in values[1:]:
+        row = list(row) + [""] * (len(headers) - len(row))
+        records.append(dict(zip(headers, numericise_all(row[:len(headers)]))))
+    return records
+
+
+def meta_from_values(values):
+    """{worksheet title: (version, epoch)} from the raw Meta cells."""
+    meta = {}
+    for row in values[1:]:
+        if row and row[0]:
+            row = list(row) + [""] * 3
+            meta[str(row[0])] = (str(row[1]), str(row[2]))
+    return meta
+
+
+class RequestBudget:
+    """Sliding one-minute window of request timestamps."""
+
+    def __init__(self, per_minute=60, window=60.0, clock=time.monotonic, sleep=time.sleep):
+        self.per_minute = per_minute
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+        self._stamps = deque()
+        self._lock = threading.Lock()
+        self.throttled_seconds = 0.0
+
+    def _expire(self, now):
+        while self._stamps and now - self._stamps[0] >= self.window:
+            self._stamps.popleft()
+
+    def used(self):
+        with self._lock:
+            self._expire(self.clock())
+            return len(self._stamps)
+
+    def remaining(self):
+        return max(0, self.per_minute - self.used())
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._expire(now)
+                if len(self._stamps) < self.per_minute:
+                    self._stamps.append(now)
+                    return
+                wait = self.window - (now - self._stamps[0])
+                self.throttled_seconds += wait
+            self.sleep(wait)
+
+
+class SheetsGateway:
+    """
+    Wraps a gspread client bound to one spreadsheet.
+
+    Reads go out immediately (one batched ``values_batch_get`` for several
+    worksheets). Writes are queued with ``replace_table`` / ``append_rows``
+    and only sent on ``flush()``. A later replace of the same worksheet
+    supersedes everything queued before it, and appends to the same
+    worksheet are concatenated, so a burst of saves costs one clear and one
+    update request in total.
+
+    The quota is per service account, so gateways to several spreadsheets
+    through one account should share one ``budget``.
+    """
+
+    def __init__(self, client, sheet_name, requests_per_minute=60, max_retries=5,
+                 base_delay=1.0, max_delay=32.0, clock=time.monotonic, sleep=time.sleep, budget=None):
+        self.client = client
+        self.sheet_name = sheet_name
+        self.budget = budget or RequestBudget(requests_per_minute, clock=clock, sleep=sleep)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self._spreadsheet = None
+        self._worksheets = {}
+        self._titles = None
+        self._queue = {}  # title -> {"replace": rows or None, "append": [rows]}
+        self._queue_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._unstamped = set()  # written worksheets whose Meta stamp failed; retried on the next flush
+        self._unstamped_resets = set()
+        self.counters = {"requests": 0, "retries": 0, "failures": 0, "flushes": 0, "merged_writes": 0}
+
+    # --- low level ---
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.budget.acquire()
+            self.counters["requests"] += 1
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_transient_error(e) or attempt >= self.max_retries:
+                    self.counters["failures"] += 1
+                    raise
+                # Full jitter: sleep anywhere between 0 and the capped exponential delay
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+                attempt += 1
+                self.counters["retries"] += 1
+                self.sleep(delay)
+
+    def spreadsheet(self):
+        if self._spreadsheet is None:
+            self._spreadsheet = self.call(self.client.open, self.sheet_name)
+        return self._spreadsheet
+
+    def titles(self, refresh=False):
+        if self._titles is None or refresh:
+            sh = self.spreadsheet()
+            self._worksheets = {ws.title: ws for ws in self.call(sh.worksheets)}
+            self._titles = list(self._worksheets)
+        return self._titles
+
+    def worksheet(self, title, create=False, cols=10):
+        if title not in self.titles():
+            if not create:
+                raise WorksheetNotFound(title)
+            ws = self.call(self.spreadsheet().add_worksheet, title=title, rows=100, cols=cols)
+            self._worksheets[title] = ws
+            self._titles.append(title)
+        return self._worksheets[title]
+
+    # --- reads ---
+    def read_values(self, titles):
+        """Raw cell values for each worksheet; missing worksheets give []."""
+        existing = [t for t in titles if t in self.titles()]
+        result = {t: [] for t in titles}
+        if existing:
+            resp = self.call(self.spreadsheet().values_batch_get, [absolute_range_name(t) for t in existing])
+            for title, vr in zip(existing, resp.get("valueRanges", [])):
+                result[title] = vr.get("values", [])
+        return result
+
+    def read_tables(self, titles):
+        return {t: rows_to_records(v) for t, v in self.read_values(titles).items()}
+
+    def read_rows_from(self, title, first_row):
+        """Raw values of rows ``first_row`` (1-based) to the end of a worksheet; [] when there are none."""
+        if title not in self.titles():
+            return []
+        resp = self.call(self.spreadsheet().values_batch_get, [absolute_range_name(title, f"A{first_row}:Z")])
+        ranges = resp.get("valueRanges", [])
+        return ranges[0].get("values", []) if ranges else []
+
+    # --- change detection ---
+    def read_meta(self):
+        """{title: (version, epoch)} of every stamped worksheet, in one request; {} before the first stamp."""
+        if META_SHEET not in self.titles():
+            # Another process may have created it since the titles were cached
+            self.titles(refresh=True)
+        meta = meta_from_values(self.read_values([META_SHEET])[META_SHEET])
+        if any(t not in self.titles() for t in meta):
+            # A worksheet another process created since; re-reading it must not come back empty
+            self.titles(refresh=True)
+        return meta
+
+    def _stamp(self, titles, resets=(), prefix=""):
+        # Written after the data, so a reader that sees a new version also sees the rows behind it.
+        # Only the rows of these worksheets are rewritten; other writers' stamps stay as they are.
+        ws = self.worksheet(META_SHEET, create=True, cols=len(META_HEADERS))
+        rows = self.read_values([META_SHEET])[META_SHEET] or [list(META_HEADERS)]
+        position = {str(row[0]): i for i, row in enumerate(rows) if i and row}
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        data = [] if rows[0] == META_HEADERS else [{"range": absolute_range_name(ws.title, "A1:D1"), "values": [META_HEADERS]}]
+        versions = {}
+        for title in sorted(titles):
+            i = position.get(title)
+            if i is None:
+                i = position[title] = len(rows)
+                rows.append([title])
+            old_epoch = rows[i][2] if len(rows[i]) > 2 else ""
+            version = prefix + uuid.uuid4().hex[:12]
+            epoch = version if title in resets or not old_epoch else old_epoch
+            data.append({"range": absolute_range_name(ws.title, f"A{i + 1}:D{i + 1}"), "values": [[title, version, epoch, now]]})
+            versions[title] = version
+        self.call(self.spreadsheet().values_batch_update, body={"valueInputOption": "RAW", "data": data})
+        return versions
+
+    def stamp(self, titles, resets=(), prefix=""):
+        """Stamp worksheets with new versions (starting with ``prefix``) right away; returns {title: version}."""
+        with self._flush_lock:
+            return self._stamp(titles, resets, prefix)
+
+    def _stamp_quietly(self, titles, resets=()):
+        self._unstamped |= set(titles)
+        self._unstamped_resets |= set(resets)
+        try:
+            self._stamp(self._unstamped, self._unstamped_resets)
+        except Exception:
+            # The data is written; readers see it once a later flush gets a stamp through
+            return
+        self._unstamped, self._unstamped_resets = set(), set()
+
+    # --- queued writes ---
+    def replace_table(self, title, rows):
+        with self._queue_lock:
+            entry = self._queue.get(title)
+            if entry is not None:
+                self.counters["merged_writes"] += 1
+            self._queue[title] = {"replace": [list(r) for r in rows], "append": []}
+
+    def append_rows(self, title, rows):
+        if not rows:
+            return
+        with self._queue_lock:
+            entry = self._queue.setdefault(title, {"replace": None, "append": []})
+            if entry["replace"] is not None:
+                entry["replace"].extend(list(r) for r in rows)
+                self.counters["merged_writes"] += 1
+            else:
+                if entry["append"]:
+                    self.counters["merged_writes"] += 1
+                entry["append"].extend(list(r) for r in rows)
+
+    def write_table(self, title, rows, stamp=True):
+        """Replace a whole worksheet right away, outside the queue; raises when the write did not go through."""
+        with self._flush_lock:
+            self._send({title: {"replace": [list(r) for r in rows], "append": []}})
+            if stamp:
+                self._stamp_quietly([title], resets=[title])
+
+    def delete_rows(self, title, start_index, end_index):
+        # Not queued: row positions are only valid against the current sheet contents
+        self.call(self.worksheet(title).delete_rows, start_index, end_index)
+        with self._flush_lock:
+            self._stamp_quietly([title], resets=[title])
+
+    def discard_queue(self):
+        with self._queue_lock:
+            self._queue = {}
+
+    def queue_depth(self):
+        with self._queue_lock:
+            return sum((1 if e["replace"] is not None else 0) + (1 if e["append"] else 0) for e in self._queue.values())
+
+    def flush(self):
+        # Another session may already be flushing; our writes are then sent by it.
+        with self._flush_lock:
+            with self._queue_lock:
+                pending, self._queue = self._queue, {}
+            if not pending:
+                return
+            resets = [t for t, e in pending.items() if e["replace"] is not None]
+            try:
+                self._send(pending)
+            except Exception:
+                # Put back whatever was not sent, keeping newer queued writes on top
+                with self._queue_lock:
+                    for title, entry in pending.items():
+                        newer = self._queue.get(title)
+                        if newer is None:
+                            self._queue[title] = entry
+                        elif newer["replace"] is None:
+                            newer["replace"] = entry["replace"]
+                            newer["append"] = entry["append"] + newer["append"]
+                raise
+            self.counters["flushes"] += 1
+            self._stamp_quietly(pending, resets)
+
+    def _send(self, pending):
+        sh = self.spreadsheet()
+        for title in pending:
+            self.worksheet(title, create=True)
+        replaces = {t: e["replace"] for t, e in pending.items() if e["replace"] is not None}
+        if replaces:
+            ranges = [absolute_range_name(t) for t in replaces]
+            self.call(sh.values_batch_clear, body={"ranges": ranges})
+            data = [{"range": absolute_range_name(t), "values": rows} for t, rows in replaces.items() if rows]
+            if data:
+                self.call(sh.values_batch_update, body={"valueInputOption": "RAW", "data": data})
+            for t in replaces:
+                pending[t]["replace"] = None
+        for title, entry in pending.items():
+            if entry["append"]:
+                self.call(self.worksheet(title).append_rows, entry["append"])
+                entry["append"] = []
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "requests_last_minute": self.budget.used(),
+            "budget_remaining": self.budget.remaining(),
+            "throttled_seconds": round(self.budget.throttled_seconds, 1),
+            **self.counters,
+        }
+
+
+# --- Offline stand-in for gspread ---
+
+class _FakeResponse:
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._body = {"error": {"code": code, "message": message, "status": "FAKE"}}
+
+    def json(self):
+        return self._body
+
+
+def _title_from_range(range_name):
+    title = range_name.split("!")[0]
+    if title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    return title
+
+
+def _row_span(range_name):
+    """(first, last) 1-based rows of an A1 range; None where the range leaves them open."""
+    _, sep, cells = range_name.rpartition("!")
+    if not sep:
+        return None, None
+    m = re.fullmatch(r"[A-Za-z]*(\d*)(:[A-Za-z]*(\d*))?", cells)
+    if not m:
+        return None, None
+    first = int(m.group(1)) if m.group(1) else None
+    if not m.group(2):
+        return first, first
+    return first, int(m.group(3)) if m.group(3) else None
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, values=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.values = [list(r) for r in (values or [])]
+
+    def get_all_values(self):
+        self.spreadsheet.client._hit("get_all_values")
+        return [[str(c) for c in r] for r in self.values]
+
+    def get_all_records(self):
+        return rows_to_records(self.get_all_values())
+
+    def clear(self):
+        self.spreadsheet.client._hit("clear")
+        self.values = []
+
+    def update(self, values, range_name=None, **kwargs):
+        self.spreadsheet.client._hit("update")
+        self.values = [list(r) for r in values]
+
+    def append_rows(self, values, **kwargs):
+        self.spreadsheet.client._hit("append_rows")
+        self.values.extend(list(r) for r in values)
+
+    def delete_rows(self, start_index, end_index=None):
+        self.spreadsheet.client._hit("delete_rows")
+        end_index = end_index or start_index
+        del self.values[start_index - 1:end_index]
+
+
+class FakeSpreadsheet:
+    def __init__(self, client, title):
+        self.client = client
+        self.title = title
+        self.sheets = {}
+
+    def worksheets(self):
+        self.client._hit("worksheets")
+        return list(self.sheets.values())
+
+    def worksheet(self, title):
+        self.client._hit("worksheet")
+        if title not in self.sheets:
+            raise WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows=100, cols=10, **kwargs):
+        self.client._hit("add_worksheet")
+        self.sheets[title] = FakeWorksheet(self, title)
+        return self.sheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        self.client._hit("values_batch_get")
+        result = []
+        for r in ranges:
+            first, last = _row_span(r)
+            rows = self.sheets[_title_from_range(r)].values[(first or 1) - 1:last]
+            result.append({"range": r, "values": [[str(c) for c in row] for row in rows]})
+        return {"valueRanges": result}
+
+    def values_batch_clear(self, params=None, body=None):
+        self.client._hit("values_batch_clear")
+        for r in body["ranges"]:
+            self.sheets[_title_from_range(r)].values = []
+
+    def values_batch_update(self, body=None):
+        self.client._hit("values_batch_update")
+        for item in body["data"]:
+            sheet = self.sheets[_title_from_range(item["range"])]
+            first, _ = _row_span(item["range"])
+            if first is None:
+                sheet.values = [list(r) for r in item["values"]]
+                continue
+            # A range starting at a row overwrites just those rows
+            sheet.values.extend([] for _ in range(first - 1 + len(item["values"]) - len(sheet.values)))
+            for i, row in enumerate(item["values"]):
+                sheet.values[first - 1 + i] = list(row)
+
+
+class FakeSheetsClient:
+    """
+    In-memory replacement for ``gspread.Client``.
+
+    ``seed`` maps spreadsheet name -> worksheet title -> list of rows (header
+    first). ``fail_next(n)`` makes the next n calls raise an APIError with the
+    given status so retry paths can be tested offline. ``calls`` counts every
+    backend call by method name.
+    """
+
+    def __init__(self, seed=None, latency=0.0):
+        self.spreadsheets = {}
+        self.latency = latency
+        self.calls = {}
+        self._failures = deque()
+        self._lock = threading.Lock()
+        for name, sheets in (seed or {}).items():
+            sh = self.spreadsheets.setdefault(name, FakeSpreadsheet(self, name))
+            for title, values in sheets.items():
+                sh.sheets[title] = FakeWorksheet(sh, title, values)
+
+    @classmethod
+    def from_json_file(cls, path, **kwargs):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), **kwargs)
+
+    def fail_next(self, n=1, code=429, message="Quota exceeded"):
+        self._failures.extend([(code, message)] * n)
+
+    def _hit(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            failure = self._failures.popleft() if self._failures else None
+        if self.latency:
+            time.sleep(self.latency)
+        if failure:
+            raise APIError(_FakeResponse(*failure))
+
+    def open(self, title):
+        self._hit("open")
+        if title not in self.spreadsheets:
+            self.spreadsheets[title] = FakeSpreadsheet(self, title)
+            for ws in ("Teachers", "Classrooms", "Schedule"):
+                self.spreadsheets[title].sheets[ws] = FakeWorksheet(self.spreadsheets[title], ws)
+        return self.spreadsheets[title]
@@ -0,0 +1,177 @@
+"""
+Named schedule snapshots stored as deltas, and a slot-level diff engine.
+
+A snapshot is the set of slots keyed by (room, day, period, program) with
+a (teacher, subject, facility) value. Snapshots are kept in the ``Snapshots``
+worksheet: every ``KEYFRAME_EVERY``-th snapshot is stored in full, the
+others only as the slots set/removed since the previous snapshot. Payloads
+are JSON, zlib-compressed and base64-encoded, split into parts so no cell
+exceeds the Sheets cell limit. Snapshots taken before slots had a
+facility decode with facility "".
+"""
+import base64
+import json
+import threading
+import zlib
+from datetime import datetime
+
+from rules import split_teachers
+from sheets_client import rows_to_records
+
+SNAPSHOT_LIST_SHEET = "Snapshots"
+SNAPSHOT_LIST_HEADERS = ["Name", "CreatedAt", "Base", "Part", "Payload"]
+KEYFRAME_EVERY = 10
+PART_SIZE = 40000
+PART_PREFIX = "~"  # keeps Sheets from reading a short base64 tail as a number
+
+
+def schedule_state(schedule):
+    """{(room, day, period, program): (teacher, subject, facility)} from the nested schedule dict."""
+    state = {}
+    for r, days in schedule.items():
+        for d, periods in days.items():
+            for p, slots in periods.items():
+                for s in slots:
+                    state[(str(r), str(d), int(p), str(s.get('program', 'รวมทุกสาย')))] = (str(s['teacher']), str(s['subject']), str(s.get('facility', '')))
+    return state
+
+
+def diff_states(old, new):
+    """Sorted (key, old_value, new_value) for every slot that differs; None means absent."""
+    changes = []
+    for key in old.keys() | new.keys():
+        a, b = old.get(key), new.get(key)
+        if a != b:
+            changes.append((key, a, b))
+    changes.sort(key=lambda c: (c[0][0], c[0][1], c[0][2], c[0][3]))
+    return changes
+
+
+def change_kind(change):
+    _, a, b = change
+    return "added" if a is None else "removed" if b is None else "changed"
+
+
+def group_by_room(changes):
+    groups = {}
+    for c in changes:
+        groups.setdefault(c[0][0], []).append(c)
+    return groups
+
+
+def group_by_teacher(changes):
+    groups = {}
+    for c in changes:
+        teachers = set()
+        for value in (c[1], c[2]):
+            if value:
+                teachers.update(t for t in split_teachers(value[0]) if t)
+        for t in teachers:
+            groups.setdefault(t, []).append(c)
+    return groups
+
+
+def _pack(obj):
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.b64encode(zlib.compress(raw, 9)).decode("ascii")
+
+
+def _unpack(text):
+    return json.loads(zlib.decompress(base64.b64decode(text)).decode("utf-8"))
+
+
+def encode_state(state, base=None):
+    if base is None:
+        return _pack({"full": [[*k, *v] for k, v in sorted(state.items())]})
+    changes = diff_states(base, state)
+    return _pack({
+        "set": [[*k, *b] for k, _, b in changes if b is not None],
+        "del": [list(k) for k, _, b in changes if b is None],
+    })
+
+
+def _slot(row):
+    # [room, day, period, program, teacher, subject(, facility)] -> (key, value)
+    r, d, p, prog, t, s, *rest = row
+    return (r, d, int(p), prog), (t, s, rest[0] if rest else "")
+
+
+def decode_state(payload, base=None):
+    data = _unpack(payload)
+    if "full" in data:
+        return dict(_slot(row) for row in data["full"])
+    state = dict(base)
+    for r, d, p, prog in data["del"]:
+        state.pop((r, d, int(p), prog), None)
+    for row in data["set"]:
+        key, value = _slot(row)
+        state[key] = value
+    return state
+
+
+class SnapshotStore:
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self._entries = None  # [{"name", "created_at", "base", "payload"}] oldest first
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def entries(self, refresh=False):
+        with self._lock:
+            if self._entries is None or refresh:
+                records = rows_to_records(self.gateway.read_values([SNAPSHOT_LIST_SHEET])[SNAPSHOT_LIST_SHEET])
+                entries = {}
+                for row in records:
+                    name = str(row['Name'])
+                    e = entries.setdefault(name, {"name": name, "created_at": str(row['CreatedAt']), "base": str(row['Base']), "parts": {}})
+                    e["parts"][int(row['Part'])] = str(row['Payload'])[len(PART_PREFIX):]
+                self._entries = [
+                    {"name": e["name"], "created_at": e["created_at"], "base": e["base"],
+                     "payload": "".join(e["parts"][i] for i in sorted(e["parts"]))}
+                    for e in entries.values()
+                ]
+                self._states = {}
+            return self._entries
+
+    def names(self, refresh=False):
+        return [e["name"] for e in self.entries(refresh)]
+
+    def load(self, name):
+        by_name = {e["name"]: e for e in self.entries()}
+        chain = []
+        while name and name not in self._states:
+            entry = by_name[name]
+            chain.append(entry)
+            name = entry["base"]
+        state = self._states.get(name)
+        for entry in reversed(chain):
+            state = decode_state(entry["payload"], state)
+            self._states[entry["name"]] = state
+        return state
+
+    def create(self, name, state):
+        entries = self.entries(refresh=True)
+        if any(e["name"] == name for e in entries):
+            raise ValueError(f"มี snapshot ชื่อ '{name}' อยู่แล้ว")
+        base_name = entries[-1]["name"] if entries else ""
+        # Keyframe every N snapshots keeps the replay chain short
+        chain_length, cursor = 0, base_name
+        by_name = {e["name"]: e for e in entries}
+        while cursor:
+            chain_length += 1
+            cursor = by_name[cursor]["base"]
+        if not base_name or chain_length >= KEYFRAME_EVERY:
+            base_name, payload = "", encode_state(state)
+        else:
+            payload = encode_state(state, self.load(base_name))
+        created_at = datetime.now().isoformat(timespec="seconds")
+        parts = [payload[i:i + PART_SIZE] for i in range(0, len(payload), PART_SIZE)] or [""]
+        rows = [[name, created_at, base_name, i, PART_PREFIX + part] for i, part in enumerate(parts)]
+        if not entries and not self.gateway.read_values([SNAPSHOT_LIST_SHEET])[SNAPSHOT_LIST_SHEET]:
+            rows = [list(SNAPSHOT_LIST_HEADERS)] + rows
+        self.gateway.append_rows(SNAPSHOT_LIST_SHEET, rows)
+        self.gateway.flush()
+        with self._lock:
+            self._entries = entries + [{"name": name, "created_at": created_at, "base": base_name, "payload": payload}]
+            self._states[name] = dict(state)
+        return len(payload)
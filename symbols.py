@@ -0,0 +1,78 @@
+"""
+Symbol table for teacher, room, subject, program and facility names.
+
+Every distinct name gets a small integer ID and one canonical ``str``
+object (the ``sys.intern`` one, so the names ``rules.split_teachers``
+returns are the same objects). Each school has its own table
+(``TenantServices.symbols``), dropped together with the school's other
+state and started afresh from the loaded data on every reload, so it only
+holds names the current dataset uses. Schedules loaded by the school's
+sessions are rewritten to point at the canonical objects; slots still hold
+plain strings, so flattening to the sheet columns is unchanged.
+
+Indexes key on the IDs: the search postings, the per-teacher rule masks
+and the teacher/facility occupancy of the editor's conflict check. Lookups
+with names that came from the UI use ``get()``, which never adds a name.
+A session's search index remembers the table it was built on and is
+rebuilt when the school's table has been replaced.
+"""
+import sys
+import threading
+
+
+class SymbolTable:
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def id(self, name):
+        name = str(name)
+        i = self._ids.get(name)
+        if i is None:
+            with self._lock:
+                i = self._ids.get(name)
+                if i is None:
+                    i = len(self._names)
+                    canonical = sys.intern(name)
+                    self._names.append(canonical)
+                    self._ids[canonical] = i
+        return i
+
+    def get(self, name):
+        """ID of ``name``, or None when the table has never seen it."""
+        return self._ids.get(str(name))
+
+    def name(self, i):
+        return self._names[i]
+
+    def intern(self, name):
+        return self._names[self.id(name)]
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return str(name) in self._ids
+
+    def __iter__(self):
+        # Names in ID order
+        return iter(self._names)
+
+
+def intern_schedule(schedule, symbols):
+    """Same schedule with room keys and slot strings replaced by their canonical objects (slots are updated in place)."""
+    def canon(value):
+        # Numbers read back from the sheet stay as they are so lookups by the original value still work
+        return symbols.intern(value) if isinstance(value, str) else value
+
+    result = {}
+    for r, days in schedule.items():
+        for periods in days.values():
+            for cell in periods.values():
+                for s in cell:
+                    for field in ('teacher', 'subject', 'program', 'facility'):
+                        if field in s:
+                            s[field] = canon(s[field])
+        result[canon(r)] = days
+    return result
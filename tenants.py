@@ -0,0 +1,124 @@
+"""
+Schools (tenants) served by one deployment.
+
+Each tenant has its own spreadsheet and its own local SQLite cache; tenants
+that share a service account share one authorized client. The list comes
+from ``[tenants.<id>]`` tables in ``.streamlit/secrets.toml``::
+
+    [tenants.main]
+    name = "โรงเรียนสาขาหลัก"
+    sheet = "SchoolSchedulerDB"
+
+    [tenants.north]
+    name = "วิทยาเขตเหนือ"
+    sheet = "SchoolSchedulerDB_North"
+    credentials = "gcp_service_account_north"   # secrets key, default gcp_service_account
+    cache = ".scheduler_cache.north.sqlite3"     # default .scheduler_cache.<id>.sqlite3
+
+or from a JSON file of the same shape named by ``SCHEDULER_TENANTS``.
+Without either, the single tenant "default" keeps the original spreadsheet
+and cache path, so an existing one-school deployment runs unchanged.
+
+``TenantServices`` bundles the in-process state of one school (gateway,
+journal, local store, sync worker, snapshots, symbol table, .ics builder,
+term archive) so a host can keep a bounded number of schools alive and
+drop the least recently used one as a unit (``close()``). The authorized
+client and the request budget belong to the service account and are shared
+by every school that uses it: the Sheets quota is per account.
+"""
+import json
+import os
+import re
+
+from ical import IcsBuilder
+from local_store import LocalStore, SyncWorker
+from schedule_store import ScheduleJournal
+from school_config import SHEET_NAME
+from sheets_client import SheetsGateway
+from snapshots import SnapshotStore
+from symbols import SymbolTable
+from term_archive import TermArchive
+
+DEFAULT_TENANT = "default"
+DEFAULT_CREDENTIALS = "gcp_service_account"
+DEFAULT_CACHE_PATH = ".scheduler_cache.sqlite3"
+DEFAULT_ARCHIVE_ROOT = ".scheduler_archive"
+
+
+class Tenant:
+    def __init__(self, tenant_id, name=None, sheet=SHEET_NAME, credentials=DEFAULT_CREDENTIALS, cache=None):
+        self.id = str(tenant_id)
+        self.name = name or self.id
+        self.sheet = sheet
+        self.credentials = credentials
+        if cache is None:
+            cache = DEFAULT_CACHE_PATH if self.id == DEFAULT_TENANT else f".scheduler_cache.{safe_id(self.id)}.sqlite3"
+        self.cache = cache
+
+    def __repr__(self):
+        return f"Tenant({self.id!r}, sheet={self.sheet!r})"
+
+
+def safe_id(tenant_id):
+    return re.sub(r"[^\w.-]", "_", str(tenant_id))
+
+
+def load_tenants(secrets=None, env=None, default_cache=None):
+    """{tenant id: Tenant} in configuration order; ``secrets`` is st.secrets or the parsed secrets.toml."""
+    env = os.environ if env is None else env
+    config = None
+    path = env.get("SCHEDULER_TENANTS")
+    if path:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    elif secrets is not None and "tenants" in secrets:
+        config = secrets["tenants"]
+    if not config:
+        return {DEFAULT_TENANT: Tenant(DEFAULT_TENANT, "โรงเรียน", cache=default_cache or DEFAULT_CACHE_PATH)}
+    tenants = {}
+    for tenant_id, entry in config.items():
+        entry = dict(entry)
+        unknown = set(entry) - {"name", "sheet", "credentials", "cache"}
+        if unknown:
+            raise ValueError(f"tenant {tenant_id}: unknown keys {sorted(unknown)}")
+        tenants[str(tenant_id)] = Tenant(tenant_id, **entry)
+    return tenants
+
+
+class TenantServices:
+    """
+    Everything one school keeps in-process, created together. ``budget`` is
+    the RequestBudget of the service account behind ``client``. Edits left
+    in the local queue (e.g. by an evicted predecessor) are pushed by a
+    retry thread started here.
+    """
+
+    def __init__(self, tenant, client, ics_root=None, archive_root=DEFAULT_ARCHIVE_ROOT, budget=None):
+        self.tenant = tenant
+        self.gateway = SheetsGateway(client, tenant.sheet, budget=budget)
+        self.journal = ScheduleJournal(self.gateway)
+        self.store = LocalStore(tenant.cache)
+        self.sync = SyncWorker(self.store, self.gateway, self.journal)
+        self.snapshots = SnapshotStore(self.gateway)
+        self.symbols = SymbolTable()
+        if ics_root and tenant.id != DEFAULT_TENANT:
+            ics_root = os.path.join(ics_root, safe_id(tenant.id))
+        self.ics = IcsBuilder(ics_root)
+        if tenant.id != DEFAULT_TENANT:
+            archive_root = os.path.join(archive_root, safe_id(tenant.id))
+        self.archive = TermArchive(archive_root)
+        if self.store.pending_count():
+            self.sync.start()
+
+    def new_symbols(self):
+        """
+        Replace the symbol table with an empty one, on every data reload, so
+        names the school no longer uses are dropped. Indexes built on the old
+        table keep working until their session rebuilds them.
+        """
+        self.symbols = SymbolTable()
+        return self.symbols
+
+    def close(self, timeout=10.0):
+        """Stop the background sync when the school is dropped; queued edits stay in the local store."""
+        self.sync.stop(timeout)
@@ -0,0 +1,161 @@
+"""
+Columnar archive of finalized terms for cross-term analytics.
+
+Each archived term is the flattened schedule (the Room, Day, Period,
+Teacher, Subject, Program rows of ``flatten_schedule``) plus a few derived
+columns, written as one zstd-compressed Parquet file under a hive-style
+directory per term::
+
+    <root>/term=2567-2/part-0.parquet
+    <root>/term=2568-1/part-0.parquet
+
+Archiving a term again replaces its file. Queries go through a
+``pyarrow.dataset`` over the whole root: the term filter prunes whole
+directories, only the columns a query names are read, and aggregation is
+done by Arrow's vectorised ``group_by`` rather than row by row in Python,
+so adding years of terms only adds files that a query can skip.
+
+Columns: room, level, day, period, teacher, subject, program, teachers
+(the team split into a list, for per-teacher loads). The file footer keeps
+archived_at and slots_per_week (the bell schedule's periods per week, to
+turn used slots into utilisation).
+"""
+import os
+import re
+import shutil
+import time
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from rules import split_teachers
+from search_index import level_of
+
+SCHEMA = pa.schema([
+    ("room", pa.string()),
+    ("level", pa.string()),
+    ("day", pa.string()),
+    ("period", pa.int16()),
+    ("teacher", pa.string()),
+    ("subject", pa.string()),
+    ("program", pa.string()),
+    ("teachers", pa.list_(pa.string())),
+])
+PARTITIONING = ds.partitioning(pa.schema([("term", pa.string())]), flavor="hive")
+TERM_PATTERN = re.compile(r"[\w.-]+")
+
+
+def check_term(term):
+    term = str(term).strip()
+    if not TERM_PATTERN.fullmatch(term):
+        raise ValueError(f"term key {term!r}: use letters, digits, '.', '-' or '_' (e.g. 2568-1)")
+    return term
+
+
+def default_term_key(today=None):
+    """Thai academic year (B.E.) and semester for a date: semester 1 runs May-October, 2 November-April."""
+    today = today or date.today()
+    year = today.year + 543 - (1 if today.month < 5 else 0)
+    return f"{year}-{1 if 5 <= today.month <= 10 else 2}"
+
+
+def table_from_flat(flat_rows):
+    """Arrow table in SCHEMA from ``flatten_schedule`` rows (header first)."""
+    rows = flat_rows[1:]
+    rooms = [str(r[0]) for r in rows]
+    teachers = [str(r[3]) for r in rows]
+    return pa.table({
+        "room": rooms,
+        "level": [level_of(r) for r in rooms],
+        "day": [str(r[1]) for r in rows],
+        "period": [int(r[2]) for r in rows],
+        "teacher": teachers,
+        "subject": [str(r[4]) for r in rows],
+        "program": [str(r[5]) for r in rows],
+        "teachers": [[t for t in split_teachers(t_str) if t] for t_str in teachers],
+    }, schema=SCHEMA)
+
+
+def aggregate(table, keys, aggregations, names):
+    """``group_by(keys).aggregate(aggregations)`` as columns keys + names, whatever order Arrow returns."""
+    result = table.group_by(keys).aggregate(aggregations)
+    return result.select(keys + [f"{col}_{fn}" for col, fn in aggregations]).rename_columns(keys + names)
+
+
+class TermArchive:
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, term):
+        return os.path.join(self.root, f"term={check_term(term)}")
+
+    # --- writing ---
+    def archive(self, term, flat_rows, slots_per_week):
+        """Write (or replace) one term; returns the number of slots archived."""
+        table = table_from_flat(flat_rows)
+        table = table.replace_schema_metadata({
+            "archived_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "slots_per_week": str(int(slots_per_week)),
+        })
+        target = self._dir(term)
+        os.makedirs(target, exist_ok=True)
+        # Write beside the live file and swap, so a query never sees half a term ("." hides it from scans)
+        tmp = os.path.join(target, ".part-0.parquet.tmp")
+        pq.write_table(table, tmp, compression="zstd", use_dictionary=True)
+        os.replace(tmp, os.path.join(target, "part-0.parquet"))
+        return table.num_rows
+
+    def delete(self, term):
+        shutil.rmtree(self._dir(term), ignore_errors=True)
+
+    # --- catalogue ---
+    def terms(self):
+        """[(term, slots, archived_at, slots_per_week, bytes)] sorted by term; reads file footers only."""
+        if not os.path.isdir(self.root):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name, "part-0.parquet")
+            if not name.startswith("term=") or not os.path.isfile(path):
+                continue
+            meta = pq.read_metadata(path)
+            extra = {k.decode(): v.decode() for k, v in (meta.metadata or {}).items() if not k.startswith(b"ARROW")}
+            result.append((name[len("term="):], meta.num_rows, extra.get("archived_at", ""),
+                           int(extra.get("slots_per_week", 0)), os.path.getsize(path)))
+        return result
+
+    def key(self):
+        """Changes whenever a term is archived, replaced or deleted (for caching query results)."""
+        return tuple((t, at, size) for t, _, at, _, size in self.terms())
+
+    # --- queries ---
+    def scan(self, columns, terms=None):
+        """Arrow table of ``columns`` (plus term) for the given terms; None = every term."""
+        schema = SCHEMA.append(pa.field("term", pa.string()))
+        if not self.terms():
+            return schema.empty_table().select(["term", *columns])
+        dataset = ds.dataset(self.root, format="parquet", partitioning=PARTITIONING, schema=schema)
+        flt = None if terms is None else pc.field("term").isin([check_term(t) for t in terms])
+        return dataset.to_table(columns=["term", *columns], filter=flt)
+
+    def teacher_load(self, terms=None):
+        """Periods per week of every teacher in every term: columns term, teacher, periods."""
+        table = self.scan(["teachers"], terms)
+        names = pc.list_flatten(table["teachers"])
+        owner = pc.list_parent_indices(table["teachers"])
+        exploded = pa.table({"term": pc.take(table["term"], owner), "teacher": names})
+        return aggregate(exploded, ["term", "teacher"], [("teacher", "count")], ["periods"])
+
+    def room_usage(self, terms=None):
+        """Occupied (day, period) cells of every room in every term: columns term, level, room, used."""
+        table = self.scan(["level", "room", "day", "period"], terms)
+        cells = table.group_by(["term", "level", "room", "day", "period"]).aggregate([])
+        return aggregate(cells, ["term", "level", "room"], [("day", "count")], ["used"])
+
+    def program_coverage(self, terms=None):
+        """Slots and distinct rooms of every program in every term: columns term, program, slots, rooms."""
+        table = self.scan(["program", "room"], terms)
+        return aggregate(table, ["term", "program"], [("room", "count"), ("room", "count_distinct")], ["slots", "rooms"])
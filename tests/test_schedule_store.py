@@ -0,0 +1,170 @@
+import pytest
+
+import schedule_store
+
+from schedule_store import (JOURNAL_SHEET, SNAPSHOT_HEADERS, SNAPSHOT_SHEET, ScheduleJournal, current_journal,
+                            fold_journal)
+from sheets_client import FakeSheetsClient, SheetsGateway, rows_to_records
+
+SHEET = "SchoolSchedulerDB"
+
+
+def make_gateway(client):
+    return SheetsGateway(client, SHEET, sleep=lambda s: None)
+
+
+def make_journal(client, edits=5):
+    gateway = make_gateway(client)
+    gateway.write_table(SNAPSHOT_SHEET, [SNAPSHOT_HEADERS])
+    journal = ScheduleJournal(gateway, compact_threshold=10 ** 6)
+    for p in range(1, edits + 1):
+        journal.append([("ป.1/1", "จันทร์", p, "รวมทุกสาย", None, (f"ครู{p}", "คณิต", ""))], "s1")
+    return gateway, journal
+
+
+def observed(gateway):
+    """Snapshot + journal as the app would load them."""
+    values = gateway.read_values([SNAPSHOT_SHEET, JOURNAL_SHEET])
+    records = rows_to_records(current_journal(values[JOURNAL_SHEET]))
+    return sorted(map(tuple, fold_journal(rows_to_records(values[SNAPSHOT_SHEET]), records)[1:]))
+
+
+def journal_length(gateway):
+    return len(gateway.read_values([JOURNAL_SHEET])[JOURNAL_SHEET]) - 1
+
+
+def second_writer(client):
+    journal = ScheduleJournal(make_gateway(client), compact_threshold=10 ** 6)
+    journal.has_header = True
+    return journal
+
+
+def test_compact_folds_the_journal_into_the_snapshot():
+    gateway, journal = make_journal(FakeSheetsClient())
+    before = observed(gateway)
+
+    assert journal.compact() == 5
+
+    assert observed(gateway) == before
+    assert journal_length(gateway) == 0
+
+
+def test_failed_snapshot_write_keeps_the_journal(monkeypatch):
+    gateway, journal = make_journal(FakeSheetsClient())
+    before = observed(gateway)
+
+    def fail(pending):
+        raise RuntimeError("quota")
+    monkeypatch.setattr(gateway, "_send", fail)
+    with pytest.raises(RuntimeError):
+        journal.compact()
+    monkeypatch.undo()
+
+    assert journal_length(gateway) == 5
+    assert observed(gateway) == before
+
+
+def test_discarded_queue_cannot_drop_the_snapshot():
+    gateway, journal = make_journal(FakeSheetsClient())
+    before = observed(gateway)
+    gateway.replace_table("Teachers", [["ชื่อ-สกุล"]])
+    gateway.discard_queue()
+
+    assert journal.compact() == 5
+    assert observed(gateway) == before
+
+
+def test_backs_off_when_another_writer_compacts_after_the_read(monkeypatch):
+    client = FakeSheetsClient()
+    gateway, journal = make_journal(client)
+    other = second_writer(client)
+    read_values = gateway.read_values
+
+    def read_then_race(titles):
+        values = read_values(titles)
+        if SNAPSHOT_SHEET in titles:
+            monkeypatch.setattr(gateway, "read_values", read_values)
+            other.compact()
+            other.append([("ป.1/1", "อังคาร", 1, "รวมทุกสาย", None, ("ครูอื่น", "ไทย", ""))], "s2")
+        return values
+    monkeypatch.setattr(gateway, "read_values", read_then_race)
+
+    assert journal.compact() == 0
+    rows = observed(gateway)
+    assert len(rows) == 6 and ("ป.1/1", "อังคาร", 1, "ครูอื่น", "ไทย", "รวมทุกสาย", "") in rows
+
+
+def test_later_claim_wins_and_the_earlier_compaction_keeps_the_rows(monkeypatch):
+    client = FakeSheetsClient()
+    gateway, journal = make_journal(client)
+    other = second_writer(client)
+    write_table = gateway.write_table
+
+    def race_then_write(title, rows, stamp=True):
+        # Another process appends and compacts between our claim check and our write
+        other.append([("ป.1/1", "พุธ", 1, "รวมทุกสาย", None, ("ครูอื่น", "ไทย", ""))], "s2")
+        other_gateway = other.gateway
+        other_gateway.stamp([SNAPSHOT_SHEET], resets=[SNAPSHOT_SHEET])
+        write_table(title, rows, stamp)
+    monkeypatch.setattr(gateway, "write_table", race_then_write)
+
+    assert journal.compact() == 0
+    assert journal_length(gateway) == 6  # nothing deleted: our claim did not hold
+    rows = observed(gateway)
+    assert len(rows) == 6 and ("ป.1/1", "พุธ", 1, "ครูอื่น", "ไทย", "รวมทุกสาย", "") in rows
+
+
+def test_keeps_rows_that_moved_before_the_delete(monkeypatch):
+    gateway, journal = make_journal(FakeSheetsClient())
+    write_table = gateway.write_table
+
+    def write_then_trim(title, rows, stamp=True):
+        write_table(title, rows, stamp)
+        gateway.call(gateway.worksheet(JOURNAL_SHEET).delete_rows, 2, 3)  # an unstamped trim
+    monkeypatch.setattr(gateway, "write_table", write_then_trim)
+
+    assert journal.compact() == 0
+    assert journal_length(gateway) == 3
+
+
+def test_another_compaction_backs_off_while_the_snapshot_is_claimed(monkeypatch):
+    client = FakeSheetsClient()
+    gateway, journal = make_journal(client)
+    other = second_writer(client)
+    write_table = gateway.write_table
+    results = []
+
+    def race_then_write(title, rows, stamp=True):
+        # Another process starts after our claim and would overwrite the snapshot we are about to write
+        other.append([("ป.1/1", "พุธ", 1, "รวมทุกสาย", None, ("ครูอื่น", "ไทย", ""))], "s2")
+        results.append(other.compact())
+        write_table(title, rows, stamp)
+    monkeypatch.setattr(gateway, "write_table", race_then_write)
+
+    assert journal.compact() == 5
+    assert results == [0]
+    rows = observed(gateway)
+    assert len(rows) == 6 and ("ป.1/1", "พุธ", 1, "ครูอื่น", "ไทย", "รวมทุกสาย", "") in rows
+    assert journal_length(gateway) == 1
+
+
+def test_stale_claim_left_by_a_crashed_compaction_is_ignored(monkeypatch):
+    client = FakeSheetsClient()
+    gateway, journal = make_journal(client)
+    gateway.stamp([SNAPSHOT_SHEET], prefix=schedule_store.CLAIM_PREFIX)
+    now = [1000.0]
+    monkeypatch.setattr(schedule_store.time, "monotonic", lambda: now[0])
+
+    assert journal.compact() == 0
+    now[0] += schedule_store.CLAIM_TIMEOUT
+    assert journal.compact() == 5
+    assert not gateway.read_meta()[SNAPSHOT_SHEET][0].startswith(schedule_store.CLAIM_PREFIX)
+
+
+def test_readers_see_a_new_snapshot_version_after_compaction():
+    gateway, journal = make_journal(FakeSheetsClient())
+    before = gateway.read_meta()
+    journal.compact()
+    after = gateway.read_meta()
+    assert after[SNAPSHOT_SHEET][0] != before[SNAPSHOT_SHEET][0]
+    assert after[JOURNAL_SHEET][1] != before[JOURNAL_SHEET][1]
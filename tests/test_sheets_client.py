@@ -0,0 +1,203 @@
+import pytest
+from gspread.exceptions import APIError
+
+import sheets_client
+from sheets_client import META_SHEET, FakeSheetsClient, RequestBudget, SheetsGateway
+
+SHEET = "SchoolSchedulerDB"
+
+
+class FakeTime:
+    """Injected clock and sleep: sleeping advances the clock instead of waiting."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def fake_time():
+    return FakeTime()
+
+
+@pytest.fixture
+def client():
+    return FakeSheetsClient({SHEET: {"Teachers": [["ชื่อ-สกุล", "วิชาที่สอน"], ["ครูเอ", "คณิต"]],
+                                     "Schedule": [["Room", "Day", "Period"]]}})
+
+
+def make_gateway(client, fake_time, **kwargs):
+    return SheetsGateway(client, SHEET, clock=fake_time.clock, sleep=fake_time.sleep, **kwargs)
+
+
+# --- RequestBudget ---
+
+def test_budget_waits_for_the_oldest_request_to_leave_the_window(fake_time):
+    budget = RequestBudget(per_minute=3, clock=fake_time.clock, sleep=fake_time.sleep)
+    for t in (0.0, 10.0, 20.0):
+        fake_time.now = t
+        budget.acquire()
+    assert budget.remaining() == 0
+
+    budget.acquire()
+
+    assert fake_time.sleeps == [40.0]  # until the request at t=0 is a minute old
+    assert fake_time.now == 60.0
+    assert budget.throttled_seconds == 40.0
+    assert budget.used() == 3
+
+
+def test_budget_does_not_wait_while_requests_remain(fake_time):
+    budget = RequestBudget(per_minute=2, clock=fake_time.clock, sleep=fake_time.sleep)
+    budget.acquire()
+    fake_time.now = 61.0
+    budget.acquire()
+    budget.acquire()
+    assert fake_time.sleeps == []
+    assert budget.used() == 2
+
+
+def test_gateway_requests_are_throttled_by_the_budget(client, fake_time):
+    gateway = make_gateway(client, fake_time, requests_per_minute=2)
+    for _ in range(3):
+        gateway.read_values(["Teachers"])
+    assert gateway.budget.throttled_seconds > 0
+    assert sum(fake_time.sleeps) == gateway.budget.throttled_seconds
+
+
+# --- queued writes ---
+
+def test_later_replace_supersedes_earlier_writes(client, fake_time):
+    gateway = make_gateway(client, fake_time)
+    gateway.append_rows("Teachers", [["ครูบี", "ไทย"]])
+    gateway.replace_table("Teachers", [["ชื่อ-สกุล", "วิชาที่สอน"], ["ครูซี", "ศิลปะ"]])
+    gateway.append_rows("Teachers", [["ครูดี", "ดนตรี"]])
+
+    assert gateway.queue_depth() == 1
+    assert gateway.counters["merged_writes"] == 2
+
+    client.calls.clear()
+    gateway.flush()
+
+    assert gateway.read_values(["Teachers"])["Teachers"] == [
+        ["ชื่อ-สกุล", "วิชาที่สอน"], ["ครูซี", "ศิลปะ"], ["ครูดี", "ดนตรี"]]
+    assert client.calls["values_batch_clear"] == 1
+    assert "append_rows" not in client.calls
+    assert gateway.queue_depth() == 0
+
+
+def test_appends_are_concatenated_into_one_request(client, fake_time):
+    gateway = make_gateway(client, fake_time)
+    gateway.append_rows("Schedule", [["ป.1/1", "จันทร์", 1]])
+    gateway.append_rows("Schedule", [["ป.1/1", "จันทร์", 2]])
+
+    client.calls.clear()
+    gateway.flush()
+
+    assert client.calls["append_rows"] == 1
+    assert gateway.read_values(["Schedule"])["Schedule"][1:] == [["ป.1/1", "จันทร์", "1"], ["ป.1/1", "จันทร์", "2"]]
+
+
+def test_replaces_of_several_worksheets_share_one_clear_and_one_update(client, fake_time):
+    gateway = make_gateway(client, fake_time)
+    gateway.replace_table("Teachers", [["ชื่อ-สกุล"]])
+    gateway.replace_table("Schedule", [["Room"]])
+    gateway.read_values([META_SHEET])  # worksheet titles are cached before counting
+
+    client.calls.clear()
+    gateway.flush()
+
+    assert client.calls["values_batch_clear"] == 1
+    # One update for the data, one for the Meta stamp
+    assert client.calls["values_batch_update"] == 2
+    assert set(gateway.read_meta()) == {"Teachers", "Schedule"}
+
+
+def test_failed_flush_keeps_the_writes_queued(client, fake_time):
+    gateway = make_gateway(client, fake_time, max_retries=0)
+    gateway.replace_table("Teachers", [["ชื่อ-สกุล"]])
+    gateway.read_values(["Teachers"])
+    client.fail_next(1, code=500)
+
+    with pytest.raises(APIError):
+        gateway.flush()
+
+    assert gateway.queue_depth() == 1
+    gateway.flush()
+    assert gateway.read_values(["Teachers"])["Teachers"] == [["ชื่อ-สกุล"]]
+
+
+# --- retries ---
+
+def test_429_is_retried_with_jittered_exponential_backoff(client, fake_time, monkeypatch):
+    ceilings = []
+
+    def uniform(low, high):
+        ceilings.append((low, high))
+        return high / 2
+    monkeypatch.setattr(sheets_client.random, "uniform", uniform)
+    gateway = make_gateway(client, fake_time, base_delay=1.0, max_delay=3.0)
+    gateway.read_values(["Teachers"])
+    client.fail_next(3, code=429)
+
+    values = gateway.read_values(["Teachers"])
+
+    assert values["Teachers"][1] == ["ครูเอ", "คณิต"]
+    assert ceilings == [(0, 1.0), (0, 2.0), (0, 3.0)]  # capped at max_delay
+    assert fake_time.sleeps == [0.5, 1.0, 1.5]
+    assert gateway.counters["retries"] == 3
+    assert gateway.counters["failures"] == 0
+
+
+def test_retries_give_up_after_max_retries(client, fake_time):
+    gateway = make_gateway(client, fake_time, max_retries=2)
+    gateway.read_values(["Teachers"])
+    client.fail_next(3, code=503)
+
+    with pytest.raises(APIError):
+        gateway.read_values(["Teachers"])
+
+    assert gateway.counters["retries"] == 2
+    assert gateway.counters["failures"] == 1
+
+
+def test_non_transient_errors_are_not_retried(client, fake_time):
+    gateway = make_gateway(client, fake_time)
+    gateway.read_values(["Teachers"])
+    client.fail_next(1, code=400, message="Bad request")
+
+    with pytest.raises(APIError):
+        gateway.read_values(["Teachers"])
+
+    assert gateway.counters["retries"] == 0
+    assert fake_time.sleeps == []
+
+
+# --- metrics ---
+
+def test_metrics_report_queue_depth_and_budget(client, fake_time):
+    gateway = make_gateway(client, fake_time, requests_per_minute=10)
+    gateway.replace_table("Teachers", [["ชื่อ-สกุล"]])
+    gateway.append_rows("Schedule", [["ป.1/1"]])
+    gateway.append_rows("Schedule", [["ป.1/2"]])
+
+    m = gateway.metrics()
+    assert m["queue_depth"] == 2
+    assert m["requests_last_minute"] == 0
+    assert m["budget_remaining"] == 10
+    assert m["merged_writes"] == 1
+
+    gateway.flush()
+    m = gateway.metrics()
+    assert m["queue_depth"] == 0
+    assert m["flushes"] == 1
+    assert m["requests_last_minute"] == m["requests"]
+    assert m["budget_remaining"] == 10 - m["requests"]
+    assert m["throttled_seconds"] == 0
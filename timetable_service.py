@@ -0,0 +1,308 @@
+"""
+Read-only JSON/HTTP timetable service for other school systems.
+
+Runs next to the Streamlit app over the same data layer and serves::
+
+    GET /api/version
+    GET /api/rooms              GET /api/rooms/<room>      (e.g. /api/rooms/ป.4/1)
+    GET /api/teachers           GET /api/teachers/<name>
+    GET /api/levels             GET /api/levels/<level>    (e.g. /api/levels/ป.4)
+
+Every response body is built once per dataset version, in plain and gzip
+form. The ETag is the dataset version (a hash of the raw worksheet
+values), so a display polling with ``If-None-Match`` gets an empty 304
+until the timetable actually changes. A background thread checks the
+data every ``--refresh`` seconds and swaps in a new index only when the
+version changed. Against Sheets a check is one read of the Meta versions;
+only the worksheets whose version moved are read again (just the new
+journal rows after an append), as ``SyncWorker.poll`` does. With
+``--cache`` it is a local SQLite read.
+
+    python timetable_service.py --port 8600
+    python timetable_service.py --cache .scheduler_cache.sqlite3
+    python timetable_service.py --tenant north --port 8601   # one process per school
+    SCHEDULER_FAKE_SHEETS=seed.json python timetable_service.py
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+from local_store import DATASET_SHEETS, LocalStore, apply_pending
+from rules import split_teachers
+from schedule_store import JOURNAL_SHEET, SNAPSHOT_SHEET, current_journal, schedule_from_tables
+from bell_schedule import BELL_SHEET, BellSchedule
+from sheets_client import FakeSheetsClient, SheetsGateway, rows_to_records
+from tenants import load_tenants
+
+GZIP_MIN_BYTES = 512
+
+
+def dataset_version(values):
+    raw = json.dumps([values.get(t, []) for t in DATASET_SHEETS], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def _level_of(room):
+    return room.split("/")[0] if "/" in room else room
+
+
+class TimetableIndex:
+    """All responses for one dataset version: {path: (json bytes, gzip bytes or None)}."""
+
+    def __init__(self, values):
+        self.version = dataset_version(values)
+        self.built_at = time.time()
+        tables = {t: rows_to_records(values.get(t, [])) for t in DATASET_SHEETS}
+        tables[JOURNAL_SHEET] = rows_to_records(current_journal(values.get(JOURNAL_SHEET, [])))
+        programs = {str(r['ห้องเรียน']): str(r.get('สายการเรียน', '')) for r in tables["Classrooms"]}
+        rooms = list(programs)
+        bell = BellSchedule.from_records(tables[BELL_SHEET])
+        schedule = schedule_from_tables(tables, rooms, bell.days, bell.periods)
+
+        room_docs, teacher_slots = {}, {}
+        for r in rooms:
+            days = {}
+            for d in bell.days:
+                days[d] = {}
+                for p in bell.day_periods[d]:
+                    cell = [{"teacher": str(s['teacher']), "subject": str(s['subject']),
+                             "program": str(s.get('program', 'รวมทุกสาย')),
+                             **({"facility": s['facility']} if s.get('facility') else {})} for s in schedule[r][d][p]]
+                    days[d][str(p)] = cell
+                    for s in cell:
+                        for t in split_teachers(s["teacher"]):
+                            if t:
+                                teacher_slots.setdefault(t, []).append(
+                                    {"day": d, "period": p, "time": bell.time_of(d, p), "room": r,
+                                     "subject": s["subject"], "program": s["program"],
+                                     **({"facility": s["facility"]} if "facility" in s else {})})
+            room_docs[r] = {"room": r, "program": programs[r], "days": days}
+        for t in tables["Teachers"]:
+            teacher_slots.setdefault(str(t['ชื่อ-สกุล']), [])
+
+        levels = {}
+        for r in rooms:
+            levels.setdefault(_level_of(r), []).append(r)
+
+        meta = {"version": self.version, "periods": {str(p): t for p, t in bell.times.items()}, "days": bell.days}
+        if bell.special_days:
+            meta["day_periods"] = {d: {str(p): t for p, t in times.items()} for d, times in bell.special_days.items()}
+        self.responses = {}
+        self._add("/api/version", {"version": self.version, "built_at": self.built_at})
+        self._add("/api/rooms", {**meta, "rooms": rooms})
+        self._add("/api/teachers", {**meta, "teachers": sorted(teacher_slots)})
+        self._add("/api/levels", {**meta, "levels": {lv: rs for lv, rs in levels.items()}})
+        for r, doc in room_docs.items():
+            self._add(f"/api/rooms/{r}", {**meta, **doc})
+        for t, slots in teacher_slots.items():
+            self._add(f"/api/teachers/{t}", {**meta, "teacher": t, "slots": slots})
+        for lv, rs in levels.items():
+            self._add(f"/api/levels/{lv}", {**meta, "level": lv, "rooms": {r: room_docs[r] for r in rs}})
+
+    def _add(self, path, doc):
+        body = json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.responses[path] = (body, gzip.compress(body, 6) if len(body) >= GZIP_MIN_BYTES else None)
+
+
+class TimetableSource:
+    """Reads the raw worksheets either from Google Sheets or from the app's local SQLite cache."""
+
+    def __init__(self, gateway=None, store=None):
+        self.gateway = gateway
+        self.store = store
+        self.values = None    # last values read from Sheets
+        self.versions = {}    # {title: (version, epoch)} from Meta at that read
+
+    def read(self):
+        if self.store is not None:
+            values = self.store.load_dataset() or {t: [] for t in DATASET_SHEETS}
+            return apply_pending(values, self.store.pending())
+        # Meta first: a write landing in between stamps a newer version and is picked up next time
+        self.versions = self.gateway.read_meta()
+        self.values = self.gateway.read_values(DATASET_SHEETS)
+        return self.values
+
+    def poll(self):
+        """Values after re-reading what moved since the last read, or None when the Meta versions show nothing did."""
+        if self.store is not None or self.values is None:
+            return self.read()
+        versions = self.gateway.read_meta()
+        if not versions:
+            return self.read()  # nothing stamped yet, so no way to tell what changed
+        changed = [t for t in DATASET_SHEETS if versions.get(t) != self.versions.get(t)]
+        if not changed:
+            return None
+        values = dict(self.values)
+        # Same epoch = rows were only appended since, so the rows already read are still in place
+        tail_only = (JOURNAL_SHEET in changed and SNAPSHOT_SHEET not in changed and values.get(JOURNAL_SHEET)
+                     and JOURNAL_SHEET in versions
+                     and versions[JOURNAL_SHEET][1] == self.versions.get(JOURNAL_SHEET, (None, None))[1])
+        full = [t for t in changed if not (tail_only and t == JOURNAL_SHEET)]
+        if full:
+            values.update(self.gateway.read_values(full))
+        if tail_only:
+            values[JOURNAL_SHEET] = values[JOURNAL_SHEET] + self.gateway.read_rows_from(JOURNAL_SHEET, len(values[JOURNAL_SHEET]) + 1)
+        self.values, self.versions = values, versions
+        return values
+
+
+class TimetableService:
+    def __init__(self, source, refresh_seconds=60.0):
+        self.source = source
+        self.refresh_seconds = refresh_seconds
+        self.index = TimetableIndex(source.read())
+        self.requests = 0
+        self.not_modified = 0
+        self._counter_lock = threading.Lock()  # handler threads update the counters concurrently
+        self.rebuilds = 1
+        self.last_error = None
+        self._stop = threading.Event()
+
+    def refresh(self):
+        values = self.source.poll()
+        if values is not None and dataset_version(values) != self.index.version:
+            self.index = TimetableIndex(values)  # swapped in one assignment; readers keep the old one
+            self.rebuilds += 1
+            return True
+        return False
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e  # keep serving the last good index
+
+    def start_refresher(self):
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def handler_class(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            server_version = "SchoolTimetable/1.0"
+
+            def do_GET(self):
+                self._respond(head=False)
+
+            def do_HEAD(self):
+                self._respond(head=True)
+
+            def _respond(self, head):
+                with service._counter_lock:
+                    service.requests += 1
+                index = service.index
+                path = unquote(urlsplit(self.path).path).rstrip("/") or "/"
+                entry = index.responses.get(path)
+                if entry is None:
+                    self._send(404, json.dumps({"error": "not found", "path": path}, ensure_ascii=False).encode("utf-8"), head=head)
+                    return
+                etag = f'"{index.version}"'
+                tags = [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]
+                if etag in tags or f"W/{etag}" in tags or "*" in tags:
+                    with service._counter_lock:
+                        service.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", "no-cache")
+                    self.end_headers()
+                    return
+                body, zipped = entry
+                use_gzip = zipped is not None and "gzip" in self.headers.get("Accept-Encoding", "")
+                self._send(200, zipped if use_gzip else body, etag=etag, gzipped=use_gzip, head=head)
+
+            def _send(self, status, body, etag=None, gzipped=False, head=False):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.send_header("Vary", "Accept-Encoding")
+                if etag:
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", "no-cache")
+                if gzipped:
+                    self.send_header("Content-Encoding", "gzip")
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host="0.0.0.0", port=8600):
+        httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.start_refresher()
+        try:
+            httpd.serve_forever()
+        finally:
+            self.stop()
+            httpd.server_close()
+
+
+def _read_secrets():
+    path = os.path.join(".streamlit", "secrets.toml")
+    if not os.path.isfile(path):
+        return {}
+    import tomllib
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def _gspread_client(credentials_path, secrets, credentials_key):
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    if credentials_path:
+        creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_path, scope)
+    else:
+        # Same service account the Streamlit app uses for this school
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(secrets[credentials_key], scope)
+    return gspread.authorize(creds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read-only timetable JSON service")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--refresh", type=float, default=60.0, help="seconds between data checks")
+    parser.add_argument("--tenant", help="school id from the tenants config (default: the first one)")
+    parser.add_argument("--cache", help="serve from an SQLite cache instead of Google Sheets (default path: the school's)",
+                        nargs="?", const="")
+    parser.add_argument("--credentials", default=os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"),
+                        help="service-account JSON (default: .streamlit/secrets.toml)")
+    args = parser.parse_args(argv)
+
+    secrets = _read_secrets()
+    tenants = load_tenants(secrets, default_cache=os.environ.get("SCHEDULER_CACHE_PATH"))
+    if args.tenant is not None and args.tenant not in tenants:
+        parser.error(f"unknown tenant {args.tenant!r} (known: {', '.join(tenants)})")
+    tenant = tenants[args.tenant or next(iter(tenants))]
+
+    if args.cache is not None:
+        source = TimetableSource(store=LocalStore(args.cache or tenant.cache))
+    else:
+        fake = os.environ.get("SCHEDULER_FAKE_SHEETS")
+        if fake:
+            client = FakeSheetsClient.from_json_file(fake) if os.path.isfile(fake) else FakeSheetsClient()
+        else:
+            client = _gspread_client(args.credentials, secrets, tenant.credentials)
+        source = TimetableSource(gateway=SheetsGateway(client, tenant.sheet))
+    service = TimetableService(source, args.refresh)
+    print(f"serving {len(service.index.responses)} timetables for {tenant.name} on http://{args.host}:{args.port} (version {service.index.version})")
+    service.serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()